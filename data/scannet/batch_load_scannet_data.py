@@ -3,12 +3,21 @@ Modified from: https://github.com/facebookresearch/votenet/blob/master/scannet/b
 
 Batch mode in loading Scannet scenes with vertices and ground truth labels for semantic and instance segmentations
 
-Usage example: python ./batch_load_scannet_data.py
+Usage example: python ./batch_load_scannet_data.py --num_workers 8
+
+Exported scans are recorded in OUTPUT_FOLDER/manifest.json together with the mtimes/sizes of their
+source files and the checksums of their outputs, so re-runs only re-export scans that changed or failed.
 """
 
 import os
 import sys
+import json
+import time
+import zlib
+import hashlib
+import argparse
 import datetime
+import multiprocessing as mp
 import numpy as np
 from load_scannet_data import export
 import pdb
@@ -21,12 +30,19 @@ DONOTCARE_CLASS_IDS = np.array([])
 OBJ_CLASS_IDS = np.array([3, 4, 5, 6, 7, 8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 21, 23, 24, 25, 26, 27, 28, 29, 30, 31, 32, 33, 34, 35, 36, 37, 38, 39, 40]) # exclude wall (1), floor (2), ceiling (22)
 MAX_NUM_POINT = 50000
 OUTPUT_FOLDER = './scannet_data'
+MANIFEST_FILE = os.path.join(OUTPUT_FOLDER, 'manifest.json')
+TIMING_FILE = os.path.join(OUTPUT_FOLDER, 'export_timing.csv')
+OUTPUT_SUFFIXES = ['_vert.npy', '_aligned_vert.npy', '_sem_label.npy', '_ins_label.npy', '_bbox.npy', '_aligned_bbox.npy']
 
-def export_one_scan(scan_name, output_filename_prefix):    
+def get_source_files(scan_name):
     mesh_file = os.path.join(SCANNET_DIR, scan_name, scan_name + '_vh_clean_2.ply')
     agg_file = os.path.join(SCANNET_DIR, scan_name, scan_name + '.aggregation.json')
     seg_file = os.path.join(SCANNET_DIR, scan_name, scan_name + '_vh_clean_2.0.010000.segs.json')
-    meta_file = os.path.join(SCANNET_DIR, scan_name, scan_name + '.txt') # includes axisAlignment info for the train set scans.   
+    meta_file = os.path.join(SCANNET_DIR, scan_name, scan_name + '.txt') # includes axisAlignment info for the train set scans.
+    return mesh_file, agg_file, seg_file, meta_file
+
+def export_one_scan(scan_name, output_filename_prefix):    
+    mesh_file, agg_file, seg_file, meta_file = get_source_files(scan_name)
     mesh_vertices, aligned_vertices, semantic_labels, instance_labels, instance_bboxes, aligned_instance_bboxes = export(mesh_file, agg_file, seg_file, meta_file, LABEL_MAP_FILE, None)
 
     # 去除不考虑的object_class，这里没有不要的
@@ -65,22 +81,128 @@ def export_one_scan(scan_name, output_filename_prefix):
     np.save(output_filename_prefix+'_bbox.npy', instance_bboxes)
     np.save(output_filename_prefix+'_aligned_bbox.npy', aligned_instance_bboxes)
 
-def batch_export():
-    if not os.path.exists(OUTPUT_FOLDER):
-        print('Creating new data folder: {}'.format(OUTPUT_FOLDER))                
-        os.mkdir(OUTPUT_FOLDER)        
-        
-    for scan_name in SCAN_NAMES:
-        output_filename_prefix = os.path.join(OUTPUT_FOLDER, scan_name)
-        # if os.path.exists(output_filename_prefix + '_vert.npy'): continue
-        
+def get_source_stats(scan_name):
+    """ (mtime, size) of every source file of a scan, None for missing ones (e.g. no aggregation for test scans) """
+    stats = {}
+    for path in get_source_files(scan_name):
+        if os.path.isfile(path):
+            st = os.stat(path)
+            stats[os.path.basename(path)] = [st.st_mtime, st.st_size]
+        else:
+            stats[os.path.basename(path)] = None
+    return stats
+
+def get_checksum(path, chunk_size=1 << 20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def load_manifest(manifest_file=MANIFEST_FILE):
+    if not os.path.isfile(manifest_file):
+        return {}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+def save_manifest(manifest, manifest_file=MANIFEST_FILE):
+    # write to a temp file first so that an interrupted run never leaves a truncated manifest behind
+    tmp_file = manifest_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+
+def is_up_to_date(scan_name, entry):
+    """ a scan is skipped only if it was exported successfully from unchanged sources and its outputs are intact """
+    if entry is None or entry.get('status') != 'done':
+        return False
+    if entry.get('sources') != get_source_stats(scan_name):
+        return False
+    output_filename_prefix = os.path.join(OUTPUT_FOLDER, scan_name)
+    for suffix, checksum in entry.get('outputs', {}).items():
+        output_file = output_filename_prefix + suffix
+        if not os.path.isfile(output_file) or get_checksum(output_file) != checksum:
+            return False
+    return len(entry.get('outputs', {})) == len(OUTPUT_SUFFIXES)
+
+def export_worker(scan_name):
+    """ export a single scan and return its manifest entry, never raises so that one bad scan does not stop the pool """
+    output_filename_prefix = os.path.join(OUTPUT_FOLDER, scan_name)
+    # seed per scan so that the point subsampling does not depend on worker scheduling
+    np.random.seed(zlib.crc32(scan_name.encode()))
+    start = time.time()
+    entry = {'sources': get_source_stats(scan_name)}
+    try:
         print('-'*20+'begin')
         print(datetime.datetime.now())
         print(scan_name)
-              
+
         export_one_scan(scan_name, output_filename_prefix)
-             
+        entry['outputs'] = {suffix: get_checksum(output_filename_prefix + suffix) for suffix in OUTPUT_SUFFIXES}
+        entry['status'] = 'done'
+
         print('-'*20+'done')
+    except Exception as e:
+        print('Failed to export {}: {!r}'.format(scan_name, e))
+        entry['status'] = 'failed'
+        entry['error'] = repr(e)
+    entry['time'] = time.time() - start
+    return scan_name, entry
+
+def write_timing_summary(timings, timing_file=TIMING_FILE):
+    with open(timing_file, 'w') as f:
+        f.write('scan_name,status,seconds\n')
+        for scan_name, status, seconds in sorted(timings, key=lambda x: -x[2]):
+            f.write('{},{},{:.3f}\n'.format(scan_name, status, seconds))
+
+    exported = [t for t in timings if t[1] != 'skipped']
+    total = sum(t[2] for t in exported)
+    print('Exported {} scans ({} failed), skipped {} up-to-date scans'.format(
+        len(exported), len([t for t in exported if t[1] == 'failed']), len(timings) - len(exported)))
+    if len(exported) > 0:
+        print('Export time per scan: mean {:.2f}s, max {:.2f}s ({}), total {:.2f}s'.format(
+            total / len(exported), max(t[2] for t in exported), max(exported, key=lambda x: x[2])[0], total))
+    print('Per-scan timing written to {}'.format(timing_file))
+
+def batch_export(num_workers=1, force=False):
+    if not os.path.exists(OUTPUT_FOLDER):
+        print('Creating new data folder: {}'.format(OUTPUT_FOLDER))                
+        os.mkdir(OUTPUT_FOLDER)        
+
+    manifest = load_manifest()
+    timings = []
+    todo = []
+    for scan_name in SCAN_NAMES:
+        if not force and is_up_to_date(scan_name, manifest.get(scan_name)):
+            timings.append((scan_name, 'skipped', 0.))
+            continue
+        todo.append(scan_name)
+    print('{} of {} scans need to be exported'.format(len(todo), len(SCAN_NAMES)))
+
+    if num_workers > 1:
+        pool = mp.Pool(num_workers)
+        results = pool.imap_unordered(export_worker, todo)
+    else:
+        pool = None
+        results = map(export_worker, todo)
+
+    try:
+        for scan_name, entry in results:
+            manifest[scan_name] = entry
+            timings.append((scan_name, entry['status'], entry['time']))
+            # keep the manifest current so that an interrupted run can be resumed
+            save_manifest(manifest)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    write_timing_summary(timings)
 
 if __name__=='__main__':    
-    batch_export()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_workers', type=int, default=1, help='number of export processes')
+    parser.add_argument('--force', action='store_true', help='re-export all scans regardless of the manifest')
+    opt = parser.parse_args()
+
+    batch_export(opt.num_workers, opt.force)
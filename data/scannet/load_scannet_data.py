@@ -10,6 +10,7 @@ import os, sys, argparse
 import inspect
 import json
 import pdb
+import tempfile
 import numpy as np
 import scannet_utils
 
@@ -51,7 +52,133 @@ def read_segmentation(filename):
     return seg_to_verts, num_verts
 
 
-def export(mesh_file, agg_file, seg_file, meta_file, label_map_file, output_file=None):
+def read_segmentation_indices(filename):
+    """ read the per-vertex segment ids as an array instead of building the seg_to_verts dict """
+    with open(filename) as f:
+        data = json.load(f)
+        seg_indices = np.asarray(data['segIndices'], dtype=np.int64)
+    return seg_indices
+
+
+def get_vertex_labels_loop(object_id_to_segs, label_to_segs, seg_to_verts, num_verts, label_map):
+    """ reference implementation, assigns the labels vertex list by vertex list """
+    # 创建列表，长度等于点的总数，存储每个点对应的label_id，0则代表该点不对应任何label
+    label_ids = np.zeros(shape=(num_verts), dtype=np.uint32) # 0: unannotated
+    object_id_to_label_id = {}
+    for label, segs in label_to_segs.items():
+        label_id = label_map[label] #从lobel_map中，找到该label对应的id，如label_map['chair']=5
+        for seg in segs:
+            verts = seg_to_verts[seg]
+            label_ids[verts] = label_id
+
+    instance_ids = np.zeros(shape=(num_verts), dtype=np.uint32) # 0: unannotated
+    for object_id, segs in object_id_to_segs.items():
+        for seg in segs:
+            verts = seg_to_verts[seg]
+            instance_ids[verts] = object_id
+            if object_id not in object_id_to_label_id:
+                object_id_to_label_id[object_id] = label_ids[verts][0] #object_id与label_id对应的字典
+
+    return label_ids, instance_ids, object_id_to_label_id
+
+
+def _assign_per_segment(seg_ids, segs_list, values, num_segs):
+    """ per-segment value where later (segs, value) pairs overwrite earlier ones, 0 for untouched segments """
+    seg_values = np.zeros(num_segs, dtype=np.uint32)
+    if len(segs_list) == 0:
+        return seg_values
+    segs = np.concatenate([np.asarray(s, dtype=np.int64) for s in segs_list])
+    vals = np.repeat(np.asarray(values, dtype=np.uint32), [len(s) for s in segs_list])
+    seg_idx = np.searchsorted(seg_ids, segs)
+    seg_idx = np.clip(seg_idx, 0, len(seg_ids) - 1)
+    missing = seg_ids[seg_idx] != segs
+    if missing.any():
+        raise KeyError(int(segs[missing][0]))
+    # keep the last write of every segment, like the sequential loop does
+    _, last = np.unique(seg_idx[::-1], return_index=True)
+    last = len(seg_idx) - 1 - last
+    seg_values[seg_idx[last]] = vals[last]
+    return seg_values
+
+
+def get_vertex_labels(object_id_to_segs, label_to_segs, seg_indices, label_map):
+    """ vectorized get_vertex_labels_loop, groups the vertices by segment with a single unique pass
+    and assigns semantic/instance ids per segment instead of per vertex list
+    """
+    seg_ids, seg_inverse = np.unique(seg_indices, return_inverse=True)
+    seg_inverse = seg_inverse.reshape(-1)
+
+    seg_label_ids = _assign_per_segment(seg_ids, list(label_to_segs.values()),
+                                        [label_map[label] for label in label_to_segs.keys()], len(seg_ids))
+    seg_instance_ids = _assign_per_segment(seg_ids, list(object_id_to_segs.values()),
+                                           list(object_id_to_segs.keys()), len(seg_ids))
+
+    label_ids = seg_label_ids[seg_inverse]
+    instance_ids = seg_instance_ids[seg_inverse]
+
+    # the label of an object is the label of its first segment
+    object_id_to_label_id = {}
+    for object_id, segs in object_id_to_segs.items():
+        if len(segs) > 0:
+            object_id_to_label_id[object_id] = seg_label_ids[np.searchsorted(seg_ids, segs[0])]
+
+    return label_ids, instance_ids, object_id_to_label_id
+
+
+def get_instance_bboxes_loop(mesh_vertices, aligned_vertices, instance_ids, object_ids, object_id_to_label_id, num_instances):
+    """ reference implementation, masks all vertices once per object and mesh """
+    instance_bboxes = np.zeros((num_instances,8)) # also include object id
+    aligned_instance_bboxes = np.zeros((num_instances,8)) # also include object id
+    for obj_id in object_ids:
+        label_id = object_id_to_label_id[obj_id]
+        for vertices, bboxes in ((mesh_vertices, instance_bboxes), (aligned_vertices, aligned_instance_bboxes)):
+            obj_pc = vertices[instance_ids==obj_id, 0:3]
+            if len(obj_pc) == 0: break
+            xmin = np.min(obj_pc[:,0])
+            ymin = np.min(obj_pc[:,1])
+            zmin = np.min(obj_pc[:,2])
+            xmax = np.max(obj_pc[:,0])
+            ymax = np.max(obj_pc[:,1])
+            zmax = np.max(obj_pc[:,2])
+            bbox = np.array([(xmin+xmax)/2, (ymin+ymax)/2, (zmin+zmax)/2, xmax-xmin, ymax-ymin, zmax-zmin, label_id, obj_id-1]) # also include object id
+            bboxes[obj_id-1,:] = bbox
+    return instance_bboxes, aligned_instance_bboxes
+
+
+def get_instance_bboxes(mesh_vertices, aligned_vertices, instance_ids, object_ids, object_id_to_label_id, num_instances):
+    """ axis aligned boxes of all instances in the original and the aligned meshes
+
+    The vertices are sorted by instance id once and the boxes of both meshes come out of
+    segmented min/max reductions, instead of masking all vertices for every object and mesh.
+    An axis aligned bounding box is parameterized by (cx,cy,cz) and (dx,dy,dz) and label id
+    where (cx,cy,cz) is the center point of the box, dx is the x-axis length of the box.
+    Rows are (cx,cy,cz,dx,dy,dz,label_id,obj_id-1), objects without vertices keep a zero row.
+    NOTE: this assumes obj_id is in 1,2,3,.,,,.NUM_INSTANCES
+    """
+    instance_bboxes = np.zeros((num_instances,8)) # also include object id
+    aligned_instance_bboxes = np.zeros((num_instances,8)) # also include object id
+    if len(instance_ids) == 0:
+        return instance_bboxes, aligned_instance_bboxes
+
+    order = np.argsort(instance_ids, kind='stable')
+    ids, starts = np.unique(instance_ids[order], return_index=True)
+    # raw and aligned coordinates side by side so that both boxes come out of the same reduction
+    xyz = np.concatenate([mesh_vertices[order, 0:3], aligned_vertices[order, 0:3]], axis=1)
+    xyz_min = np.minimum.reduceat(xyz, starts, axis=0)
+    xyz_max = np.maximum.reduceat(xyz, starts, axis=0)
+
+    keep = np.isin(ids, np.asarray(object_ids, dtype=np.int64))
+    ids, xyz_min, xyz_max = ids[keep].astype(np.int64), xyz_min[keep], xyz_max[keep]
+    label_ids = [object_id_to_label_id[obj_id] for obj_id in ids]
+    for bboxes, cols in ((instance_bboxes, slice(0, 3)), (aligned_instance_bboxes, slice(3, 6))):
+        bboxes[ids-1, 0:3] = (xyz_min[:, cols] + xyz_max[:, cols]) / 2
+        bboxes[ids-1, 3:6] = xyz_max[:, cols] - xyz_min[:, cols]
+        bboxes[ids-1, 6] = label_ids
+        bboxes[ids-1, 7] = ids - 1
+    return instance_bboxes, aligned_instance_bboxes
+
+
+def export(mesh_file, agg_file, seg_file, meta_file, label_map_file, output_file=None, vectorized=True):
     """ points are XYZ RGB (RGB in 0-255),
     semantic label as nyu40 ids,
     instance label as 1-#instance,
@@ -89,67 +216,21 @@ def export(mesh_file, agg_file, seg_file, meta_file, label_map_file, output_file
     # Load semantic and instance labels
     if os.path.isfile(agg_file):
         object_id_to_segs, label_to_segs = read_aggregation(agg_file)
-        seg_to_verts, num_verts = read_segmentation(seg_file)
         # 由以上的字典，则可以得出每个点对应的object_id和label
+        if vectorized:
+            seg_indices = read_segmentation_indices(seg_file)
+            label_ids, instance_ids, object_id_to_label_id = get_vertex_labels(
+                object_id_to_segs, label_to_segs, seg_indices, label_map)
+        else:
+            seg_to_verts, num_verts = read_segmentation(seg_file)
+            label_ids, instance_ids, object_id_to_label_id = get_vertex_labels_loop(
+                object_id_to_segs, label_to_segs, seg_to_verts, num_verts, label_map)
 
-        # 创建列表，长度等于点的总数，存储每个点对应的label_id，0则代表该点不对应任何label
-        label_ids = np.zeros(shape=(num_verts), dtype=np.uint32) # 0: unannotated
-        object_id_to_label_id = {}
-        for label, segs in label_to_segs.items():
-            label_id = label_map[label] #从lobel_map中，找到该label对应的id，如label_map['chair']=5
-            for seg in segs:
-                verts = seg_to_verts[seg]
-                label_ids[verts] = label_id
-
-        instance_ids = np.zeros(shape=(num_verts), dtype=np.uint32) # 0: unannotated
         num_instances = len(np.unique(list(object_id_to_segs.keys())))
-        for object_id, segs in object_id_to_segs.items():
-            for seg in segs:
-                verts = seg_to_verts[seg]
-                instance_ids[verts] = object_id
-                if object_id not in object_id_to_label_id:
-                    object_id_to_label_id[object_id] = label_ids[verts][0] #object_id与label_id对应的字典
-        
-        instance_bboxes = np.zeros((num_instances,8)) # also include object id
-        aligned_instance_bboxes = np.zeros((num_instances,8)) # also include object id
-        for obj_id in object_id_to_segs:
-            label_id = object_id_to_label_id[obj_id]
-
-            # bboxes in the original meshes
-            obj_pc = mesh_vertices[instance_ids==obj_id, 0:3]
-            if len(obj_pc) == 0: continue
-            # Compute axis aligned box
-            # An axis aligned bounding box is parameterized by
-            # (cx,cy,cz) and (dx,dy,dz) and label id
-            # where (cx,cy,cz) is the center point of the box,
-            # dx is the x-axis length of the box.
-            xmin = np.min(obj_pc[:,0])
-            ymin = np.min(obj_pc[:,1])
-            zmin = np.min(obj_pc[:,2])
-            xmax = np.max(obj_pc[:,0])
-            ymax = np.max(obj_pc[:,1])
-            zmax = np.max(obj_pc[:,2])
-            bbox = np.array([(xmin+xmax)/2, (ymin+ymax)/2, (zmin+zmax)/2, xmax-xmin, ymax-ymin, zmax-zmin, label_id, obj_id-1]) # also include object id
-            # NOTE: this assumes obj_id is in 1,2,3,.,,,.NUM_INSTANCES
-            instance_bboxes[obj_id-1,:] = bbox 
-
-            # bboxes in the aligned meshes
-            obj_pc = aligned_vertices[instance_ids==obj_id, 0:3]
-            if len(obj_pc) == 0: continue
-            # Compute axis aligned box
-            # An axis aligned bounding box is parameterized by
-            # (cx,cy,cz) and (dx,dy,dz) and label id
-            # where (cx,cy,cz) is the center point of the box,
-            # dx is the x-axis length of the box.
-            xmin = np.min(obj_pc[:,0])
-            ymin = np.min(obj_pc[:,1])
-            zmin = np.min(obj_pc[:,2])
-            xmax = np.max(obj_pc[:,0])
-            ymax = np.max(obj_pc[:,1])
-            zmax = np.max(obj_pc[:,2])
-            bbox = np.array([(xmin+xmax)/2, (ymin+ymax)/2, (zmin+zmax)/2, xmax-xmin, ymax-ymin, zmax-zmin, label_id, obj_id-1]) # also include object id
-            # NOTE: this assumes obj_id is in 1,2,3,.,,,.NUM_INSTANCES
-            aligned_instance_bboxes[obj_id-1,:] = bbox 
+        get_bboxes = get_instance_bboxes if vectorized else get_instance_bboxes_loop
+        instance_bboxes, aligned_instance_bboxes = get_bboxes(
+            mesh_vertices, aligned_vertices, instance_ids, list(object_id_to_segs.keys()), object_id_to_label_id,
+            num_instances)
     else:
         # use zero as placeholders for the test scene
         print("use placeholders")
@@ -169,18 +250,85 @@ def export(mesh_file, agg_file, seg_file, meta_file, label_map_file, output_file
 
     return mesh_vertices, aligned_vertices, label_ids, instance_ids, instance_bboxes, aligned_instance_bboxes
 
+def check_vectorized(mesh_file, agg_file, seg_file, meta_file, label_map_file):
+    """ compare the vectorized labels and boxes against the reference loops, outputs must be byte-identical """
+    outputs = export(mesh_file, agg_file, seg_file, meta_file, label_map_file, None, vectorized=True)
+    outputs_loop = export(mesh_file, agg_file, seg_file, meta_file, label_map_file, None, vectorized=False)
+    names = ['vert', 'aligned_vert', 'sem_label', 'ins_label', 'bbox', 'aligned_bbox']
+    for name, arr, arr_loop in zip(names, outputs, outputs_loop):
+        assert arr.dtype == arr_loop.dtype and arr.shape == arr_loop.shape, name
+        assert arr.tobytes() == arr_loop.tobytes(), '{} differs from the reference implementation'.format(name)
+    print('vectorized export matches the reference implementation')
+
+def check_vectorized_synthetic(num_verts=20000, num_segs=300, num_objects=40, seed=0):
+    """ check_vectorized on a random scene, runs without ScanNet data
+
+    The aggregation and segmentation files are written to a temp folder and read back with
+    read_aggregation / read_segmentation(_indices), so the labels go through the same path as
+    in export. Segment ids are sparse, objects may share segments (the later object wins) and
+    some objects lose all their vertices to later ones.
+    """
+    rng = np.random.RandomState(seed)
+    seg_ids = np.sort(rng.choice(num_segs * 10, num_segs, replace=False))
+    seg_indices = rng.choice(seg_ids, num_verts)
+    labels = ['wall', 'floor', 'chair', 'table', 'door', 'window']
+    label_map = {label: i + 1 for i, label in enumerate(labels)}
+    seg_groups = []
+    for i in range(num_objects):
+        segs = rng.choice(seg_ids, rng.randint(1, 12), replace=False).tolist()
+        seg_groups.append({'objectId': i, 'label': labels[rng.randint(len(labels))], 'segments': segs})
+
+    with tempfile.TemporaryDirectory() as folder:
+        agg_file = os.path.join(folder, 'scene.aggregation.json')
+        seg_file = os.path.join(folder, 'scene.segs.json')
+        with open(agg_file, 'w') as f:
+            json.dump({'segGroups': seg_groups}, f)
+        with open(seg_file, 'w') as f:
+            json.dump({'segIndices': seg_indices.tolist()}, f)
+        object_id_to_segs, label_to_segs = read_aggregation(agg_file)
+        seg_to_verts, num_verts = read_segmentation(seg_file)
+        outputs = get_vertex_labels(object_id_to_segs, label_to_segs, read_segmentation_indices(seg_file), label_map)
+        outputs_loop = get_vertex_labels_loop(object_id_to_segs, label_to_segs, seg_to_verts, num_verts, label_map)
+
+    for name, arr, arr_loop in zip(['sem_label', 'ins_label'], outputs[:2], outputs_loop[:2]):
+        assert arr.dtype == arr_loop.dtype and arr.tobytes() == arr_loop.tobytes(), \
+            '{} differs from the reference implementation'.format(name)
+    assert {k: int(v) for k, v in outputs[2].items()} == {k: int(v) for k, v in outputs_loop[2].items()}, \
+        'object_id_to_label_id differs from the reference implementation'
+
+    mesh_vertices = rng.rand(num_verts, 6) * 5
+    aligned_vertices = mesh_vertices.copy()
+    aligned_vertices[:, 0:3] = mesh_vertices[:, 0:3] @ rng.rand(3, 3) + rng.rand(3)
+    object_ids = list(object_id_to_segs.keys())
+    args = (mesh_vertices, aligned_vertices, outputs[1], object_ids, outputs[2], len(np.unique(object_ids)))
+    for name, arr, arr_loop in zip(['bbox', 'aligned_bbox'], get_instance_bboxes(*args), get_instance_bboxes_loop(*args)):
+        assert arr.dtype == arr_loop.dtype and arr.tobytes() == arr_loop.tobytes(), \
+            '{} differs from the reference implementation'.format(name)
+    print('vectorized labels and boxes match the reference implementation on a synthetic scene')
+
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument('--scan_path', required=True, help='path to scannet scene (e.g., data/ScanNet/v2/scene0000_00')
-    parser.add_argument('--output_file', required=True, help='output file')
-    parser.add_argument('--label_map_file', required=True, help='path to scannetv2-labels.combined.tsv')
+    parser.add_argument('--scan_path', help='path to scannet scene (e.g., data/ScanNet/v2/scene0000_00')
+    parser.add_argument('--output_file', help='output file')
+    parser.add_argument('--label_map_file', help='path to scannetv2-labels.combined.tsv')
+    parser.add_argument('--check_vectorized', action='store_true', help='compare against the reference loop implementation')
+    parser.add_argument('--check_synthetic', action='store_true',
+                        help='only compare against the reference loop implementation on a random scene (no ScanNet data needed)')
     opt = parser.parse_args()
 
+    if opt.check_synthetic:
+        check_vectorized_synthetic()
+        return
+    if opt.scan_path is None or opt.output_file is None or opt.label_map_file is None:
+        parser.error('--scan_path, --output_file and --label_map_file are required')
+
     scan_name = os.path.split(opt.scan_path)[-1]
     mesh_file = os.path.join(opt.scan_path, scan_name + '_vh_clean_2.ply')
     agg_file = os.path.join(opt.scan_path, scan_name + '.aggregation.json')
     seg_file = os.path.join(opt.scan_path, scan_name + '_vh_clean_2.0.010000.segs.json')
     meta_file = os.path.join(opt.scan_path, scan_name + '.txt') # includes axisAlignment info for the train set scans.
+    if opt.check_vectorized:
+        check_vectorized(mesh_file, agg_file, seg_file, meta_file, opt.label_map_file)
     export(mesh_file, agg_file, seg_file, meta_file, opt.label_map_file, opt.output_file)
 
 if __name__ == '__main__':
@@ -7,6 +7,7 @@ import sys
 import json
 import csv
 import numpy as np
+from numpy.lib import recfunctions
 
 try:
     from plyfile import PlyData, PlyElement
@@ -36,10 +37,8 @@ def compute_normal(vertices, faces):
     # now we have a normalized array of normals, one per triangle, i.e., per triangle normals.
     # But instead of one per triangle (i.e., flat shading), we add to each vertex in that triangle, 
     # the triangles' normal. Multiple triangles would then contribute to every vertex, so we need to normalize again afterwards.
-    # The cool part, we can actually add the normals through an indexed view of our (zeroed) per vertex normal array
-    normals[ faces[:,0] ] += n
-    normals[ faces[:,1] ] += n
-    normals[ faces[:,2] ] += n
+    # np.add.at accumulates over repeated indices, a plain fancy-indexed += would keep only one triangle per vertex
+    np.add.at(normals, faces.reshape(-1), np.repeat(n, 3, axis=0))
     normalize_v3(normals)
     
     return normals
@@ -64,17 +63,99 @@ def read_label_mapping(filename, label_from='raw_category', label_to='nyu40id'):
         mapping = {int(k):v for k,v in mapping.items()}
     return mapping
 
+PLY_DTYPES = {
+    'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1',
+    'short': 'i2', 'int16': 'i2', 'ushort': 'u2', 'uint16': 'u2',
+    'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+    'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8',
+}
+
+def read_ply_header(f):
+    """ parse a PLY header from an open binary file.
+    returns (format, elements, header size in bytes), elements is a list of (name, count, properties)
+    and every property is (name, type, list item type or None)
+    """
+    if f.readline().strip() != b'ply':
+        raise ValueError('not a PLY file')
+    fmt = None
+    elements = []
+    while True:
+        line = f.readline()
+        if not line:
+            raise ValueError('unexpected end of PLY header')
+        tokens = line.decode('ascii').split()
+        if len(tokens) == 0:
+            continue
+        if tokens[0] == 'format':
+            fmt = tokens[1]
+        elif tokens[0] == 'element':
+            elements.append((tokens[1], int(tokens[2]), []))
+        elif tokens[0] == 'property':
+            if tokens[1] == 'list':
+                elements[-1][2].append((tokens[4], tokens[2], tokens[3]))
+            else:
+                elements[-1][2].append((tokens[2], tokens[1], None))
+        elif tokens[0] == 'end_header':
+            break
+    return fmt, elements, f.tell()
+
+def read_ply_binary(filename):
+    """ map every element of a binary little endian PLY file straight into a numpy structured array.
+    List properties are supported when all lists of an element have the same length (e.g. triangle faces),
+    they become a '<name>_count' field plus a fixed size '<name>' subarray field.
+    Raises ValueError for files this reader can not handle, callers fall back to plyfile.
+    """
+    with open(filename, 'rb') as f:
+        fmt, elements, offset = read_ply_header(f)
+    if fmt != 'binary_little_endian':
+        raise ValueError('only binary_little_endian PLY files are supported, got {}'.format(fmt))
+    data = np.memmap(filename, dtype=np.uint8, mode='r')
+
+    out = {}
+    for name, count, properties in elements:
+        fields = []
+        pos = offset  # position inside the first element, used to peek the list lengths
+        for prop_name, prop_type, item_type in properties:
+            if item_type is None:
+                fields.append((prop_name, '<' + PLY_DTYPES[prop_type]))
+                pos += np.dtype(PLY_DTYPES[prop_type]).itemsize
+            else:
+                count_dtype = np.dtype('<' + PLY_DTYPES[prop_type])
+                list_len = int(np.frombuffer(data, dtype=count_dtype, count=1, offset=pos)[0]) if count > 0 else 0
+                fields.append((prop_name + '_count', count_dtype))
+                fields.append((prop_name, '<' + PLY_DTYPES[item_type], (list_len,)))
+                pos += count_dtype.itemsize + list_len * np.dtype(PLY_DTYPES[item_type]).itemsize
+        dtype = np.dtype(fields)
+        if offset + dtype.itemsize * count > data.shape[0]:
+            raise ValueError('PLY element {} exceeds the file size'.format(name))
+        arr = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+        for prop_name, _, item_type in properties:
+            if item_type is not None and count > 0 and np.any(arr[prop_name + '_count'] != arr[prop_name].shape[1]):
+                raise ValueError('variable length list property {} is not supported'.format(prop_name))
+        out[name] = arr
+        offset += dtype.itemsize * count
+    return out
+
+def read_mesh_arrays(filename):
+    """ vertex structured array and (num_faces, 3) face indices of a mesh, fast path for binary PLY """
+    try:
+        ply = read_ply_binary(filename)
+        vertex = ply['vertex']
+        face = ply['face']['vertex_indices'] if 'face' in ply else np.zeros((0, 3), dtype=np.int64)
+    except (ValueError, KeyError):
+        with open(filename, 'rb') as f:
+            plydata = PlyData.read(f)
+        vertex = plydata['vertex'].data
+        face = np.vstack(plydata['face'].data['vertex_indices']) if 'face' in plydata and plydata['face'].count > 0 \
+            else np.zeros((0, 3), dtype=np.int64)
+    return vertex, face
+
 def read_mesh_vertices(filename):
     """ read XYZ for each vertex.
     """
     assert os.path.isfile(filename)
-    with open(filename, 'rb') as f:
-        plydata = PlyData.read(f)
-        num_verts = plydata['vertex'].count
-        vertices = np.zeros(shape=[num_verts, 3], dtype=np.float32)
-        vertices[:,0] = plydata['vertex'].data['x']
-        vertices[:,1] = plydata['vertex'].data['y']
-        vertices[:,2] = plydata['vertex'].data['z']
+    vertex, _ = read_mesh_arrays(filename)
+    vertices = recfunctions.structured_to_unstructured(vertex[['x', 'y', 'z']], dtype=np.float32)
     return vertices
 
 def read_mesh_vertices_rgb(filename):
@@ -82,35 +163,22 @@ def read_mesh_vertices_rgb(filename):
     Note: RGB values are in 0-255
     """
     assert os.path.isfile(filename)
-    with open(filename, 'rb') as f:
-        plydata = PlyData.read(f)
-        num_verts = plydata['vertex'].count
-        vertices = np.zeros(shape=[num_verts, 6], dtype=np.float32)
-        vertices[:,0] = plydata['vertex'].data['x']
-        vertices[:,1] = plydata['vertex'].data['y']
-        vertices[:,2] = plydata['vertex'].data['z']
-        vertices[:,3] = plydata['vertex'].data['red']
-        vertices[:,4] = plydata['vertex'].data['green']
-        vertices[:,5] = plydata['vertex'].data['blue']
+    vertex, _ = read_mesh_arrays(filename)
+    vertices = recfunctions.structured_to_unstructured(
+        vertex[['x', 'y', 'z', 'red', 'green', 'blue']], dtype=np.float32)
     return vertices
 
 def read_mesh_vertices_rgb_normal(filename):
     """ read XYZ RGB normals point cloud from filename PLY file """
     assert os.path.isfile(filename)
-    with open(filename, 'rb') as f:
-        plydata = PlyData.read(f)
-        num_verts = plydata['vertex'].count
-        vertices = np.zeros(shape=[num_verts, 9], dtype=np.float32)
-        vertices[:,0] = plydata['vertex'].data['x']
-        vertices[:,1] = plydata['vertex'].data['y']
-        vertices[:,2] = plydata['vertex'].data['z']
-        vertices[:,3] = plydata['vertex'].data['red']
-        vertices[:,4] = plydata['vertex'].data['green']
-        vertices[:,5] = plydata['vertex'].data['blue']
-
-        # compute normals
-        xyz = np.array([[x, y, z] for x, y, z, _, _, _, _ in plydata["vertex"].data])
-        face = np.array([f[0] for f in plydata["face"].data])
-        nxnynz = compute_normal(xyz, face)
-        vertices[:,6:] = nxnynz
+    vertex, face = read_mesh_arrays(filename)
+    num_verts = vertex.shape[0]
+    vertices = np.zeros(shape=[num_verts, 9], dtype=np.float32)
+    vertices[:,0:6] = recfunctions.structured_to_unstructured(
+        vertex[['x', 'y', 'z', 'red', 'green', 'blue']], dtype=np.float32)
+
+    # compute normals
+    xyz = recfunctions.structured_to_unstructured(vertex[['x', 'y', 'z']], dtype=np.float64)
+    nxnynz = compute_normal(xyz, face.astype(np.int64))
+    vertices[:,6:] = nxnynz
     return vertices
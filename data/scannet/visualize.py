@@ -1,35 +1,40 @@
 import os
 import argparse
+import multiprocessing as mp
 
 import numpy as np
 
+
+def write_obj(verts, output_file, faces=None):
+    """ write "v x y z [r g b]" lines (and 1-based "f" lines) in bulk, verts: (N, 3) or (N, 6) """
+    fmt = "v" + " %.6f" * verts.shape[1] + "\n"
+    with open(output_file, "w") as f:
+        # one %-formatting call for all vertices instead of one str.format per vertex
+        f.write((fmt * verts.shape[0]) % tuple(verts.ravel().tolist()))
+        if faces is not None:
+            f.write(("f %d %d %d\n" * faces.shape[0]) % tuple((faces + 1).ravel().tolist()))
+
+
+def export_scene(scene_id):
+    verts = np.load("scannet_data/{}_vert.npy".format(scene_id))
+    aligned_verts = np.load("scannet_data/{}_aligned_vert.npy".format(scene_id))
+
+    write_obj(verts[:, 0:6], "scannet_data/{}_verts.obj".format(scene_id))
+    write_obj(aligned_verts[:, 0:6], "scannet_data/{}_aligned_verts.obj".format(scene_id))
+
+    return scene_id
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--scene_id", type=str, help="scene id of scene to be visualized", default="scene0000_00")
+    parser.add_argument("--scene_id", type=str, nargs="+", help="scene id(s) of scene to be visualized", default=["scene0000_00"])
+    parser.add_argument("--num_workers", type=int, default=1, help="number of scenes exported in parallel")
     args = parser.parse_args()
 
-    verts = np.load("scannet_data/{}_vert.npy".format(args.scene_id))
-    aligned_verts = np.load("scannet_data/{}_aligned_vert.npy".format(args.scene_id))
-
-
-    with open("scannet_data/{}_verts.obj".format(args.scene_id), "w") as f:
-        for i in range(verts.shape[0]):
-            f.write("v {} {} {} {} {} {}\n".format(
-                verts[i, 0], 
-                verts[i, 1], 
-                verts[i, 2], 
-                verts[i, 3], 
-                verts[i, 4], 
-                verts[i, 5]
-            ))
-
-    with open("scannet_data/{}_aligned_verts.obj".format(args.scene_id), "w") as f:
-        for i in range(aligned_verts.shape[0]):
-            f.write("v {} {} {} {} {} {}\n".format(
-                aligned_verts[i, 0], 
-                aligned_verts[i, 1], 
-                aligned_verts[i, 2], 
-                aligned_verts[i, 3], 
-                aligned_verts[i, 4], 
-                aligned_verts[i, 5]
-            ))
+    if args.num_workers > 1:
+        with mp.Pool(args.num_workers) as pool:
+            for scene_id in pool.imap_unordered(export_scene, args.scene_id):
+                print("exported {}".format(scene_id))
+    else:
+        for scene_id in args.scene_id:
+            export_scene(scene_id)
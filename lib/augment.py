@@ -0,0 +1,130 @@
+'''
+Batched version of ScannetReferenceDataset.dataAugment (jitter, flip, rotation, scale).
+
+dataAugment builds a 3x3 matrix in numpy for every sample inside transform_train and transforms
+the points in the DataLoader worker. With the batch_augment option of ScannetReferenceDataset the
+worker only draws the matrices (random_affine, same distribution as dataAugment, the scale is
+folded into the matrix, one seed per sample so a matrix does not depend on the rest of the batch)
+and skips the voxelization. augment_batch then runs on the collated batch after it was moved to
+the device (CapNet.on_after_batch_transfer): the affine of every sample (batch_affine), the
+elastic distortion, the voxel coordinates and the voxelization, all with torch ops.
+
+The affine comes after the crop of transform_train here. crop only drops points when a scene has
+more than max_npoint of them, and then the window depends on the transformed points, so those
+scenes are still augmented in the worker (see aug_mask). Their voxel coordinates come with the batch
+(aug_coords) and are kept as they are.
+'''
+
+import math
+
+import numpy as np
+import torch
+
+from lib.elastic import elastic_batch
+from lib.voxel_cache import voxelize_batch
+
+FIXED_THETA = 0.35 * math.pi  # rotation of dataAugment when the random rotation is not applied
+
+
+def _draw(batch_size, seeds=None, generator=None):
+    """ the random numbers of dataAugment for batch_size samples, uniform (B, 7) and normal (B, 9), float64 """
+    if seeds is None:
+        return (torch.rand(batch_size, 7, generator=generator, dtype=torch.float64),
+                torch.randn(batch_size, 9, generator=generator, dtype=torch.float64))
+    uniform = torch.empty(batch_size, 7, dtype=torch.float64)
+    normal = torch.empty(batch_size, 9, dtype=torch.float64)
+    for i, seed in enumerate(seeds):
+        generator = torch.Generator().manual_seed(int(seed))
+        torch.rand(7, generator=generator, dtype=torch.float64, out=uniform[i])
+        torch.randn(9, generator=generator, dtype=torch.float64, out=normal[i])
+    return uniform, normal
+
+
+def random_affine(batch_size, jitter=True, flip=True, rot=True, scale=True, prob=1.0, seeds=None, generator=None):
+    """ (B, 3, 3) float64 matrices, points are transformed as xyz @ m like in dataAugment
+
+    seeds: one int per sample, every sample then draws from its own torch.Generator,
+    otherwise all samples draw from generator (the default generator if None).
+    """
+    uniform, normal = _draw(batch_size, seeds, generator)
+    gate = (uniform[:, :4] < prob).double()  # jitter, flip, rotation, scale
+    if not jitter:
+        gate[:, 0] = 0
+    if not flip:
+        gate[:, 1] = 0
+    if not rot:
+        gate[:, 2] = 0
+    if not scale:
+        gate[:, 3] = 0
+
+    m = torch.eye(3, dtype=torch.float64) + normal.view(-1, 3, 3) * (0.1 * gate[:, 0, None, None])
+    m[:, 0, 0] *= 1 - 2 * gate[:, 1] * (uniform[:, 4] < 0.5).double()
+    theta = gate[:, 2] * uniform[:, 5] * 2 * math.pi + (1 - gate[:, 2]) * FIXED_THETA
+    cos, sin = torch.cos(theta), torch.sin(theta)
+    rotation = torch.stack([cos, sin, torch.zeros_like(theta), -sin, cos, torch.zeros_like(theta),
+                            torch.zeros_like(theta), torch.zeros_like(theta), torch.ones_like(theta)], 1).view(-1, 3, 3)
+    m = torch.bmm(m, rotation)
+    return m * (1 + gate[:, 3] * (uniform[:, 6] * 0.1 - 0.05))[:, None, None]
+
+
+def get_batch_offsets(batch_idxs, batch_size):
+    """ (B + 1) start of every sample in the concatenated points, batch_idxs: (N) sample of every point (in order) """
+    return torch.cat([batch_idxs.new_zeros(1, dtype=torch.long),
+                      torch.bincount(batch_idxs, minlength=batch_size).cumsum(0)])
+
+
+def batch_affine(xyz, batch_offsets, matrices):
+    """ xyz: (N, 3) concatenated points of the batch, batch_offsets: (B + 1) start of every sample in xyz,
+    matrices: (B, 3, 3), returns xyz @ matrices[i] for the points of every sample i in the dtype / on the device of xyz
+
+    The points of a sample are contiguous (collate_fn), so every sample is one (n, 3) @ (3, 3) matmul.
+    """
+    matrices = matrices.to(device=xyz.device, dtype=xyz.dtype)
+    batch_offsets = batch_offsets.tolist()
+    out = torch.empty_like(xyz)
+    for i, (start, end) in enumerate(zip(batch_offsets[:-1], batch_offsets[1:])):
+        torch.mm(xyz[start:end], matrices[i], out=out[start:end])
+    return out
+
+
+def augment_batch(batch, voxel_cfg):
+    """ the augmentation of transform_train for the samples of aug_mask, done on the device of the batch
+
+    batch: collate_fn output with aug_matrices (B, 3, 3), aug_mask (B) and, if not all samples are in aug_mask,
+    aug_coords (N, 1 + 3) (all are removed) and without voxelization, coords_float and pt_offset_labels are
+    transformed, voxel_coords, v2p_map, p2v_map and spatial_shape (and coords if in the batch) are computed from
+    the augmented points and the voxel coordinates of aug_coords for the samples not in aug_mask.
+    """
+    matrices, mask = batch.pop('aug_matrices'), batch.pop('aug_mask')
+    coords = batch.pop('aug_coords', None)
+    batch_idxs = batch['batch_idxs'].long()
+    batch_offsets = get_batch_offsets(batch_idxs, batch['batch_size'])
+
+    # 点相对instance中心的偏移是线性的，和点坐标做同样的变换（worker中已增强的场景的矩阵是单位矩阵）
+    coords_float = batch_affine(batch['coords_float'], batch_offsets, matrices)
+    pt_offset_labels = batch_affine(batch['pt_offset_labels'], batch_offsets, matrices)
+    # 不属于任何instance的点的偏移是-100 - xyz（见get_instance_info），不是线性的
+    unassigned = batch['instance_labels'] < 0
+    pt_offset_labels[unassigned] = -100. - coords_float[unassigned]
+
+    # elastic和平移只对aug_mask中的场景做，其余场景在worker中已做过（还有crop），用aug_coords中的voxel坐标
+    mask = mask.to(coords_float.device)
+    points = mask[batch_idxs]
+    lengths = (batch_offsets[1:] - batch_offsets[:-1])[mask]
+    offsets = torch.cat([lengths.new_zeros(1), lengths.cumsum(0)])
+    xyz = elastic_batch(coords_float[points] * voxel_cfg.scale, offsets, 6, 40.)
+    xyz = elastic_batch(xyz, offsets, 20, 160.)
+    for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist()):
+        xyz[start:end] -= xyz[start:end].min(0)[0]
+
+    if coords is None:
+        coords = torch.cat([batch_idxs[:, None], xyz.long()], 1)
+    else:
+        coords = coords.to(xyz.device, copy=True)
+        coords[points, 1:] = xyz.long()
+    batch['voxel_coords'], batch['v2p_map'], batch['p2v_map'] = voxelize_batch(coords)
+    batch['spatial_shape'] = np.clip(coords.max(0)[0][1:].cpu().numpy() + 1, voxel_cfg.spatial_shape[0], None)
+    batch['coords_float'], batch['pt_offset_labels'] = coords_float, pt_offset_labels
+    if 'coords' in batch:
+        batch['coords'] = coords
+    return batch
@@ -0,0 +1,111 @@
+'''
+Output type of ScannetReferenceDataset.collate_fn.
+
+Batch is a plain dict (every key access of the model stays the same) that can pin and move all
+of its tensors at once. DataLoader(pin_memory=True) calls pin_memory in its pin thread. Lightning
+moves a batch that is not a plain tensor with batch.to(device), without non_blocking, so Batch.to
+copies with non_blocking=True by default: the host-to-device copies of the pinned tensors are
+queued on the current stream without the CPU waiting for each of them, so they overlap with the
+GPU work still queued from the previous step (copies of pageable tensors stay synchronous).
+
+BatchBufferRing is the per-worker set of shared memory buffers collate_fn writes into (see the
+batch_ring_size option of ScannetReferenceDataset). collate_fn runs in the DataLoader worker, so
+the per-sample arrays never leave it, only the collated batch goes through the result queue.
+Torch moves every tensor of it into a new shared memory segment before sending the handle; the
+tensors of a ring slot are in shared memory already, so only their handles are sent. A slot is
+written again num_slots batches later, so the training process must be done with a batch by then:
+num_slots has to be larger than the number of batches of a worker that can be alive at once:
+prefetch_factor queued ones, the one in use and the one Lightning fetches ahead, i.e. at least
+min_ring_size(prefetch_factor), 5 with the default prefetch_factor=2. With pin_memory=True the pin
+thread copies the batch out of the slot right away.
+
+With field projection (the fields option of ScannetReferenceDataset) a Batch only holds the keys
+declared for the stage. In validation mode the other keys are collated as well and their names
+kept in Batch.undeclared: reading one of them with batch[key] or batch.get(key) warns and returns
+it, so a model that needs a key missing from the declaration keeps running and names the key.
+forward(**batch) gets all keys without going through batch[key], warn_undeclared_args does the
+check for the named arguments of forward. scripts/check_stage_fields.py checks the declarations
+against the model without running it.
+'''
+
+import inspect
+import warnings
+
+import numpy as np
+import torch
+
+
+def _pin(v):
+    return v.pin_memory() if torch.is_tensor(v) and not v.is_pinned() else v
+
+
+class Batch(dict):
+    """ dict of tensors and other values (scan ids, spatial_shape, batch_size, ...) of one batch """
+
+    def __init__(self, *args, undeclared=(), **kwargs):
+        super().__init__(*args, **kwargs)
+        self.undeclared = frozenset(undeclared)  # keys outside the declared fields, see the module docstring
+
+    def __getitem__(self, key):
+        if key in self.undeclared:
+            _warn_undeclared(key)
+        return super().__getitem__(key)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def pin_memory(self):
+        return Batch({k: _pin(v) for k, v in self.items()}, undeclared=self.undeclared)
+
+    def to(self, device, non_blocking=True):
+        """ copy of the batch with all tensors on device, non_blocking is only asynchronous for pinned tensors """
+        def move(v):
+            return v.to(device, non_blocking=non_blocking) if torch.is_tensor(v) else v
+        return Batch({k: move(v) for k, v in self.items()}, undeclared=self.undeclared)
+
+
+def _warn_undeclared(key):
+    warnings.warn("batch key '{}' is not in the declared fields of the dataset".format(key), stacklevel=3)
+
+
+def warn_undeclared_args(batch, fn):
+    """ before fn(**batch): warns about the undeclared keys of batch that fn takes as named arguments """
+    if isinstance(batch, Batch):
+        for key in sorted(batch.undeclared & set(inspect.signature(fn).parameters)):
+            _warn_undeclared(key)
+
+
+def min_ring_size(prefetch_factor):
+    """ smallest num_slots of a BatchBufferRing without pin_memory for DataLoader(prefetch_factor=...) """
+    return prefetch_factor + 3
+
+
+class BatchBufferRing(object):
+    """ num_slots sets of named shared memory tensors, collate_fn takes next_slot() once per batch and
+    empty(name, size, dtype) for every output """
+
+    def __init__(self, num_slots, growth=1.25):
+        self.num_slots = num_slots
+        self.growth = growth  # headroom of a (re)allocated buffer, batches differ in their number of points
+        self.slots = [{} for _ in range(num_slots)]  # name -> flat shared tensor
+        self.index = 0
+
+    def next_slot(self):
+        self.index = (self.index + 1) % self.num_slots
+
+    def empty(self, name, size, dtype):
+        """ uninitialized (size) view of the buffer name of the current slot, grown if too small """
+        slot = self.slots[self.index]
+        numel = int(np.prod(size))
+        buffer = slot.get(name)
+        if buffer is None or buffer.dtype != dtype or buffer.numel() < numel:
+            buffer = torch.empty(int(numel * self.growth) + 1, dtype=dtype).share_memory_()
+            slot[name] = buffer
+        return buffer[:numel].view(size)
+
+    def __getstate__(self):
+        # every worker gets an empty ring, buffers are allocated in the worker
+        return {'num_slots': self.num_slots, 'growth': self.growth}
+
+    def __setstate__(self, state):
+        self.__init__(state['num_slots'], state['growth'])
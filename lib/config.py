@@ -17,6 +17,9 @@ CONF.PATH.UTILS = os.path.join(CONF.PATH.BASE, "utils")
 CONF.PATH.SCANNET_SCANS = os.path.join(CONF.PATH.SCANNET, "scans")  # 源数据
 CONF.PATH.SCANNET_META = os.path.join(CONF.PATH.SCANNET, "meta_data")  # meta_data，包含labels.combined.tsv文件
 CONF.PATH.SCANNET_DATA = os.path.join(CONF.PATH.SCANNET, "scannet_data")  # 预处理后的所有数据
+CONF.PATH.SCANNET_PACKED = os.path.join(CONF.PATH.SCANNET, "scannet_packed")  # 每个场景打包成一个文件 (lib/scene_pack.py)
+CONF.PATH.SCANNET_SHARD = os.path.join(CONF.PATH.SCANNET, "scannet_shard.pack")  # 所有场景合并成一个文件 (lib/scene_pack.py)
+CONF.PATH.VOXEL_CACHE = os.path.join(CONF.PATH.SCANNET, "voxel_cache")  # val/test的voxelization缓存 (lib/voxel_cache.py)
 
 # no used
 CONF.MULTIVIEW = os.path.join(CONF.PATH.SCANNET_DATA, "enet_feats_maxpool.hdf5")
@@ -0,0 +1,109 @@
+'''
+Crop of large scenes to the point budget of ScannetReferenceDataset (voxel_cfg.max_npoint).
+
+The original crop shrinks the x / y size of the window by 32 voxels at a time and tests all
+points against every window. Here the points are binned once into a 2D summed-area table over
+x / y, which gives lower and upper bounds of the number of points in a window in O(1). The
+window sequence (and the random offsets drawn for it) is the same as before; the points are
+only tested exactly when the bounds cannot decide whether the budget is met, and once for the
+mask of the final window, so the result is identical to crop_loop.
+'''
+
+import numpy as np
+
+DEFAULT_CELL_SIZE = 2.  # in scaled (voxel) units
+
+
+def _in_window(xyz_offset, window):
+    return ((xyz_offset >= 0) & (xyz_offset < window)).all(1)
+
+
+class PointHistogram(object):
+    """ summed-area table of the x / y point counts of a scene, built once and reused by every crop try """
+
+    def __init__(self, xyz, cell_size=DEFAULT_CELL_SIZE):
+        self.cell_size = cell_size
+        self.xyz_min = xyz.min(0)
+        self.xyz_max = xyz.max(0)
+        self.origin = self.xyz_min[:2]
+
+        # truncation is floor for the non-negative cell coordinates
+        cells = ((xyz[:, :2] - self.origin) * (1. / cell_size)).astype(np.int64)
+        self.shape = cells.max(0) + 1
+        hist = np.bincount(cells[:, 0] * self.shape[1] + cells[:, 1], minlength=int(np.prod(self.shape)))
+        self.sat = np.zeros(self.shape + 1, dtype=np.int64)
+        self.sat[1:, 1:] = hist.reshape(self.shape).cumsum(0).cumsum(1)
+
+    def _count(self, lo, hi):
+        """ number of points in the cells [lo, hi) """
+        lo = np.clip(lo, 0, self.shape)
+        hi = np.clip(hi, 0, self.shape)
+        if (hi <= lo).any():
+            return 0
+        return int(self.sat[hi[0], hi[1]] - self.sat[lo[0], hi[1]] - self.sat[hi[0], lo[1]] + self.sat[lo[0], lo[1]])
+
+    def count_bounds(self, offset, window):
+        """ (lower, upper) bound of the number of points with 0 <= xyz + offset < window
+
+        Cells are taken with a margin of one cell so that float rounding at the cell borders
+        cannot break the bounds. The lower bound is only used when the window spans all z.
+        """
+        lower = np.floor((-offset[:2] - self.origin) / self.cell_size).astype(np.int64)
+        upper = np.floor((window[:2] - offset[:2] - self.origin) / self.cell_size).astype(np.int64)
+        num_upper = self._count(lower - 1, upper + 2)
+        num_lower = 0
+        if self.xyz_min[2] + offset[2] >= 0 and self.xyz_max[2] + offset[2] < window[2]:
+            num_lower = self._count(lower + 2, upper - 1)
+        return num_lower, num_upper
+
+
+def crop(xyz, spatial_shape, max_npoint, step=32, histogram=None):
+    """ same result as crop_loop, histogram: PointHistogram of xyz (built here if None and needed) """
+    if xyz.shape[0] <= max_npoint:
+        valid_idxs = xyz.min(1) >= 0
+        assert valid_idxs.sum() == xyz.shape[0]
+        return xyz.copy(), valid_idxs
+    if histogram is None:
+        histogram = PointHistogram(xyz)
+    assert histogram.xyz_min.min() >= 0
+
+    spatial_shape = np.array([spatial_shape] * 3)
+    room_range = histogram.xyz_max - histogram.xyz_min
+    offset, window = np.zeros(3), None
+    num_lower = num_upper = xyz.shape[0]
+    while num_upper > max_npoint:
+        if num_lower <= max_npoint or num_lower <= 1e6 < num_upper:
+            # the bounds do not decide the loop condition or the step size, count exactly
+            valid_idxs = _in_window(xyz + offset, window)
+            num_lower = num_upper = valid_idxs.sum()
+            if num_upper <= max_npoint:
+                break
+        step_temp = step * 2 if num_lower > 1e6 else step
+        offset = np.clip(spatial_shape - room_range + 0.001, None, 0) * np.random.rand(3)
+        window = spatial_shape.copy()
+        num_lower, num_upper = histogram.count_bounds(offset, window)
+        valid_idxs = None
+        spatial_shape[:2] -= step_temp
+
+    xyz_offset = xyz + offset
+    if valid_idxs is None:
+        valid_idxs = _in_window(xyz_offset, window)
+    return xyz_offset, valid_idxs
+
+
+# 原来的实现，每次缩小窗口都对所有点重新判断，用于对比和benchmark (scripts/benchmark_dataset.py)
+def crop_loop(xyz, spatial_shape, max_npoint, step=32):
+    xyz_offset = xyz.copy()
+    valid_idxs = xyz_offset.min(1) >= 0
+    assert valid_idxs.sum() == xyz.shape[0]
+    spatial_shape = np.array([spatial_shape] * 3)
+    room_range = xyz.max(0) - xyz.min(0)
+    while (valid_idxs.sum() > max_npoint):
+        step_temp = step
+        if valid_idxs.sum() > 1e6:
+            step_temp = step * 2
+        offset = np.clip(spatial_shape - room_range + 0.001, None, 0) * np.random.rand(3)
+        xyz_offset = xyz + offset
+        valid_idxs = (xyz_offset.min(1) >= 0) * ((xyz_offset < spatial_shape).sum(1) == 3)
+        spatial_shape[:2] -= step_temp
+    return xyz_offset, valid_idxs
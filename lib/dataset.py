@@ -12,20 +12,28 @@ import pickle
 import numpy as np
 import multiprocessing as mp
 import torch
-import scipy.interpolate
-import scipy.ndimage
 import math
 
 from itertools import chain
 from collections import Counter
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, get_worker_info
 from ops import voxelization_idx
 
 sys.path.append(os.path.join(os.getcwd(), "lib"))  # HACK add the lib folder
 from lib.config import CONF
-from utils.pc_utils import random_sampling, rotx, roty, rotz
+from utils.pc_utils import random_sampling, voxel_sampling, rotx, roty, rotz
 from utils.box_util import get_3d_box, get_3d_box_batch
 from data.scannet.model_util_scannet import rotate_aligned_boxes, ScannetDatasetConfig, rotate_aligned_boxes_along_axis
+from lib.scene_pack import load_packed_scene, SceneShard, decode_vertices
+from lib.voxel_cache import VoxelizationCache, merge_voxelizations
+from lib.scene_cache import SceneCache, DEFAULT_CACHE_BYTES
+from lib.shared_scenes import SharedSceneStore
+from lib.batch import Batch, BatchBufferRing, min_ring_size
+from lib.stage_timer import StageTimer
+from lib.glove import load_glove
+from lib.elastic import elastic, elastic_batch, NoisePool
+from lib.augment import random_affine
+from lib.crop import crop, PointHistogram
 
 from copy import deepcopy
 
@@ -55,11 +63,29 @@ semantic_map = {
     32: 19, 35: 19, 37: 19, 38: 19, 39: 19, 40: 19  # other furniture
 
 }
+# semantic_map as a lookup table, SEMANTIC_MAP_LUT[nyu40id] == semantic_map[nyu40id]
+SEMANTIC_MAP_LUT = np.zeros(max(semantic_map.keys()) + 1, dtype=np.int16)
+for nyu40id, semantic_class in semantic_map.items():
+    SEMANTIC_MAP_LUT[nyu40id] = semantic_class
 # data setting
 DC = ScannetDatasetConfig()
 MAX_NUM_OBJ = 128
 MEAN_COLOR_RGB = np.array([109.8, 97.2, 83.8])
 
+# 模型每个阶段用到的collate_fn输出（fields选项，见ScannetReferenceDataset），其他的既不计算也不返回
+# train: CapNet.training_step，val: CapNet.validation_step，predict: CapNet.predict_step
+# 修改模型后用scripts/check_stage_fields.py检查（静态分析模型读取的batch key）
+SOFTGROUP_FIELDS = ("batch_idxs", "voxel_coords", "p2v_map", "v2p_map", "coords_float", "feats", "semantic_labels",
+                    "instance_labels", "pt_offset_labels", "spatial_shape", "batch_size")
+STAGE_FIELDS = {
+    "train": frozenset(SOFTGROUP_FIELDS + ("object_id", "target_batch_idxs", "ref_center_label", "ref_size_label",
+                                           "lang_feat", "lang_len", "lang_ids", "aug_matrices", "aug_mask",
+                                           "aug_coords", "stage_times", "scene_cache")),
+    "val": frozenset(SOFTGROUP_FIELDS + ("object_id", "scan_ids", "center_label", "scene_object_ids",
+                                         "gt_box_corner_label", "lang_feat", "lang_len", "lang_ids")),
+    "predict": frozenset(SOFTGROUP_FIELDS + ("scan_ids",)),
+}
+
 # data path
 SCANNET_V2_TSV = os.path.join(CONF.PATH.SCANNET_META, "scannetv2-labels.combined.tsv")
 # SCANREFER_VOCAB = os.path.join(CONF.PATH.DATA, "ScanRefer_vocabulary.json")
@@ -121,6 +147,60 @@ def get_scanrefer(model=None):
     return new_scanrefer_train, new_scanrefer_eval_train, new_scanrefer_eval_val, all_scene_list
 
 
+# 原来逐个instance做np.where的实现，O(instance数 x 点数)，用于对比和benchmark (scripts/benchmark_dataset.py)
+def get_instance_info_loop(xyz, instance_label, semantic_label):
+    pt_mean = np.ones((xyz.shape[0], 3), dtype=np.float32) * -100.0
+    instance_pointnum = []
+    instance_cls = []
+    # max(instance_num, 0) to support instance_label with no valid instance_id
+    instance_num = max(int(instance_label.max()) + 1, 0)
+    for i_ in range(instance_num):
+        inst_idx_i = np.where(instance_label == i_)
+        if inst_idx_i[0].size == 0:  # 因为在前处理时，有些instance比如ceiling已经被删除了，所以可能会有空余的instance_label
+            instance_pointnum.append(inst_idx_i[0].size)
+            instance_cls.append(-100)
+            continue
+        xyz_i = xyz[inst_idx_i]  # 对应instance_id为i的所有点坐标
+        pt_mean[inst_idx_i] = xyz_i.mean(0)  # 这个instance的所有点的mean
+        instance_pointnum.append(inst_idx_i[0].size)
+        cls_idx = inst_idx_i[0][0]
+        instance_cls.append(semantic_label[cls_idx])
+    pt_offset_label = pt_mean - xyz
+    return instance_num, instance_pointnum, instance_cls, pt_offset_label
+
+
+# 与get_instance_info_loop结果完全相同：点数用bincount，class取每个instance的第一个点，
+# 按instance稳定排序后每个instance是一段连续的点，均值在这一段上计算（与xyz[np.where(...)]是同样的数组，
+# 所以np.mean的结果逐位相同，用bincount加权求和会有舍入差异），最后按instance_label gather得到每个点的均值
+def get_instance_info(xyz, instance_label, semantic_label):
+    # max(instance_num, 0) to support instance_label with no valid instance_id
+    instance_num = max(int(instance_label.max()) + 1, 0)
+    valid = instance_label >= 0
+    valid_idxs = np.nonzero(valid)[0]
+    valid_labels = instance_label[valid_idxs]
+    instance_pointnum = np.bincount(valid_labels, minlength=instance_num)
+
+    # 同一instance内保持原来的点顺序，instance数量小于int16范围时stable argsort用的是radix sort
+    sort_labels = valid_labels.astype(np.int16) if instance_num <= np.iinfo(np.int16).max else valid_labels
+    order = valid_idxs[np.argsort(sort_labels, kind="stable")]
+    starts = np.cumsum(instance_pointnum) - instance_pointnum
+    nonempty = np.nonzero(instance_pointnum)[0]
+
+    # 因为在前处理时，有些instance比如ceiling已经被删除了，所以可能会有空余的instance_label
+    instance_cls = np.full(instance_num, -100, dtype=np.int64)
+    instance_cls[nonempty] = semantic_label[order[starts[nonempty]]]
+
+    # 最后一行-100给不属于任何instance的点
+    xyz_sorted = np.take(xyz, order, axis=0)
+    instance_mean = np.full((instance_num + 1, 3), -100.0, dtype=np.float32)
+    for i_ in nonempty:
+        instance_mean[i_] = xyz_sorted[starts[i_]:starts[i_] + instance_pointnum[i_]].mean(0)
+
+    pt_mean = np.take(instance_mean, np.where(valid, instance_label, instance_num), axis=0)
+    pt_offset_label = pt_mean - xyz
+    return instance_num, instance_pointnum.tolist(), instance_cls.tolist(), pt_offset_label
+
+
 class ReferenceDataset(Dataset):
     def __init__(self):
         pass
@@ -212,6 +292,7 @@ class ReferenceDataset(Dataset):
     # 返回两个字典lang和lang_ids
     # lang[scene_id][object_id][ann_id]存储每个句子embedding后的词向量
     # lang_ids[scene_id][object_id][ann_id]存储每个句子中单词对应idx的列表
+    # lang_ids_only时lang中都为None，不分配词向量矩阵也不查GloVe向量，由CaptionModule.word_embedding根据lang_ids查表
     def _tranform_des(self):
         lang = {}
         label = {}
@@ -238,20 +319,28 @@ class ReferenceDataset(Dataset):
 
             # tokenize the description
             tokens = ["sos"] + tokens + ["eos"]
-            embeddings = np.zeros((CONF.TRAIN.MAX_DES_LEN + 2, 300))  # word embedding后该句子中每个单词的词向量
             labels = np.zeros((CONF.TRAIN.MAX_DES_LEN + 2))  # start and end，句子中每个单词对应的idx的列表
+            word2idx = self.vocabulary["word2idx"]
 
             # load
             # 若长度未到MAX+2，则embeddings和labels中剩余为0
             # 在word2idx中，pad_对应的idx为0
-            for token_id in range(len(tokens)):
-                token = tokens[token_id]
-                try:
-                    embeddings[token_id] = self.glove[token]
-                    labels[token_id] = self.vocabulary["word2idx"][token]
-                except KeyError:
-                    embeddings[token_id] = self.glove["unk"]
-                    labels[token_id] = self.vocabulary["word2idx"]["unk"]
+            if self.lang_ids_only:
+                # 和下面相同：不在GloVe或不在词表中的单词都为unk
+                for token_id, token in enumerate(tokens):
+                    known = token in self.glove and token in word2idx
+                    labels[token_id] = word2idx[token] if known else word2idx["unk"]
+                embeddings = None
+            else:
+                embeddings = np.zeros((CONF.TRAIN.MAX_DES_LEN + 2, 300))  # word embedding后该句子中每个单词的词向量
+                for token_id in range(len(tokens)):
+                    token = tokens[token_id]
+                    try:
+                        embeddings[token_id] = self.glove[token]
+                        labels[token_id] = word2idx[token]
+                    except KeyError:
+                        embeddings[token_id] = self.glove["unk"]
+                        labels[token_id] = word2idx["unk"]
 
             # store
             lang[scene_id][object_id][ann_id] = embeddings
@@ -328,8 +417,13 @@ class ReferenceDataset(Dataset):
     def _load_data(self, dataset_name):
         print("loading data...")
         # load language features
-        self.glove = pickle.load(open(GLOVE_PICKLE, "rb"))
-        self._build_vocabulary(dataset_name)  # 存储了word2index和index2word
+        if os.path.exists(VOCAB.format(dataset_name)):
+            self._build_vocabulary(dataset_name)  # 存储了word2index和index2word
+            self.glove = load_glove(self.vocabulary, dataset_name)  # 只含词表中单词的memory map (lib/glove.py)
+        else:
+            # 构建词表需要完整的GloVe字典
+            self.glove = pickle.load(open(GLOVE_PICKLE, "rb"))
+            self._build_vocabulary(dataset_name)
         self.num_vocabs = len(self.vocabulary["word2idx"].keys())  # 共有多少种words
         self.lang, self.lang_ids = self._tranform_des()  # 表示caption的两个字典，详细见上def备注
         self._build_frequency(dataset_name)
@@ -337,20 +431,13 @@ class ReferenceDataset(Dataset):
         # add scannet data
         self.scene_list = sorted(list(set([data["scene_id"] for data in self.scanrefer])))
 
-        # load scene data 从预处理文件中读取所有的numpy数组信息并存储在字典里
+        # load scene data 从预处理文件中读取所有场景，预处理（_prepare_scene）后存储在字典里，原始数组不保留
+        # lazy模式下不预先读取，由_get_scene在第一次访问时以memory map打开并放入LRU cache
+        # shared_memory模式下由__init__逐个读取并预处理后写入共享内存（SharedSceneStore.create），这里也不预先读取
         self.scene_data = {}
-        for scene_id in self.scene_list:
-            self.scene_data[scene_id] = {}
-            # self.scene_data[scene_id]["mesh_vertices"] = np.load(os.path.join(CONF.PATH.SCANNET_DATA, scene_id)+"_vert.npy")
-            self.scene_data[scene_id]["mesh_vertices"] = np.load(
-                os.path.join(CONF.PATH.SCANNET_DATA, scene_id) + "_aligned_vert.npy")  # axis-aligned
-            self.scene_data[scene_id]["instance_labels"] = np.load(
-                os.path.join(CONF.PATH.SCANNET_DATA, scene_id) + "_ins_label.npy")
-            self.scene_data[scene_id]["semantic_labels"] = np.load(
-                os.path.join(CONF.PATH.SCANNET_DATA, scene_id) + "_sem_label.npy")
-            # self.scene_data[scene_id]["instance_bboxes"] = np.load(os.path.join(CONF.PATH.SCANNET_DATA, scene_id)+"_bbox.npy")
-            self.scene_data[scene_id]["instance_bboxes"] = np.load(
-                os.path.join(CONF.PATH.SCANNET_DATA, scene_id) + "_aligned_bbox.npy")
+        if not self.lazy and not self.shared_memory:
+            for scene_id in self.scene_list:
+                self.scene_data[scene_id] = self._load_prepared_scene(scene_id)
 
         # prepare class mapping
         lines = [line.rstrip() for line in open(SCANNET_V2_TSV)]
@@ -367,6 +454,157 @@ class ReferenceDataset(Dataset):
         self.raw2label = self._get_raw2label()
         self.unique_multiple_lookup = self._get_unique_multiple_lookup()
 
+    # 读取一个场景的点云、label和bbox
+    # scene_format为"npy"时从CONF.PATH.SCANNET_DATA中的4个.npy文件读取
+    # 为"packed"时从CONF.PATH.SCANNET_PACKED中的单个.pack文件读取 (lib/scene_pack.py)，返回只读的memory map
+    # 为"shard"时所有场景共用CONF.PATH.SCANNET_SHARD的一个memory map，每个场景只是其中的切片
+    # packed/shard为compact profile时保持量化后的数组（mesh_xyz, mesh_rgb, mesh_origin），由_get_scene解码
+    def _load_scene(self, scene_id):
+        scene_format = self.scene_format
+        mmap_mode = "r" if self.lazy else None
+        if scene_format in ("packed", "shard"):
+            if scene_format == "packed":
+                arrays = load_packed_scene(scene_id)
+            else:
+                if self.shard is None:
+                    self.shard = SceneShard(CONF.PATH.SCANNET_SHARD)
+                arrays = self.shard.get_scene(scene_id)
+            scene = {
+                "instance_labels": arrays["ins_label"],
+                "semantic_labels": arrays["sem_label"],
+                "instance_bboxes": arrays["aligned_bbox"],
+            }
+            if "aligned_vert_xyz" in arrays:
+                scene["mesh_xyz"] = arrays["aligned_vert_xyz"]  # int16, 相对mesh_origin的毫米坐标
+                scene["mesh_rgb"] = arrays["aligned_vert_rgb"]  # uint8
+                scene["mesh_origin"] = arrays["aligned_vert_origin"]
+            else:
+                scene["mesh_vertices"] = arrays["aligned_vert"]  # axis-aligned
+            return scene
+        elif scene_format == "npy":
+            scene = {}
+            # scene["mesh_vertices"] = np.load(os.path.join(CONF.PATH.SCANNET_DATA, scene_id)+"_vert.npy")
+            scene["mesh_vertices"] = np.load(
+                os.path.join(CONF.PATH.SCANNET_DATA, scene_id) + "_aligned_vert.npy", mmap_mode=mmap_mode)  # axis-aligned
+            scene["instance_labels"] = np.load(
+                os.path.join(CONF.PATH.SCANNET_DATA, scene_id) + "_ins_label.npy", mmap_mode=mmap_mode)
+            scene["semantic_labels"] = np.load(
+                os.path.join(CONF.PATH.SCANNET_DATA, scene_id) + "_sem_label.npy", mmap_mode=mmap_mode)
+            # scene["instance_bboxes"] = np.load(os.path.join(CONF.PATH.SCANNET_DATA, scene_id)+"_bbox.npy")
+            scene["instance_bboxes"] = np.load(
+                os.path.join(CONF.PATH.SCANNET_DATA, scene_id) + "_aligned_bbox.npy", mmap_mode=mmap_mode)
+            return scene
+        else:
+            raise ValueError("unknown scene_format: {}".format(scene_format))
+
+    # 返回_prepare_scene预处理后的场景数据：_load_data预先处理好的self.scene_data，lazy模式下存放在self.scene_cache这个LRU cache中
+    # shared_memory模式下直接返回共享内存中的只读数组（所有worker共用）
+    def _get_scene(self, scene_id):
+        if self.scene_store is not None:
+            return self.scene_store.get(scene_id)
+        if not self.lazy:
+            return self.scene_data[scene_id]
+        return self.scene_cache.get(scene_id, lambda: self._load_prepared_scene(scene_id))
+
+    # 读取并预处理一个场景（lazy模式下为memory map）
+    def _load_prepared_scene(self, scene_id):
+        return self._prepare_scene(self._decode_scene(self._load_scene(scene_id)))
+
+    # compact profile的场景在这里解码成float32的mesh_vertices
+    @staticmethod
+    def _decode_scene(scene):
+        if "mesh_vertices" not in scene:
+            scene = dict(scene)
+            scene["mesh_vertices"] = decode_vertices(scene["mesh_xyz"], scene["mesh_rgb"], scene["mesh_origin"])
+            del scene["mesh_xyz"], scene["mesh_rgb"], scene["mesh_origin"]
+        return scene
+
+    # 与采样、augmentation和ref object无关的处理每个场景只做一次：
+    # label映射、点云中心化和color正则化、场景内所有bbox的label和corners
+    # 返回的数组都是新分配的（不会改动原始数组），并设为只读，__getitem__不能in-place修改
+    def _prepare_scene(self, scene):
+        prepared = {}
+
+        # 从nyu40id（1-40,0表示未分类）映射到语义分割时的class（0-19）, ceiling和未分配点变为-100
+        semantic_labels_nyu40id = np.array(scene["semantic_labels"])  # 保存原始的nyu40id
+        prepared["semantic_labels_nyu40id"] = semantic_labels_nyu40id
+        prepared["semantic_labels"] = SEMANTIC_MAP_LUT[semantic_labels_nyu40id]  # int16
+
+        # map instance label
+        instance_labels = scene["instance_labels"].astype(np.int64) - 1
+        instance_labels[instance_labels == -1] = -100
+        prepared["instance_labels"] = instance_labels.astype(np.int32)
+
+        point_cloud = np.array(scene["mesh_vertices"][:, 0:6])
+        # 对坐标数据预处理,让其中心为(0,0,0),目的是为了后面的transform的scale放大操作
+        # 对instance_bbox也中心化
+        # 获取color数据, 对color正则化，rgb范围为[-1,1]
+        point_cloud[:, 0:3] = np.ascontiguousarray(point_cloud[:, 0:3] - point_cloud[:, 0:3].mean(0))
+        point_cloud[:, 3:6] = (point_cloud[:, 3:6] - MEAN_COLOR_RGB) / 256.0
+        prepared["point_cloud"] = point_cloud
+        instance_bboxes = np.array(scene["instance_bboxes"])  # nparray float64
+        instance_bboxes[:, 0:3] = instance_bboxes[:, 0:3] - point_cloud[:, 0:3].mean(0)
+        prepared["instance_bboxes"] = instance_bboxes
+
+        # ------------------------------- LABELS ------------------------------
+        target_bboxes = np.zeros((MAX_NUM_OBJ, 6))  # 场景内所有bbox的坐标+尺寸
+        target_bboxes_mask = np.zeros((MAX_NUM_OBJ))  # 场景内的所有bbox的mask
+        size_classes = np.zeros((MAX_NUM_OBJ,))
+        size_residuals = np.zeros((MAX_NUM_OBJ, 3))
+
+        num_bbox = instance_bboxes.shape[0] if instance_bboxes.shape[0] < MAX_NUM_OBJ else MAX_NUM_OBJ
+        target_bboxes_mask[0:num_bbox] = 1
+        target_bboxes[0:num_bbox, :] = instance_bboxes[:MAX_NUM_OBJ, 0:6]
+
+        # NOTE: set size class as semantic class. Consider use size2class.
+        # 将instance_bbox的nyu40id映射到semantic class（0-19）
+        class_ind = SEMANTIC_MAP_LUT[instance_bboxes[:num_bbox, -2].astype(np.int64)].astype(np.int64)
+        size_classes[0:num_bbox] = class_ind
+        size_residuals[0:num_bbox, :] = target_bboxes[0:num_bbox, 3:6] - DC.mean_size_arr[class_ind - 2,
+                                                                         :]  # 和这个类平均尺寸的偏差
+        # 上面不会出错，虽然semantic_map会将ceiling映射到-100,但预处理中已经去除了instance_bbox中属于这类的bbox
+        # 所以DC.mean_size_arr不会出现indexError，减2是因为不考虑wall和floor这两类
+
+        # construct all GT bbox corners
+        all_obb = DC.param2obb_batch(target_bboxes[:num_bbox, 0:3], size_classes[:num_bbox].astype(np.int64),
+                                     size_residuals[:num_bbox])
+        all_box_corner_label = get_3d_box_batch(all_obb[:, 3:6], np.zeros(num_bbox), all_obb[:, 0:3])
+
+        # store
+        gt_box_corner_label = np.zeros((MAX_NUM_OBJ, 8, 3))
+        gt_box_masks = np.zeros((MAX_NUM_OBJ,))
+        gt_box_object_ids = np.zeros((MAX_NUM_OBJ,))
+
+        gt_box_corner_label[:num_bbox] = all_box_corner_label
+        gt_box_masks[:num_bbox] = 1
+        gt_box_object_ids[:num_bbox] = instance_bboxes[:, -1]
+
+        target_bboxes_semcls = np.zeros((MAX_NUM_OBJ))
+        target_object_ids = np.zeros((MAX_NUM_OBJ,))  # object ids of all objects
+        target_bboxes_semcls[0:num_bbox] = SEMANTIC_MAP_LUT[instance_bboxes[:, -2][0:num_bbox].astype(np.int64)]
+        target_object_ids[0:num_bbox] = instance_bboxes[:, -1][0:num_bbox]
+
+        prepared.update({
+            "num_bbox": num_bbox,  # 场景内bbox数量
+            "target_bboxes": target_bboxes,
+            "target_bboxes_mask": target_bboxes_mask,
+            "size_classes": size_classes,
+            "size_residuals": size_residuals,
+            "gt_box_corner_label": gt_box_corner_label,
+            "gt_box_masks": gt_box_masks,
+            "gt_box_object_ids": gt_box_object_ids,
+            "target_bboxes_semcls": target_bboxes_semcls,
+            "target_object_ids": target_object_ids,
+        })
+        for value in prepared.values():
+            if isinstance(value, np.ndarray):
+                value.setflags(write=False)
+        return prepared
+
+    # 预处理后场景的LRU cache的命中/未命中/淘汰次数
+    def get_scene_cache_stats(self):
+        return self.scene_cache.stats()
+
     # 对整体点云和bounding box进行平移
     def _translate(self, point_set, bbox):
         # unpack
@@ -392,7 +630,26 @@ class ScannetReferenceDataset(ReferenceDataset):
                  split="train",
                  num_points=40000,
                  augment=False,
-                 voxel_cfg=CONF.voxel_cfg):
+                 voxel_cfg=CONF.voxel_cfg,
+                 scene_format="npy",
+                 cache_voxelization=False,
+                 voxel_cache_dir=CONF.PATH.VOXEL_CACHE,
+                 lazy=False,
+                 cache_bytes=DEFAULT_CACHE_BYTES,
+                 lang_ids_only=False,
+                 elastic_pool_size=0,
+                 batch_elastic=False,
+                 sampling="random",
+                 sampling_voxel_size=0.05,
+                 targets_per_scene=0,
+                 shared_memory=False,
+                 scene_store=None,
+                 pin_memory=False,
+                 batch_augment=False,
+                 batch_ring_size=0,
+                 prefetch_factor=2,
+                 fields=None,
+                 validate_fields=False):
 
         # NOTE only feed the scan2cad_rotation when on the training mode and train split
 
@@ -402,36 +659,122 @@ class ScannetReferenceDataset(ReferenceDataset):
         self.num_points = num_points
         self.augment = augment
         self.voxel_cfg = voxel_cfg
+        self.scene_format = scene_format  # "npy", "packed" or "shard"
+        # lazy=False时_load_data读取并预处理所有场景，self.scene_data中只保留预处理后的场景
+        # lazy=True时场景在第一次访问时才读取，预处理后的场景放在最多cache_bytes字节的LRU cache中 (lib/scene_cache.py)
+        self.lazy = lazy
+        self.scene_cache = SceneCache(cache_bytes if lazy else 0)
+        self.shard = None  # scene_format="shard"时所有场景共用的memory map，第一次读取时打开
+        # lang_ids_only=True时只保存单词idx（lang_ids），不保存(MAX_DES_LEN + 2, 300)的GloVe矩阵，batch中没有lang_feat
+        self.lang_ids_only = lang_ids_only
+        # elastic_pool_size > 0时elastic从预先生成的噪声场中随机截取窗口，不再每次生成并模糊新的噪声 (lib/elastic.py)
+        self.noise_pool = NoisePool(elastic_pool_size) if elastic_pool_size > 0 else None
+        # batch_augment=True时transform_train不做dataAugment和elastic，collate_fn只生成每个sample的仿射变换矩阵（由__getitem__中
+        # 抽取的aug_seed决定）并跳过voxelization，batch移到device后由lib/augment.py的augment_batch一起做（在crop之后）；
+        # crop会裁掉点的场景（点数超过max_npoint）仍在transform_train中做
+        self.batch_augment = batch_augment
+        # batch_elastic=True时transform_train不做elastic，在collate_fn中对整个batch用torch一起做（在crop之后），batch_augment时不需要
+        self.batch_elastic = batch_elastic and not batch_augment
+        # train时选取num_points个点的方式：random为均匀随机，voxel/fps为每个sampling_voxel_size（米）的voxel保留一个点
+        # （见utils/pc_utils.py的voxel_sampling），密集区域不再占用大部分点，同样的instance覆盖率下可以用更少的点
+        if sampling not in ("random", "voxel", "fps"):
+            raise ValueError("unknown sampling {}, expected 'random', 'voxel' or 'fps'".format(sampling))
+        self.sampling = sampling
+        self.sampling_voxel_size = sampling_voxel_size
+        # shared_memory=True时主进程预处理所有场景并放入一块共享内存 (lib/shared_scenes.py)，
+        # DataLoader的worker直接读取，不再各自持有一份场景数据；用完后调用close释放
+        # scene_store为另一个dataset（同样的场景，例如同一split的val和test）已创建的共享内存，直接共用，由创建它的dataset释放
+        self.shared_memory = shared_memory or scene_store is not None
+        # collate_fn的输出在一次分配的buffer中，返回Batch (lib/batch.py)；pin_memory=True时buffer为pinned memory
+        self.pin_memory = pin_memory
+        # batch_ring_size > 0时DataLoader worker中collate_fn的输出写入可重复使用的共享内存buffer (lib/batch.py)，
+        # 进程间只传递handle；训练进程必须在batch_ring_size个batch之内用完一个batch，
+        # 因此不用pin_memory时至少为min_ring_size(prefetch_factor)（默认prefetch_factor=2时为5），
+        # prefetch_factor要和DataLoader的一致；pin_memory=True时pin线程会立即把batch复制出来
+        if 0 < batch_ring_size < min_ring_size(prefetch_factor) and not pin_memory:
+            raise ValueError("batch_ring_size {} is too small for prefetch_factor {} without pin_memory, "
+                             "expected at least {}".format(batch_ring_size, prefetch_factor,
+                                                          min_ring_size(prefetch_factor)))
+        self.batch_ring = BatchBufferRing(batch_ring_size) if batch_ring_size > 0 else None
+        # __getitem__和collate_fn各阶段的耗时 (lib/stage_timer.py)，随batch返回
+        self.stage_timer = StageTimer()
+        # fields为STAGE_FIELDS中的阶段名或batch key的集合，只计算并返回这些key，None时返回所有key；
+        # validate_fields=True时仍计算并返回所有key，未声明的记在Batch.undeclared中，模型读取时给出warning (lib/batch.py)
+        if isinstance(fields, str):
+            if fields not in STAGE_FIELDS:
+                raise ValueError("unknown fields {}, expected one of {} or a set of keys".format(fields, sorted(STAGE_FIELDS)))
+            fields = STAGE_FIELDS[fields]
+        self.fields = frozenset(fields) if fields is not None else None
+        self.validate_fields = validate_fields
+
+        # 只有确定性的split（无augment，不随机采样）每个epoch的voxelization结果才相同，可以缓存 (lib/voxel_cache.py)
+        self.voxel_cache = None
+        if cache_voxelization:
+            if augment or split == 'train':
+                raise ValueError("voxelization cache needs a deterministic split (augment=False, split != 'train')")
+            self.voxel_cache = VoxelizationCache(voxel_cfg, voxel_cache_dir)
 
         # load data
+        self.scene_store = None
+        self.owns_scene_store = False
         self._load_data('Scanrefer')
+        if scene_store is not None:
+            missing = [scene_id for scene_id in self.scene_list if scene_id not in scene_store]
+            if len(missing) > 0:
+                raise ValueError("scene_store has no {} of the {} scenes, e.g. {}".format(
+                    len(missing), len(self.scene_list), missing[0]))
+            self.scene_store = scene_store
+        elif shared_memory:
+            self.scene_store = SharedSceneStore.create(self.scene_list, self._load_prepared_scene)
+            self.owns_scene_store = True
+
+        # targets_per_scene > 0时为scene模式：每个sample是一个场景和最多targets_per_scene个描述目标，
+        # backbone每个场景只需跑一次，collate_fn把所有目标展平，target_batch_idxs表示每个目标属于batch中的哪个场景
+        # 每个epoch由set_epoch重新分组
+        self.targets_per_scene = targets_per_scene
+        self.epoch = 0
+        self.scene_chunks = self._get_scene_chunks(targets_per_scene) if targets_per_scene > 0 else None
+
+    def close(self):
+        """ 不再引用共享内存中的场景（所有进程都不再引用时由torch释放），共用的scene_store只是不再使用 """
+        if self.scene_store is not None and self.owns_scene_store:
+            self.scene_store.close()
+        self.scene_store = None
 
     def __len__(self):
+        if self.targets_per_scene > 0:
+            return len(self.scene_chunks)
         return len(self.scanrefer)
 
+    def set_epoch(self, epoch):
+        """ scene模式下重新随机分组（和补足的描述），在DataLoader创建这个epoch的worker之前调用（见lib/sampler.py的EpochRandomSampler）
+
+        场景的顺序和每个场景的组数不变，所以__len__和每个sample的scene_id不变
+        """
+        if epoch != self.epoch and self.targets_per_scene > 0:
+            self.scene_chunks = self._get_scene_chunks(self.targets_per_scene)
+        self.epoch = epoch
+
+    def _get_scene_chunks(self, targets_per_scene):
+        """ 把每个场景的描述随机分成targets_per_scene个一组，返回[(scene_id, [scanrefer idx, ...]), ...]
+
+        每个描述在一个epoch中至少出现一次，最后一组不足时用该场景的其他描述补足
+        """
+        scene_targets = {}
+        for idx, data in enumerate(self.scanrefer):
+            scene_targets.setdefault(data["scene_id"], []).append(idx)
+        scene_chunks = []
+        for scene_id, target_idxs in scene_targets.items():
+            target_idxs = list(np.random.permutation(target_idxs))
+            num_pad = -len(target_idxs) % targets_per_scene
+            if len(target_idxs) > targets_per_scene and num_pad > 0:
+                target_idxs += target_idxs[:num_pad]
+            for i in range(0, len(target_idxs), targets_per_scene):
+                scene_chunks.append((scene_id, [int(idx) for idx in target_idxs[i:i + targets_per_scene]]))
+        return scene_chunks
+
     def elastic(self, x, gran, mag):
-        blur0 = np.ones((3, 1, 1)).astype('float32') / 3
-        blur1 = np.ones((1, 3, 1)).astype('float32') / 3
-        blur2 = np.ones((1, 1, 3)).astype('float32') / 3
-
-        bb = np.abs(x).max(0).astype(np.int32) // gran + 3
-        noise = [np.random.randn(bb[0], bb[1], bb[2]).astype('float32') for _ in range(3)]
-        noise = [scipy.ndimage.filters.convolve(n, blur0, mode='constant', cval=0) for n in noise]
-        noise = [scipy.ndimage.filters.convolve(n, blur1, mode='constant', cval=0) for n in noise]
-        noise = [scipy.ndimage.filters.convolve(n, blur2, mode='constant', cval=0) for n in noise]
-        noise = [scipy.ndimage.filters.convolve(n, blur0, mode='constant', cval=0) for n in noise]
-        noise = [scipy.ndimage.filters.convolve(n, blur1, mode='constant', cval=0) for n in noise]
-        noise = [scipy.ndimage.filters.convolve(n, blur2, mode='constant', cval=0) for n in noise]
-        ax = [np.linspace(-(b - 1) * gran, (b - 1) * gran, b) for b in bb]
-        interp = [
-            scipy.interpolate.RegularGridInterpolator(ax, n, bounds_error=0, fill_value=0)
-            for n in noise
-        ]
-
-        def g(x_):
-            return np.hstack([i(x_)[:, None] for i in interp])
-
-        return x + g(x) * mag
+        return elastic(x, gran, mag, self.noise_pool)
 
     def dataAugment(self, xyz, jitter=False, flip=False, rot=False, scale=False, prob=1.0):
         m = np.eye(3)
@@ -454,35 +797,25 @@ class ScannetReferenceDataset(ReferenceDataset):
             xyz = xyz * scale_factor
         return np.matmul(xyz, m)
 
-    def crop(self, xyz, step=32):
-        xyz_offset = xyz.copy()
-        valid_idxs = xyz_offset.min(1) >= 0
-        assert valid_idxs.sum() == xyz.shape[0]
-        spatial_shape = np.array([self.voxel_cfg.spatial_shape[1]] * 3)
-        room_range = xyz.max(0) - xyz.min(0)
-        while (valid_idxs.sum() > self.voxel_cfg.max_npoint):
-            step_temp = step
-            if valid_idxs.sum() > 1e6:
-                step_temp = step * 2
-            offset = np.clip(spatial_shape - room_range + 0.001, None, 0) * np.random.rand(3)
-            xyz_offset = xyz + offset
-            valid_idxs = (xyz_offset.min(1) >= 0) * ((xyz_offset < spatial_shape).sum(1) == 3)
-            spatial_shape[:2] -= step_temp
-        return xyz_offset, valid_idxs
-
-    def transform_train(self, xyz, rgb, semantic_label, instance_label, aug_prob=1.0):
-        if self.augment == True:
+    def crop(self, xyz, step=32, histogram=None):
+        # histogram: lib/crop.py的PointHistogram，多次crop同一个场景时只需建一次
+        return crop(xyz, self.voxel_cfg.spatial_shape[1], self.voxel_cfg.max_npoint, step, histogram)
+
+    def transform_train(self, xyz, rgb, semantic_label, instance_label, aug_prob=1.0, device_augment=False):
+        # device_augment: 仿射变换和elastic留给augment_batch（见batch_augment）
+        if self.augment == True and not device_augment:
             xyz_middle = self.dataAugment(xyz, True, True, True, True, aug_prob)
         else:
             xyz_middle = xyz
         xyz = xyz_middle * self.voxel_cfg.scale
-        if np.random.rand() < aug_prob:
+        if not (self.batch_elastic or device_augment) and np.random.rand() < aug_prob:
             xyz = self.elastic(xyz, 6, 40.)
             xyz = self.elastic(xyz, 20, 160.)
         xyz = xyz - xyz.min(0)
         max_tries = 5
+        histogram = PointHistogram(xyz) if xyz.shape[0] > self.voxel_cfg.max_npoint else None
         while (max_tries > 0):
-            xyz_offset, valid_idxs = self.crop(xyz)
+            xyz_offset, valid_idxs = self.crop(xyz, histogram=histogram)
             if valid_idxs.sum() >= self.voxel_cfg.min_npoint:
                 xyz = xyz_offset
                 break
@@ -512,151 +845,90 @@ class ScannetReferenceDataset(ReferenceDataset):
     # instance_cls:列表，存储了这个object属于的semantic label
     # pt_offset_label:Nx3数组，存储了每个点与该点所属object中心的偏移量
     def getInstanceInfo(self, xyz, instance_label, semantic_label):
-        pt_mean = np.ones((xyz.shape[0], 3), dtype=np.float32) * -100.0
-        instance_pointnum = []
-        instance_cls = []
-        # max(instance_num, 0) to support instance_label with no valid instance_id
-        instance_num = max(int(instance_label.max()) + 1, 0)
-        for i_ in range(instance_num):
-            inst_idx_i = np.where(instance_label == i_)
-            if inst_idx_i[0].size == 0:  # 因为在前处理时，有些instance比如ceiling已经被删除了，所以可能会有空余的instance_label
-                instance_pointnum.append(inst_idx_i[0].size)
-                instance_cls.append(-100)
-                continue
-            xyz_i = xyz[inst_idx_i]  # 对应instance_id为i的所有点坐标
-            pt_mean[inst_idx_i] = xyz_i.mean(0)  # 这个instance的所有点的mean
-            instance_pointnum.append(inst_idx_i[0].size)
-            cls_idx = inst_idx_i[0][0]
-            instance_cls.append(semantic_label[cls_idx])
-        pt_offset_label = pt_mean - xyz
-        return instance_num, instance_pointnum, instance_cls, pt_offset_label
+        return get_instance_info(xyz, instance_label, semantic_label)
 
     def __getitem__(self, idx):
         start = time.time()
-        scene_id = self.scanrefer[idx]["scene_id"]
-        object_id = int(self.scanrefer[idx]["object_id"])
-        object_name = " ".join(self.scanrefer[idx]["object_name"].split("_"))  # 把下划线_替换成空格
-        ann_id = self.scanrefer[idx]["ann_id"]
-
-        # get language features
-        lang_feat = self.lang[scene_id][str(object_id)][ann_id]
-        lang_len = len(self.scanrefer[idx]["token"]) + 2
-        lang_len = lang_len if lang_len <= CONF.TRAIN.MAX_DES_LEN + 2 else CONF.TRAIN.MAX_DES_LEN + 2
-
-        # get pc 获取前处理的点云数据
-        mesh_vertices = self.scene_data[scene_id]["mesh_vertices"]  # nparray float32
-        instance_labels = self.scene_data[scene_id]["instance_labels"].astype(np.int64)  # nparray int64
-        semantic_labels = self.scene_data[scene_id]["semantic_labels"].astype(np.int64)  # nparray int64
-        instance_bboxes = self.scene_data[scene_id]["instance_bboxes"]  # nparray float64
+        self.stage_timer.start()
+        if self.targets_per_scene > 0:
+            # scene模式：场景只处理一次，data_dict["targets"]为该场景的多个描述目标
+            scene_id, target_idxs = self.scene_chunks[idx]
+            scene = self._get_scene(scene_id)
+            self.stage_timer.lap("fetch")
+            data_dict = self._get_scene_sample(scene_id, scene)
+            data_dict["targets"] = [self._get_target_sample(target_idx, scene) for target_idx in target_idxs]
+        else:
+            scene_id = self.scanrefer[idx]["scene_id"]
+            scene = self._get_scene(scene_id)
+            self.stage_timer.lap("fetch")
+            data_dict = self._get_scene_sample(scene_id, scene)
+            data_dict.update(self._get_target_sample(idx, scene))
+        self.stage_timer.lap("labels")  # 场景和描述目标的label/box
 
-        # 从nyu40id（1-40,0表示未分类）映射到语义分割时的class（0-19）, ceiling和未分配点变为-100
-        semantic_labels_nyu40id = np.copy(semantic_labels)  # 保存原始的nyu40id
-        for i in range(len(semantic_labels)):
-            semantic_labels[i] = semantic_map[semantic_labels[i]]
+        # 加载时间相关
+        data_dict["load_time"] = time.time() - start
+        self.stage_timer.add("getitem", data_dict["load_time"])
 
-        # map instance label
-        instance_labels = instance_labels - 1
-        instance_labels[instance_labels == -1] = -100
+        return data_dict
 
-        point_cloud = mesh_vertices[:, 0:6]
-        # 对坐标数据预处理,让其中心为(0,0,0),目的是为了后面的transform的scale放大操作
-        # 对instance_bbox也中心化
-        # 获取color数据, 对color正则化，rgb范围为[-1,1]
-        point_cloud[:, 0:3] = np.ascontiguousarray(point_cloud[:, 0:3] - point_cloud[:, 0:3].mean(0))
-        point_cloud[:, 3:6] = (point_cloud[:, 3:6] - MEAN_COLOR_RGB) / 256.0
+    def _wants(self, key):
+        """ 是否需要计算key（sample或batch中的key）：没有fields或validate_fields时计算所有key """
+        return self.fields is None or self.validate_fields or key in self.fields
+
+    def _get_scene_sample(self, scene_id, scene):
+        """ 场景相关的部分：点云采样、augmentation、softgroup的输入和label、场景内所有GT bbox """
+        # get pc 获取预处理后的点云数据（见_prepare_scene），缓存中的数组是只读的，这里取出的都是副本
+        instance_labels = scene["instance_labels"].astype(np.int64)  # nparray int64
+        semantic_labels = scene["semantic_labels"].astype(np.int64)  # nparray int64
+        semantic_labels_nyu40id = scene["semantic_labels_nyu40id"].astype(np.int64)  # 原始的nyu40id
+        point_cloud = np.array(scene["point_cloud"])  # 已中心化，color已正则化
         pcl_color = point_cloud[:, 3:6]
-        instance_bboxes[:, 0:3] = instance_bboxes[:, 0:3] - point_cloud[:, 0:3].mean(0)
 
         if self.split == 'train':
-            # 随机选取num_points的点，这里是选取40000个点
-            point_cloud, choices = random_sampling(point_cloud, self.num_points, return_choices=True)
+            # 选取num_points的点，这里是选取40000个点
+            if self.sampling == "random":
+                point_cloud, choices = random_sampling(point_cloud, self.num_points, return_choices=True)
+            else:
+                point_cloud, choices = voxel_sampling(point_cloud, self.num_points, self.sampling_voxel_size,
+                                                      fps=self.sampling == "fps", return_choices=True)
             instance_labels = instance_labels[choices]
             semantic_labels = semantic_labels[choices]
             semantic_labels_nyu40id = semantic_labels_nyu40id[choices]
             pcl_color = pcl_color[choices]
+        self.stage_timer.lap("sampling")
 
         # --------------------------- FEAT used for SOFTGROUP -----------------------------
         # 对数据做augmentation，xyz_middle为augment之后坐标，xyz为平移+放大xyz_middle之后的坐标（用于voxelization)
+        # batch_augment时crop不裁点的场景在device上增强，crop的窗口与增强后的坐标无关
+        device_augment = self.augment and self.batch_augment and point_cloud.shape[0] <= self.voxel_cfg.max_npoint
         if self.augment:
-            data = self.transform_train(point_cloud[:, 0:3], point_cloud[:, 3:6], semantic_labels, instance_labels, 1)
+            data = self.transform_train(point_cloud[:, 0:3], point_cloud[:, 3:6], semantic_labels, instance_labels, 1,
+                                        device_augment)
         else:
             data = self.transform_test(point_cloud[:, 0:3], point_cloud[:, 3:6], semantic_labels, instance_labels)
         xyz, xyz_middle, rgb, semantic_labels, instance_labels = data
+        self.stage_timer.lap("augment")
         point_cloud = np.concatenate((xyz_middle, rgb), axis=1)
 
         # 得到场景内instance总数，每个instance中点的数量，instance所属label，点偏移量
         info = self.getInstanceInfo(xyz_middle, instance_labels, semantic_labels)
         inst_num, inst_pointnum, inst_cls, pt_offset_label = info
+        self.stage_timer.lap("instance_info")
 
         # ------------------------------- LABELS ------------------------------
-        target_bboxes = np.zeros((MAX_NUM_OBJ, 6))  # 场景内所有bbox的坐标+尺寸
-        target_bboxes_mask = np.zeros((MAX_NUM_OBJ))  # 场景内的所有bbox的mask
-        size_classes = np.zeros((MAX_NUM_OBJ,))
-        size_residuals = np.zeros((MAX_NUM_OBJ, 3))
-        num_bbox = 0  # 场景内bbox数量
-
-        ref_box_label = np.zeros(MAX_NUM_OBJ)  # bbox label for reference target
-        ref_center_label = np.zeros(3)  # bbox center for reference target
-        ref_size_class_label = 0
-        ref_size_residual_label = np.zeros(3)  # bbox size residual for reference target
-        ref_box_corner_label = np.zeros((8, 3))
-        ref_size_label = np.zeros(3)
-
-        num_bbox = instance_bboxes.shape[0] if instance_bboxes.shape[0] < MAX_NUM_OBJ else MAX_NUM_OBJ
-        target_bboxes_mask[0:num_bbox] = 1
-        target_bboxes[0:num_bbox, :] = instance_bboxes[:MAX_NUM_OBJ, 0:6]
-
-        # NOTE: set size class as semantic class. Consider use size2class.
-        # 将instance_bbox的nyu40id映射到semantic class（0-19）
-        class_ind = np.asarray([semantic_map[int(x)] for x in instance_bboxes[:num_bbox, -2]])
-        size_classes[0:num_bbox] = class_ind
-        size_residuals[0:num_bbox, :] = target_bboxes[0:num_bbox, 3:6] - DC.mean_size_arr[class_ind - 2,
-                                                                         :]  # 和这个类平均尺寸的偏差
-        # 上面不会出错，虽然semantic_map会将ceiling映射到-100,但预处理中已经去除了instance_bbox中属于这类的bbox
-        # 所以DC.mean_size_arr不会出现indexError，减2是因为不考虑wall和floor这两类
-
-        # construct the reference target label for each bbox
-        for i, gt_id in enumerate(instance_bboxes[:num_bbox, -1]):
-            if gt_id == object_id:
-                ref_box_label[i] = 1
-                ref_center_label = target_bboxes[i, 0:3]
-                ref_size_label = target_bboxes[i, 3:6]
-                ref_size_class_label = size_classes[i]
-                ref_size_residual_label = size_residuals[i]
-
-                # construct ground truth box corner coordinates
-                ref_obb = DC.param2obb(ref_center_label, ref_size_class_label, ref_size_residual_label)
-                ref_box_corner_label = get_3d_box(ref_obb[3:6], 0, ref_obb[0:3])
-
-        # construct all GT bbox corners
-        all_obb = DC.param2obb_batch(target_bboxes[:num_bbox, 0:3], size_classes[:num_bbox].astype(np.int64),
-                                     size_residuals[:num_bbox])
-        all_box_corner_label = get_3d_box_batch(all_obb[:, 3:6], np.zeros(num_bbox), all_obb[:, 0:3])
-
-        # store
-        gt_box_corner_label = np.zeros((MAX_NUM_OBJ, 8, 3))
-        gt_box_masks = np.zeros((MAX_NUM_OBJ,))
-        gt_box_object_ids = np.zeros((MAX_NUM_OBJ,))
-
-        gt_box_corner_label[:num_bbox] = all_box_corner_label
-        gt_box_masks[:num_bbox] = 1
-        gt_box_object_ids[:num_bbox] = instance_bboxes[:, -1]
-
-        target_bboxes_semcls = np.zeros((MAX_NUM_OBJ))
-        target_object_ids = np.zeros((MAX_NUM_OBJ,))  # object ids of all objects
-        try:
-            target_bboxes_semcls[0:num_bbox] = [semantic_map[int(x)] for x in instance_bboxes[:, -2][0:num_bbox]]
-            target_object_ids[0:num_bbox] = instance_bboxes[:, -1][0:num_bbox]
-        except KeyError:
-            pass
-
-        object_cat = self.raw2label[object_name] if object_name in self.raw2label else 17
+        # 场景内所有bbox的label在_prepare_scene中已算好
+        num_bbox = scene["num_bbox"]
+        target_bboxes = scene["target_bboxes"]
+        size_classes = scene["size_classes"]
+        size_residuals = scene["size_residuals"]
+        target_bboxes_mask = scene["target_bboxes_mask"]
+        gt_box_corner_label = scene["gt_box_corner_label"]
+        gt_box_masks = scene["gt_box_masks"]
+        gt_box_object_ids = scene["gt_box_object_ids"]
+        target_bboxes_semcls = scene["target_bboxes_semcls"]
+        target_object_ids = scene["target_object_ids"]
 
         data_dict = {}
-        # dataset相关
-        # ----------------------------------------------------------------------
-        data_dict["dataset_idx"] = np.array(idx).astype(np.int64)  # 表示这是dataset中第几个sample
-
         # softgroup相关参数
         # ----------------------------------------------------------------------
         data_dict["scan_id"] = scene_id
@@ -669,138 +941,247 @@ class ScannetReferenceDataset(ReferenceDataset):
         data_dict["inst_pointnum"] = np.array(inst_pointnum).astype(np.int64)
         data_dict["inst_cls"] = np.array(inst_cls).astype(np.int64)
         data_dict["pt_offset_label"] = torch.from_numpy(pt_offset_label)
+        if device_augment:
+            data_dict["aug_seed"] = np.random.randint(2 ** 31)  # 这个场景在device上的仿射变换的种子
+        if self.voxel_cache is not None:
+            data_dict["voxelization"] = self.voxel_cache.get(scene_id, data_dict["coord"])  # (voxel_coords, v2p, p2v)
 
-        # point-cloud data相关
-        # ----------------------------------------------------------------------
-        data_dict["point_clouds"] = point_cloud.astype(np.float32)  # point cloud data including features
-        data_dict["pcl_color"] = pcl_color
-        data_dict["semantic_label_nyu40id"] = np.array(semantic_labels_nyu40id).astype(np.int64)
-        data_dict["object_id"] = torch.from_numpy(np.array(int(object_id)).astype(np.int64))  # 该物体在场景中的id
-        data_dict["object_cat"] = np.array(object_cat).astype(np.int64)  # 该物体对应的category（0-17）
-        data_dict["ann_id"] = np.array(int(ann_id)).astype(np.int64)  # 该描述的id
-
-        # language description相关
+        # point-cloud data相关，collate_fn不使用，只在没有fields时返回
         # ----------------------------------------------------------------------
-        data_dict["lang_feat"] = torch.from_numpy(lang_feat.astype(np.float32))  # language feature vectors
-        data_dict["lang_len"] = torch.from_numpy(np.array(lang_len).astype(np.int64))  # length of each description
-        data_dict["lang_ids"] = torch.from_numpy(
-            np.array(self.lang_ids[scene_id][str(object_id)][ann_id]).astype(np.int64))  # 对应单词idx的列表
+        if self._wants("point_clouds"):
+            data_dict["point_clouds"] = point_cloud.astype(np.float32)  # point cloud data including features
+            data_dict["pcl_color"] = pcl_color
+            data_dict["semantic_label_nyu40id"] = np.array(semantic_labels_nyu40id).astype(np.int64)
 
         # GT bounding box相关，即该train sample对应的场景scene中的所有bbox
         # ----------------------------------------------------------------------
-        data_dict["num_bbox"] = np.array(num_bbox).astype(np.int64)  # 该scene中共有多少instances（bounding box）
-        data_dict["box_label_mask"] = target_bboxes_mask.astype(
-            np.float32)  # (MAX_NUM_OBJ) as 0/1 with 1 indicating a unique box,1表示有bbox，0表示无
-        data_dict["center_label"] = torch.from_numpy(target_bboxes.astype(np.float32)[:,
-                                                     0:3])  # (MAX_NUM_OBJ, 3) for GT box center XYZ，即所有gt box的中心坐标
-        data_dict["size_class_label"] = size_classes.astype(
-            np.int64)  # (MAX_NUM_OBJ,) with int values in 0,...,NUM_SIZE_CLUSTER，表示每个object对应的class(0-17)
-        data_dict["size_residual_label"] = size_residuals.astype(np.float32)  # (MAX_NUM_OBJ, 3) 每个object的尺寸
+        if self._wants("num_bbox"):
+            data_dict["num_bbox"] = np.array(num_bbox).astype(np.int64)  # 该scene中共有多少instances（bounding box）
+            data_dict["box_label_mask"] = target_bboxes_mask.astype(
+                np.float32)  # (MAX_NUM_OBJ) as 0/1 with 1 indicating a unique box,1表示有bbox，0表示无
+            data_dict["size_class_label"] = size_classes.astype(
+                np.int64)  # (MAX_NUM_OBJ,) with int values in 0,...,NUM_SIZE_CLUSTER，表示每个object对应的class(0-17)
+            data_dict["size_residual_label"] = size_residuals.astype(np.float32)  # (MAX_NUM_OBJ, 3) 每个object的尺寸
+        if self._wants("center_label"):
+            data_dict["center_label"] = torch.from_numpy(target_bboxes.astype(np.float32)[:,
+                                                         0:3])  # (MAX_NUM_OBJ, 3) for GT box center XYZ，即所有gt box的中心坐标
 
         # GT bounding box corner相关，即该train sample中对应的物体的bbox的corners坐标
         # ----------------------------------------------------------------------
-        data_dict["gt_box_corner_label"] = torch.from_numpy(gt_box_corner_label.astype(
-            np.float64))  # (MAX_NUM_OBJ，8，3) 所有 GT box的corners，NOTE type must be double
-        data_dict["gt_box_masks"] = gt_box_masks.astype(np.int64)  # (MAX_NUM_OBJ)，1表示有bbox，0表示无
-        data_dict["gt_box_object_ids"] = gt_box_object_ids.astype(np.int64)  # 各GT bbox对应的object ids
+        if self._wants("gt_box_corner_label"):
+            data_dict["gt_box_corner_label"] = torch.from_numpy(gt_box_corner_label.astype(
+                np.float64))  # (MAX_NUM_OBJ，8，3) 所有 GT box的corners，NOTE type must be double
+        if self._wants("gt_box_masks"):
+            data_dict["gt_box_masks"] = gt_box_masks.astype(np.int64)  # (MAX_NUM_OBJ)，1表示有bbox，0表示无
+            data_dict["gt_box_object_ids"] = gt_box_object_ids.astype(np.int64)  # 各GT bbox对应的object ids
 
-        # ref bounding box相关，即该train sample中对应的物体的bbox
+        # target相关
         # ----------------------------------------------------------------------
-        data_dict["ref_box_label"] = ref_box_label.astype(np.int64)  # 0/1 reference labels for each object bbox，1表示当前物体
-        data_dict["ref_center_label"] = torch.from_numpy(ref_center_label.astype(np.float32))  # 该ref bbox的中心点坐标
-        data_dict["ref_size_class_label"] = np.array(int(ref_size_class_label)).astype(
-            np.int64)  # 该ref bbox对应的class（0-17）
-        data_dict["ref_size_residual_label"] = ref_size_residual_label.astype(np.float32)  # 该ref bbox的尺寸误差数据
-        data_dict["ref_box_corner_label"] = ref_box_corner_label.astype(
-            np.float64)  # target box corners NOTE type must be double，即ref bbox的8个corner点坐标
-        data_dict['ref_size_label'] = torch.from_numpy(ref_size_label.astype(np.float32))  # 该ref bbox的尺寸数据
+        if self._wants("sem_cls_label"):
+            data_dict["sem_cls_label"] = target_bboxes_semcls.astype(np.int64)  # (MAX_NUM_OBJ,)，object对应的semantic class
+        if self._wants("scene_object_ids"):
+            data_dict["scene_object_ids"] = torch.from_numpy(
+                target_object_ids.astype(np.int64))  # (MAX_NUM_OBJ,)，object对应的object_id
 
-        # target相关
+        return data_dict
+
+    def _get_target_sample(self, idx, scene):
+        """ 描述目标相关的部分：语言特征、ref物体的bbox label，idx为self.scanrefer中的下标 """
+        scene_id = self.scanrefer[idx]["scene_id"]
+        object_id = int(self.scanrefer[idx]["object_id"])
+        object_name = " ".join(self.scanrefer[idx]["object_name"].split("_"))  # 把下划线_替换成空格
+        ann_id = self.scanrefer[idx]["ann_id"]
+
+        # get language features
+        lang_feat = self.lang[scene_id][str(object_id)][ann_id]  # lang_ids_only时为None
+        lang_len = len(self.scanrefer[idx]["token"]) + 2
+        lang_len = lang_len if lang_len <= CONF.TRAIN.MAX_DES_LEN + 2 else CONF.TRAIN.MAX_DES_LEN + 2
+
+        instance_bboxes = scene["instance_bboxes"]
+        num_bbox = scene["num_bbox"]
+        target_bboxes = scene["target_bboxes"]
+        size_classes = scene["size_classes"]
+        size_residuals = scene["size_residuals"]
+
+        ref_box_label = np.zeros(MAX_NUM_OBJ)  # bbox label for reference target
+        ref_center_label = np.zeros(3)  # bbox center for reference target
+        ref_size_class_label = 0
+        ref_size_residual_label = np.zeros(3)  # bbox size residual for reference target
+        ref_box_corner_label = np.zeros((8, 3))
+        ref_size_label = np.zeros(3)
+
+        # construct the reference target label for each bbox
+        # 有多个bbox的object_id相同时都标为1，ref label取最后一个
+        ref_ids = np.nonzero(instance_bboxes[:num_bbox, -1] == object_id)[0]
+        if len(ref_ids) > 0:
+            i = ref_ids[-1]
+            ref_box_label[ref_ids] = 1
+            ref_center_label = target_bboxes[i, 0:3]
+            ref_size_label = target_bboxes[i, 3:6]
+            ref_size_class_label = size_classes[i]
+            ref_size_residual_label = size_residuals[i]
+
+            # construct ground truth box corner coordinates
+            if self._wants("ref_box_corner_label"):
+                ref_obb = DC.param2obb(ref_center_label, ref_size_class_label, ref_size_residual_label)
+                ref_box_corner_label = get_3d_box(ref_obb[3:6], 0, ref_obb[0:3])
+
+        object_cat = self.raw2label[object_name] if object_name in self.raw2label else 17
+
+        data_dict = {}
+        # dataset相关
         # ----------------------------------------------------------------------
-        data_dict["sem_cls_label"] = target_bboxes_semcls.astype(np.int64)  # (MAX_NUM_OBJ,)，object对应的semantic class
-        data_dict["scene_object_ids"] = torch.from_numpy(
-            target_object_ids.astype(np.int64))  # (MAX_NUM_OBJ,)，object对应的object_id
+        if self._wants("object_id"):
+            data_dict["object_id"] = torch.from_numpy(np.array(int(object_id)).astype(np.int64))  # 该物体在场景中的id
+        if self._wants("dataset_idx"):
+            data_dict["dataset_idx"] = np.array(idx).astype(np.int64)  # 表示这是dataset中第几个sample
+            data_dict["object_cat"] = np.array(object_cat).astype(np.int64)  # 该物体对应的category（0-17）
+            data_dict["ann_id"] = np.array(int(ann_id)).astype(np.int64)  # 该描述的id
 
-        # unique_multiple，0表示该物体类型在场景中只有一个，1则表示该场景中有多个该种object
-        data_dict["unique_multiple"] = np.array(self.unique_multiple_lookup[scene_id][str(object_id)][ann_id]).astype(
-            np.int64)
+        # language description相关
+        # ----------------------------------------------------------------------
+        if lang_feat is not None and self._wants("lang_feat"):
+            data_dict["lang_feat"] = torch.from_numpy(lang_feat.astype(np.float32))  # language feature vectors
+        if self._wants("lang_len"):
+            data_dict["lang_len"] = torch.from_numpy(np.array(lang_len).astype(np.int64))  # length of each description
+        if self._wants("lang_ids"):
+            data_dict["lang_ids"] = torch.from_numpy(
+                np.array(self.lang_ids[scene_id][str(object_id)][ann_id]).astype(np.int64))  # 对应单词idx的列表
 
-        # 加载时间相关
-        data_dict["load_time"] = time.time() - start
+        # ref bounding box相关，即该train sample中对应的物体的bbox
+        # ----------------------------------------------------------------------
+        if self._wants("ref_center_label"):
+            data_dict["ref_center_label"] = torch.from_numpy(ref_center_label.astype(np.float32))  # 该ref bbox的中心点坐标
+        if self._wants("ref_size_label"):
+            data_dict['ref_size_label'] = torch.from_numpy(ref_size_label.astype(np.float32))  # 该ref bbox的尺寸数据
+        if self._wants("ref_box_label"):
+            data_dict["ref_box_label"] = ref_box_label.astype(np.int64)  # 0/1 reference labels for each object bbox，1表示当前物体
+            data_dict["ref_size_class_label"] = np.array(int(ref_size_class_label)).astype(
+                np.int64)  # 该ref bbox对应的class（0-17）
+            data_dict["ref_size_residual_label"] = ref_size_residual_label.astype(np.float32)  # 该ref bbox的尺寸误差数据
+        if self._wants("ref_box_corner_label"):
+            data_dict["ref_box_corner_label"] = ref_box_corner_label.astype(
+                np.float64)  # target box corners NOTE type must be double，即ref bbox的8个corner点坐标
+
+        # unique_multiple，0表示该物体类型在场景中只有一个，1则表示该场景中有多个该种object
+        if self._wants("unique_multiple"):
+            data_dict["unique_multiple"] = np.array(
+                self.unique_multiple_lookup[scene_id][str(object_id)][ann_id]).astype(np.int64)
 
         return data_dict
 
-    def collate_fn(self, batch):
-        scan_ids = []
-        coords = []
-        coords_float = []
-        feats = []
-        semantic_labels = []
-        instance_labels = []
-        instance_pointnum = []  # (total_nInst), int
-        instance_cls = []  # (total_nInst), long
-        pt_offset_labels = []
-
-        total_inst_num = 0
-        batch_id = 0
-
-        for data in batch:
-            if data is None:
-                continue
-            # get data from dataset
-            scan_id = data["scan_id"]
-            coord = data["coord"]
-            coord_float = data["coord_float"]
-            feat = data["feat"]
-            semantic_label = data["semantic_label"]
-            instance_label = data["instance_label"]
-            inst_num = data["inst_num"]
-            inst_pointnum = data["inst_pointnum"]
-            inst_cls = data["inst_cls"]
-            pt_offset_label = data["pt_offset_label"]
-
-            # append
-            scan_ids.append(scan_id)
-            coords.append(torch.cat([coord.new_full((coord.size(0), 1), batch_id), coord], 1))
-            coords_float.append(coord_float)
-            feats.append(feat)
-            semantic_labels.append(semantic_label)
-            instance_labels.append(instance_label)
-            instance_pointnum.extend(inst_pointnum)
-            instance_cls.extend(inst_cls)
-            pt_offset_labels.append(pt_offset_label)
-            batch_id += 1
+    def _empty(self, name, size, dtype):
+        """ collate_fn的输出buffer，worker中有batch_ring时来自共享内存的ring，
+        pin_memory=True且在主进程中collate（num_workers=0）时直接分配pinned memory
+        （worker中分配pinned memory需要初始化CUDA，这时由DataLoader(pin_memory=True)调用Batch.pin_memory） """
+        in_worker = get_worker_info() is not None
+        if in_worker and self.batch_ring is not None:
+            return self.batch_ring.empty(name, size, dtype)
+        pin = self.pin_memory and not in_worker and torch.cuda.is_available()
+        return torch.empty(size, dtype=dtype, pin_memory=pin)
+
+    def _stack(self, key, items):
+        """ 和torch.cat([item[key].unsqueeze(0) for item in items])相同，拷贝到一次分配的buffer中 """
+        tensors = [item[key] for item in items]
+        out = self._empty(key, (len(tensors),) + tuple(tensors[0].shape), tensors[0].dtype)
+        for i, tensor in enumerate(tensors):
+            out[i] = tensor
+        return out
 
+    def collate_fn(self, batch):
+        self.stage_timer.start()
+        if self.batch_ring is not None:
+            self.batch_ring.next_slot()
+        # 先统计点数和描述目标数，每个输出只分配一次，再把每个sample拷贝到对应的位置
+        samples = [data for data in batch if data is not None]
+        batch_id = len(samples)
         assert batch_id > 0, 'empty batch'
         if batch_id < len(batch):
             print(f'batch is truncated from size {len(batch)} to {batch_id}')
 
+        scan_ids = [data["scan_id"] for data in samples]
+        voxelizations = [data.get("voxelization") for data in samples]  # 缓存的单场景voxelization结果
+        targets = []  # 描述目标，scene模式下每个场景有多个
+        target_batch_idxs = []  # 每个描述目标属于batch中的哪个场景
+        for i, data in enumerate(samples):
+            data_targets = data["targets"] if "targets" in data else [data]
+            targets.extend(data_targets)
+            target_batch_idxs.extend([i] * len(data_targets))
+
         # merge all the scenes in the batch
-        coords = torch.cat(coords, 0)  # long (N, 1 + 3), the batch item idx is put in coords[:, 0]
-        batch_idxs = coords[:, 0].int()
-        coords_float = torch.cat(coords_float, 0).to(torch.float32)  # float (N, 3)
-        feats = torch.cat(feats, 0)  # float (N, C)
-        semantic_labels = torch.cat(semantic_labels, 0).long()  # long (N)
-        instance_labels = torch.cat(instance_labels, 0).long()  # long (N)
-        instance_pointnum = torch.tensor(instance_pointnum, dtype=torch.int)  # int (total_nInst)
-        instance_cls = torch.tensor(instance_cls, dtype=torch.long)  # long (total_nInst)
-        pt_offset_labels = torch.cat(pt_offset_labels).float()
-
-        object_id = torch.cat([batch[i]['object_id'].unsqueeze(0) for i in range(len(batch))], 0)
-        lang_feat = torch.cat([batch[i]['lang_feat'].unsqueeze(0) for i in range(len(batch))], 0)
-        lang_len = torch.cat([batch[i]['lang_len'].unsqueeze(0) for i in range(len(batch))], 0)
-        lang_ids = torch.cat([batch[i]['lang_ids'].unsqueeze(0) for i in range(len(batch))], 0)
-        ref_size_label = torch.cat([batch[i]['ref_size_label'].unsqueeze(0) for i in range(len(batch))], 0)
-        ref_center_label = torch.cat([batch[i]['ref_center_label'].unsqueeze(0) for i in range(len(batch))], 0)
-        center_label = torch.cat([batch[i]['center_label'].unsqueeze(0) for i in range(len(batch))], 0)
-        scene_object_ids = torch.cat([batch[i]['scene_object_ids'].unsqueeze(0) for i in range(len(batch))], 0)
-        gt_box_corner_label = torch.cat([batch[i]['gt_box_corner_label'].unsqueeze(0) for i in range(len(batch))], 0)
-
-        spatial_shape = np.clip(coords.max(0)[0][1:].numpy() + 1, self.voxel_cfg.spatial_shape[0], None)
-
-        voxel_coords, v2p_map, p2v_map = voxelization_idx(coords, batch_id)
-
-        return {
+        point_offsets = np.cumsum([0] + [data["coord"].size(0) for data in samples])
+        num_points = int(point_offsets[-1])
+        # long (N, 1 + 3), the batch item idx is put in coords[:, 0]
+        coords = self._empty('coords', (num_points, 4), torch.long)
+        coords_float = self._empty('coords_float', (num_points, 3), torch.float32)  # float (N, 3)
+        feats = self._empty('feats', (num_points, samples[0]["feat"].size(1)), torch.float32)  # float (N, C)
+        semantic_labels = self._empty('semantic_labels', num_points, torch.long)  # long (N)
+        instance_labels = self._empty('instance_labels', num_points, torch.long)  # long (N)
+        pt_offset_labels = self._empty('pt_offset_labels', (num_points, 3), torch.float32)  # float (N, 3)
+        for i, data in enumerate(samples):
+            start, end = point_offsets[i], point_offsets[i + 1]
+            coords[start:end, 0] = i
+            coords[start:end, 1:] = data["coord"]
+            coords_float[start:end] = data["coord_float"]
+            feats[start:end] = data["feat"]
+            semantic_labels[start:end] = data["semantic_label"]
+            instance_labels[start:end] = data["instance_label"]
+            pt_offset_labels[start:end] = data["pt_offset_label"]
+        batch_idxs = self._empty('batch_idxs', num_points, torch.int)
+        batch_idxs[:] = coords[:, 0]
+        instance_pointnum, instance_cls = None, None
+        if self._wants('instance_pointnum'):
+            instance_pointnum = torch.from_numpy(np.concatenate(
+                [data["inst_pointnum"].reshape(-1) for data in samples]).astype(np.int32))  # int (total_nInst)
+            instance_cls = torch.from_numpy(
+                np.concatenate([data["inst_cls"].reshape(-1) for data in samples]).astype(np.int64))  # long (total_nInst)
+        self.stage_timer.lap("collate_points")
+
+        if self.augment and self.batch_elastic:
+            # 对整个batch做elastic，再把每个场景平移到原点，重新得到voxel坐标
+            batch_offsets = torch.cat([batch_idxs.new_zeros(1), torch.bincount(batch_idxs, minlength=batch_id)]).cumsum(0)
+            xyz = coords_float * self.voxel_cfg.scale
+            xyz = elastic_batch(xyz, batch_offsets, 6, 40.)
+            xyz = elastic_batch(xyz, batch_offsets, 20, 160.)
+            for start, end in zip(batch_offsets[:-1], batch_offsets[1:]):
+                xyz[start:end] -= xyz[start:end].min(0)[0]
+            coords[:, 1:] = xyz.long()
+            self.stage_timer.lap("batch_elastic")
+
+        # batch_augment: 只生成仿射变换矩阵，增强、voxel坐标和voxelization在device上做（augment_batch），
+        # 在worker中已增强的场景用单位矩阵，不在aug_mask中
+        aug_mask = torch.tensor(["aug_seed" in data for data in samples])
+        aug_matrices = None
+        if self.batch_augment and aug_mask.any():
+            aug_matrices = torch.eye(3, dtype=torch.float32).repeat(batch_id, 1, 1)
+            aug_matrices[aug_mask] = random_affine(
+                int(aug_mask.sum()), seeds=[data["aug_seed"] for data in samples if "aug_seed" in data]).float()
+
+        # 描述目标相关的都是(num_targets, ...)，非scene模式下num_targets即batch_size
+        # fields中没有的不在sample中（见_wants），也不拼接
+        target_batch_idxs = torch.tensor(target_batch_idxs, dtype=torch.long)  # long (num_targets)
+        stacked = {}
+        for key in ('object_id', 'lang_feat', 'lang_len', 'lang_ids', 'ref_size_label', 'ref_center_label'):
+            if key in targets[0]:
+                stacked[key] = self._stack(key, targets)
+        for key in ('center_label', 'scene_object_ids', 'gt_box_corner_label'):
+            if key in samples[0]:
+                stacked[key] = self._stack(key, samples)
+        self.stage_timer.lap("collate_targets")
+
+        if aug_matrices is not None:
+            # 由augment_batch根据增强后的点计算
+            spatial_shape, voxel_coords, v2p_map, p2v_map = None, None, None, None
+        else:
+            spatial_shape = np.clip(coords.max(0)[0][1:].numpy() + 1, self.voxel_cfg.spatial_shape[0], None)
+            if all(voxelization is not None for voxelization in voxelizations):
+                # 只需平移batch idx和点/voxel的下标后拼接
+                voxel_coords, v2p_map, p2v_map = merge_voxelizations(voxelizations)
+            else:
+                voxel_coords, v2p_map, p2v_map = voxelization_idx(coords, batch_id)
+            self.stage_timer.lap("voxelize")
+
+        out = {
             # softgroup need
             'scan_ids': scan_ids,
             'coords': coords,
@@ -819,19 +1200,37 @@ class ScannetReferenceDataset(ReferenceDataset):
             'batch_size': batch_id,
 
             # proposal module need
-            'object_id': object_id,
-            'ref_size_label': ref_size_label,
-            'ref_center_label': ref_center_label,
-            'center_label': center_label,
-            'gt_box_corner_label': gt_box_corner_label,
-            'scene_object_ids': scene_object_ids,
+            'object_id': stacked.get('object_id'),
+            'target_batch_idxs': target_batch_idxs,
+            'ref_size_label': stacked.get('ref_size_label'),
+            'ref_center_label': stacked.get('ref_center_label'),
+            'center_label': stacked.get('center_label'),
+            'gt_box_corner_label': stacked.get('gt_box_corner_label'),
+            'scene_object_ids': stacked.get('scene_object_ids'),
 
             # caption module need
-            'lang_feat': lang_feat,
-            'lang_len': lang_len,
-            'lang_ids': lang_ids,
-
+            'lang_feat': stacked.get('lang_feat'),  # lang_ids_only时为None
+            'lang_len': stacked.get('lang_len'),
+            'lang_ids': stacked.get('lang_ids'),
+
+            # 这个worker中这个batch各阶段的耗时（秒），由CapNet汇总后记录percentiles
+            'stage_times': self.stage_timer.drain(),
+            # 这个worker的scene_cache（lazy模式）从上一个batch以来的命中/未命中次数，由CapNet记录命中率
+            'scene_cache': self.scene_cache.drain_counts(),
         }
+        if aug_matrices is not None:
+            # device上的增强（augment_batch）需要，用完即从batch中删除
+            out['aug_matrices'] = aug_matrices  # float (B, 3, 3)
+            out['aug_mask'] = aug_mask  # bool (B)
+            if not aug_mask.all():
+                # 不在aug_mask中的场景保留worker中得到的voxel坐标（elastic和crop后的）
+                out['aug_coords'] = coords  # long (N, 1 + 3)
+        if self.fields is None:
+            return Batch(out)
+        declared = {k: v for k, v in out.items() if k in self.fields}
+        if self.validate_fields:
+            return Batch(out, undeclared=[k for k in out if k not in self.fields])
+        return Batch(declared)
 
 
 class ScannetReferenceTestDataset():
@@ -871,7 +1270,7 @@ class ScannetReferenceTestDataset():
             point_cloud = mesh_vertices[:, 0:3]  # do not use color for now
             pcl_color = mesh_vertices[:, 3:6]
         else:
-            point_cloud = mesh_vertices[:, 0:6]
+            point_cloud = np.array(mesh_vertices[:, 0:6])
             point_cloud[:, 3:6] = (point_cloud[:, 3:6] - MEAN_COLOR_RGB) / 256.0
             pcl_color = point_cloud[:, 3:6]
 
@@ -0,0 +1,169 @@
+'''
+Elastic distortion used by ScannetReferenceDataset.transform_train.
+
+The original implementation builds three noise grids, blurs each of them with six
+scipy.ndimage convolutions and samples them with three RegularGridInterpolators per call.
+Here the three noise channels are kept in one (3, bx, by, bz) array, the box blur is done with
+shifted slice sums over all channels at once and the displacement of a point is read with one
+trilinear gather of all channels, which gives the same result up to float rounding.
+
+NoisePool optionally keeps a few pre-blurred noise fields and hands out windows at random
+offsets instead of generating and blurring a new field on every call. The noise is stationary,
+so a window has the same statistics as a fresh field except at the border cells, which are not
+damped by the zero padding of the blur.
+
+elastic_batch is the torch version (conv3d blur + grid_sample) that distorts a whole batch in
+collate_fn, see the batch_elastic option of ScannetReferenceDataset.
+'''
+
+import numpy as np
+import scipy.interpolate
+import scipy.ndimage
+import torch
+import torch.nn.functional as F
+
+BLUR_WEIGHT = np.float32(1. / 3)  # weight of the 3-tap box filter, float32 like the original kernels
+
+
+def _box_blur(noise, axis):
+    """ 3-tap box filter along axis with zero padding, same as scipy.ndimage.convolve(mode='constant', cval=0) """
+    padded = np.moveaxis(noise, axis, 0).astype(np.float64)
+    padded = np.concatenate([np.zeros_like(padded[:1]), padded, np.zeros_like(padded[:1])])
+    blurred = (padded[:-2] * BLUR_WEIGHT + padded[1:-1] * BLUR_WEIGHT + padded[2:] * BLUR_WEIGHT).astype(np.float32)
+    return np.moveaxis(blurred, 0, axis)
+
+
+def blur_noise(noise):
+    """ noise: float32 (C, bx, by, bz), every channel blurred twice along each spatial axis """
+    for _ in range(2):
+        for axis in range(1, noise.ndim):
+            noise = _box_blur(noise, axis)
+    return noise
+
+
+def make_noise(shape):
+    """ blurred standard normal noise, float32 (3,) + shape """
+    return blur_noise(np.random.randn(3, *shape).astype(np.float32))
+
+
+class NoisePool(object):
+    """ pool_size pre-blurred noise fields, get(shape) returns a window at a random offset of a random field
+
+    The fields grow (and are regenerated) when a larger window is requested.
+    """
+
+    def __init__(self, pool_size=8):
+        self.pool_size = pool_size
+        self.fields = None  # (pool_size, 3, fx, fy, fz)
+
+    def get(self, shape):
+        shape = np.asarray(shape)
+        if self.fields is None or (shape > self.fields.shape[2:]).any():
+            field_shape = shape if self.fields is None else np.maximum(shape, self.fields.shape[2:])
+            self.fields = np.stack([make_noise(field_shape) for _ in range(self.pool_size)])
+        field = self.fields[np.random.randint(self.pool_size)]
+        offset = [np.random.randint(f - s + 1) for f, s in zip(field.shape[1:], shape)]
+        return field[:, offset[0]:offset[0] + shape[0], offset[1]:offset[1] + shape[1], offset[2]:offset[2] + shape[2]]
+
+
+def trilinear_sample(noise, x, gran):
+    """ samples all channels of noise (C, bx, by, bz) at x (N, 3) -> (N, C)
+
+    noise[:, i, j, k] sits at ((2 * i - (bx - 1)) * gran, ...), i.e. on the axes
+    np.linspace(-(b - 1) * gran, (b - 1) * gran, b); points outside the grid get 0
+    (RegularGridInterpolator(bounds_error=False, fill_value=0)).
+    """
+    shape = np.array(noise.shape[1:])
+    u = (x + (shape - 1) * gran) / (2. * gran)  # continuous grid index
+    inside = ((u >= 0) & (u <= shape - 1)).all(1)
+    i0 = np.maximum(np.minimum(u.astype(np.int64), shape - 2), 0)  # truncation is floor for the points inside
+    t = u - i0
+
+    # (bx * by * bz, C), the C values of a cell are contiguous so every corner is one row gather
+    values = np.ascontiguousarray(np.moveaxis(noise, 0, -1)).reshape(-1, noise.shape[0])
+    strides = [shape[1] * shape[2], shape[2], 1]
+    cell = i0[:, 0] * strides[0] + i0[:, 1] * strides[1] + i0[:, 2]
+    weights = [(1. - t[:, axis], t[:, axis]) for axis in range(3)]
+    out = np.zeros((x.shape[0], noise.shape[0]))
+    for dx in (0, 1):
+        for dy in (0, 1):
+            wxy = weights[0][dx] * weights[1][dy]
+            for dz in (0, 1):
+                corner = cell + (dx * strides[0] + dy * strides[1] + dz * strides[2])
+                out += (wxy * weights[2][dz])[:, None] * np.take(values, corner, axis=0)
+    out[~inside] = 0
+    return out
+
+
+def elastic(x, gran, mag, noise_pool=None):
+    """ x: (N, 3) scaled coordinates, returns x + mag * (blurred noise on a grid with spacing 2 * gran)(x) """
+    bb = np.abs(x).max(0).astype(np.int32) // gran + 3
+    noise = noise_pool.get(bb) if noise_pool is not None else make_noise(bb)
+    return x + trilinear_sample(noise, x, gran) * mag
+
+
+# 原来的实现（scipy convolve + RegularGridInterpolator），用于对比和benchmark (scripts/benchmark_dataset.py)
+def elastic_scipy(x, gran, mag):
+    blur0 = np.ones((3, 1, 1)).astype('float32') / 3
+    blur1 = np.ones((1, 3, 1)).astype('float32') / 3
+    blur2 = np.ones((1, 1, 3)).astype('float32') / 3
+
+    bb = np.abs(x).max(0).astype(np.int32) // gran + 3
+    noise = [np.random.randn(bb[0], bb[1], bb[2]).astype('float32') for _ in range(3)]
+    noise = [scipy.ndimage.convolve(n, blur0, mode='constant', cval=0) for n in noise]
+    noise = [scipy.ndimage.convolve(n, blur1, mode='constant', cval=0) for n in noise]
+    noise = [scipy.ndimage.convolve(n, blur2, mode='constant', cval=0) for n in noise]
+    noise = [scipy.ndimage.convolve(n, blur0, mode='constant', cval=0) for n in noise]
+    noise = [scipy.ndimage.convolve(n, blur1, mode='constant', cval=0) for n in noise]
+    noise = [scipy.ndimage.convolve(n, blur2, mode='constant', cval=0) for n in noise]
+    ax = [np.linspace(-(b - 1) * gran, (b - 1) * gran, b) for b in bb]
+    interp = [
+        scipy.interpolate.RegularGridInterpolator(ax, n, bounds_error=0, fill_value=0)
+        for n in noise
+    ]
+
+    def g(x_):
+        return np.hstack([i(x_)[:, None] for i in interp])
+
+    return x + g(x) * mag
+
+
+def _blur_noise_torch(noise):
+    """ noise: (B, 3, bx, by, bz), same blur as blur_noise with grouped conv3d """
+    channels = noise.size(1)
+    kernels = []
+    for axis in range(3):
+        shape = [1, 1, 1]
+        shape[axis] = 3
+        kernels.append((noise.new_full([channels, 1] + shape, float(BLUR_WEIGHT)), [1 if s == 3 else 0 for s in shape]))
+    for _ in range(2):
+        for kernel, padding in kernels:
+            noise = F.conv3d(noise, kernel, padding=padding, groups=channels)
+    return noise
+
+
+def elastic_batch(xyz, batch_offsets, gran, mag, generator=None):
+    """ elastic for a whole batch, xyz: float (N, 3) scaled coordinates of the concatenated samples,
+    batch_offsets: (B + 1) start of every sample in xyz
+
+    Every sample gets its own noise field, all fields share the grid size of the largest sample.
+    generator has to be on the device of xyz.
+    """
+    batch_size = batch_offsets.numel() - 1
+    lengths = batch_offsets[1:] - batch_offsets[:-1]
+    batch_idxs = torch.repeat_interleave(torch.arange(batch_size, device=xyz.device), lengths.to(xyz.device))
+    point_idxs = torch.arange(xyz.size(0), device=xyz.device) - batch_offsets.to(xyz.device)[batch_idxs]
+
+    # half extent of every sample, the grid covers the largest one
+    extent = torch.stack([xyz[start:end].abs().max(0)[0] for start, end in zip(batch_offsets[:-1], batch_offsets[1:])])
+    bb = (extent.max(0)[0].int() // gran + 3).tolist()
+    noise = torch.randn([batch_size, 3] + bb, generator=generator, device=xyz.device, dtype=xyz.dtype)
+    noise = _blur_noise_torch(noise)
+
+    # grid_sample: grid (..., 3) is (x, y, z) indexing (W, H, D), align_corners maps -1 / 1 to the first / last cell
+    half_size = (xyz.new_tensor(bb) - 1) * gran
+    grid = xyz.new_zeros((batch_size, 1, 1, int(lengths.max()), 3))
+    grid[batch_idxs, 0, 0, point_idxs] = (xyz / half_size).flip(1)
+    displacement = F.grid_sample(noise, grid, mode='bilinear', padding_mode='zeros', align_corners=True)
+    displacement = displacement[batch_idxs, :, 0, 0, point_idxs]  # (N, 3)
+    return xyz + displacement * mag
@@ -0,0 +1,97 @@
+'''
+GloVe helpers for the caption vocabulary.
+
+Only the words of the vocabulary (<dataset>_vocabulary.json) are ever looked up, so instead of
+unpickling the full glove.p in every process the vectors can be extracted once into a
+(num_vocabs, 300) float32 matrix aligned to word2idx:
+    python -m lib.glove --dataset Scanrefer
+load_glove() memory-maps that matrix and falls back to glove.p if it has not been built.
+'''
+
+import os
+import sys
+import json
+import pickle
+import argparse
+import numpy as np
+
+sys.path.append(os.path.join(os.getcwd(), "lib"))  # HACK add the lib folder
+from lib.config import CONF
+
+GLOVE_PICKLE = os.path.join(CONF.PATH.DATA, "glove.p")
+GLOVE_MATRIX = os.path.join(CONF.PATH.DATA, "{}_glove.npy")  # dataset_name
+VOCAB = os.path.join(CONF.PATH.DATA, "{}_vocabulary.json")  # dataset_name
+
+PAD_TOKEN = "pad_"
+UNK_TOKEN = "unk"
+
+
+def build_embedding_matrix(vocabulary, glove, emb_size=300):
+    """ (num_vocabs, emb_size) float32 matrix, row idx is the GloVe vector of vocabulary["idx2word"][idx]
+
+    Matches the per-token lookup of ReferenceDataset._tranform_des: words without a GloVe vector
+    get the "unk" vector and the padding row (pad_, idx 0) stays zero.
+    """
+    matrix = np.zeros((len(vocabulary["word2idx"]), emb_size), dtype=np.float32)
+    for word, idx in vocabulary["word2idx"].items():
+        if word == PAD_TOKEN:
+            continue
+        matrix[idx] = glove[word] if word in glove else glove[UNK_TOKEN]
+    return matrix
+
+
+class GloveMatrix(object):
+    """ read-only dict-like word -> vector access backed by the vocabulary-restricted matrix
+
+    Every vocabulary word except pad_ has a row, words outside the vocabulary raise KeyError,
+    which gives the same results as the full dict for all lookups the code does (a word that is
+    in glove.p but not in the vocabulary ends up as "unk" either way).
+    """
+
+    def __init__(self, vocabulary, matrix):
+        self.word2idx = vocabulary["word2idx"]
+        self.matrix = matrix
+
+    def __contains__(self, word):
+        return word in self.word2idx and word != PAD_TOKEN
+
+    def __getitem__(self, word):
+        if word not in self:
+            raise KeyError(word)
+        return self.matrix[self.word2idx[word]]
+
+    def get(self, word, default=None):
+        return self[word] if word in self else default
+
+
+def build_glove_matrix(dataset_name="Scanrefer", glove_path=GLOVE_PICKLE):
+    vocabulary = json.load(open(VOCAB.format(dataset_name)))
+    glove = pickle.load(open(glove_path, "rb"))
+    missing = [word for word in vocabulary["word2idx"] if word != PAD_TOKEN and word not in glove]
+    if len(missing) > 0:
+        print("no GloVe vector for {}, using the unk vector".format(missing))
+    matrix = build_embedding_matrix(vocabulary, glove)
+    np.save(GLOVE_MATRIX.format(dataset_name), matrix)
+    print("saved {} {} to {}".format(matrix.dtype, matrix.shape, GLOVE_MATRIX.format(dataset_name)))
+
+
+def load_glove(vocabulary, dataset_name="Scanrefer", mmap=True):
+    """ GloveMatrix over the memory-mapped <dataset>_glove.npy, or the full glove.p dict if it was not built """
+    matrix_path = GLOVE_MATRIX.format(dataset_name)
+    if not os.path.exists(matrix_path):
+        print("{} not found, loading {} (build it with python -m lib.glove)".format(matrix_path, GLOVE_PICKLE))
+        return pickle.load(open(GLOVE_PICKLE, "rb"))
+    matrix = np.load(matrix_path, mmap_mode="r" if mmap else None)
+    if matrix.shape[0] != len(vocabulary["word2idx"]):
+        raise ValueError("{} has {} rows but the vocabulary has {} words, rebuild it".format(
+            matrix_path, matrix.shape[0], len(vocabulary["word2idx"])))
+    return GloveMatrix(vocabulary, matrix)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset", default="Scanrefer", help="name used in <dataset>_vocabulary.json")
+    parser.add_argument("--glove", default=GLOVE_PICKLE, help="pickled GloVe dict")
+    opt = parser.parse_args()
+
+    build_glove_matrix(opt.dataset, opt.glove)
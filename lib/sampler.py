@@ -0,0 +1,160 @@
+'''
+Batch sampler that keeps the scenes of consecutive batches together.
+
+With shuffle=True over annotations every batch touches batch_size unrelated scenes, so the
+per-worker SceneCache (lib/scene_cache.py) and the OS page cache rarely see a scene twice before
+it is evicted. SceneLocalityBatchSampler shuffles the scenes every epoch, gives every DataLoader
+worker its own share of them and mixes the annotations of `window` consecutive scenes of a
+worker (the shuffle window) into that worker's batches. The batches are interleaved so that
+batch i goes to worker i % num_workers, which is how DataLoader hands out batches. That only holds
+while every worker has a batch in every round, so the worker streams are balanced to the same
+number of batches (the first total % num_workers workers get one more) by moving the last batches
+of the longer streams to the shorter ones.
+
+window=1 gives batches from a single scene, a large window approaches a plain shuffle.
+simulated_hit_rate is an estimate for choosing window: the share of scene lookups that would hit
+a per-worker LRU cache of cache_scenes scenes in the batch order of the last epoch (a count based
+stand-in for the byte budget of SceneCache). The hit rate of the real SceneCache of the workers is
+sent with every batch and logged by CapNet (data/scene_cache_hit_rate).
+
+Lightning calls set_epoch of the sampler and the batch sampler of the train DataLoader before every
+epoch, before the workers of the epoch are started. EpochRandomSampler (shuffle=True) and
+SceneLocalityBatchSampler pass it on to the dataset, whose scene mode regroups its targets then
+(ScannetReferenceDataset.set_epoch).
+'''
+
+from collections import OrderedDict
+
+import numpy as np
+from torch.utils.data import RandomSampler, Sampler
+
+
+def get_sample_scene_ids(dataset):
+    """ scene id of every sample of a ScannetReferenceDataset (per annotation or per scene chunk) """
+    if getattr(dataset, 'scene_chunks', None) is not None:
+        return [scene_id for scene_id, _ in dataset.scene_chunks]
+    return [data['scene_id'] for data in dataset.scanrefer]
+
+
+def simulate_hit_rate(batches, scene_ids, num_workers=1, cache_scenes=8):
+    """ share of scene lookups that hit an LRU cache of cache_scenes scenes per worker, batch i on worker i % num_workers """
+    caches = [OrderedDict() for _ in range(max(num_workers, 1))]
+    hits, lookups = 0, 0
+    for i, batch in enumerate(batches):
+        cache = caches[i % len(caches)]
+        for idx in batch:
+            scene_id = scene_ids[idx]
+            lookups += 1
+            if scene_id in cache:
+                hits += 1
+                cache.move_to_end(scene_id)
+            else:
+                cache[scene_id] = True
+                if len(cache) > cache_scenes:
+                    cache.popitem(last=False)
+    return hits / lookups if lookups > 0 else 0.
+
+
+class EpochRandomSampler(RandomSampler):
+    """ RandomSampler that passes set_epoch on to the dataset """
+
+    def set_epoch(self, epoch):
+        self.data_source.set_epoch(epoch)
+
+
+class SceneLocalityBatchSampler(Sampler):
+    """ batches of annotations from the same / recently used scenes, see the module docstring """
+
+    def __init__(self, scene_ids, batch_size, num_workers=1, window=2, drop_last=False, seed=0, cache_scenes=8,
+                 dataset=None):
+        self.scene_ids = scene_ids
+        self.batch_size = batch_size
+        self.num_workers = max(num_workers, 1)
+        self.window = window
+        self.drop_last = drop_last
+        self.seed = seed
+        self.cache_scenes = cache_scenes
+        self.dataset = dataset  # set_epoch is passed on to it
+        self.epoch = 0
+        self.simulated_hit_rate = None
+        self._batches = None  # (epoch, batches)
+        self._iterated = False  # __iter__ ran and set_epoch was not called since
+
+        self.scene_samples = OrderedDict()  # scene_id -> sample idxs
+        for idx, scene_id in enumerate(scene_ids):
+            self.scene_samples.setdefault(scene_id, []).append(idx)
+
+    def set_epoch(self, epoch):
+        """ same as DistributedSampler.set_epoch, otherwise every __iter__ after the first starts the next epoch """
+        self.epoch = epoch
+        self._iterated = False
+        if self.dataset is not None:
+            self.dataset.set_epoch(epoch)
+
+    def _get_worker_batches(self, scenes, rng):
+        batches = []
+        samples = []
+        for start in range(0, len(scenes), self.window):
+            window_samples = np.concatenate([self.scene_samples[scene_id] for scene_id in scenes[start:start + self.window]])
+            samples.extend(rng.permutation(window_samples).tolist())
+        for start in range(0, len(samples), self.batch_size):
+            batches.append(samples[start:start + self.batch_size])
+        return batches
+
+    def _balance(self, worker_batches):
+        """ streams with total // num_workers batches each, one more for the first total % num_workers of them """
+        worker_batches = sorted(worker_batches, key=len, reverse=True)
+        total = sum(len(b) for b in worker_batches)
+        sizes = [total // self.num_workers + (1 if w < total % self.num_workers else 0) for w in range(self.num_workers)]
+        surplus = []
+        for b, size in zip(worker_batches, sizes):
+            while len(b) > size:
+                surplus.append(b.pop())
+        for b, size in zip(worker_batches, sizes):
+            while len(b) < size:
+                b.append(surplus.pop())
+        return worker_batches
+
+    def get_batches(self):
+        """ batches of the current epoch, the same on every call until the epoch changes """
+        if self._batches is not None and self._batches[0] == self.epoch:
+            return self._batches[1]
+        rng = np.random.RandomState(self.seed + self.epoch)
+        scene_list = list(self.scene_samples.keys())
+        scenes = [scene_list[i] for i in rng.permutation(len(scene_list))]
+
+        # scenes go to the worker with the fewest samples so far, keeping the streams about the same length
+        worker_scenes = [[] for _ in range(self.num_workers)]
+        worker_sizes = np.zeros(self.num_workers, dtype=np.int64)
+        for scene_id in scenes:
+            worker = worker_sizes.argmin()
+            worker_scenes[worker].append(scene_id)
+            worker_sizes[worker] += len(self.scene_samples[scene_id])
+        worker_batches = [self._get_worker_batches(s, rng) for s in worker_scenes]
+        if self.drop_last:
+            worker_batches = [[batch for batch in b if len(batch) == self.batch_size] for b in worker_batches]
+        worker_batches = self._balance(worker_batches)
+
+        # round robin over the workers, only the first workers take part in the last round
+        batches = []
+        for i in range(max([len(b) for b in worker_batches])):
+            for b in worker_batches:
+                if i < len(b):
+                    batches.append(b[i])
+        self._batches = (self.epoch, batches)
+        return batches
+
+    def __iter__(self):
+        # the epoch only advances when the next one starts, so __len__ during an epoch is the one of the epoch
+        if self._iterated:
+            self.epoch += 1
+            if self.dataset is not None:
+                self.dataset.set_epoch(self.epoch)
+        self._iterated = True
+        batches = self.get_batches()
+        self.simulated_hit_rate = simulate_hit_rate(batches, self.scene_ids, self.num_workers, self.cache_scenes)
+        return iter(batches)
+
+    def __len__(self):
+        # every worker stream may end with a partial batch, so the count depends on the scene split of the epoch
+        return len(self.get_batches())
@@ -0,0 +1,88 @@
+'''
+LRU cache for decoded scene arrays with a byte budget.
+
+Used by ScannetReferenceDataset in lazy mode: scenes are only opened (memory mapped) on first
+access and the decoded arrays are kept here until the budget forces them out. Every DataLoader
+worker has its own cache, so the budget applies per process. collate_fn sends the counts of the
+worker's cache since its last batch with every batch (drain_counts), CapNet logs the hit rate.
+'''
+
+from collections import OrderedDict
+
+import numpy as np
+
+DEFAULT_CACHE_BYTES = 2 * 1024 ** 3
+
+
+def get_nbytes(value):
+    """ bytes held by the numpy arrays of a (nested) dict / list / tuple """
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(get_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(get_nbytes(v) for v in value)
+    return 0
+
+
+class SceneCache(object):
+    """ least recently used cache bounded by max_bytes, with hit / miss / eviction counters """
+
+    def __init__(self, max_bytes=DEFAULT_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (value, nbytes), most recently used last
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.drained = {'hits': 0, 'misses': 0, 'evictions': 0}  # counters at the last drain_counts
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, load_fn):
+        """ returns the cached value of key, calls load_fn() and caches the result on a miss """
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+        self.misses += 1
+        value = load_fn()
+        nbytes = get_nbytes(value)
+        if nbytes > self.max_bytes:
+            # larger than the whole budget, hand it out without caching
+            return value
+        while self.nbytes + nbytes > self.max_bytes:
+            _, (_, evicted_nbytes) = self.entries.popitem(last=False)
+            self.nbytes -= evicted_nbytes
+            self.evictions += 1
+        self.entries[key] = (value, nbytes)
+        self.nbytes += nbytes
+        return value
+
+    def drain_counts(self):
+        """ {'hits', 'misses', 'evictions'} since the last call """
+        counts = {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+        delta = {k: v - self.drained[k] for k, v in counts.items()}
+        self.drained = counts
+        return delta
+
+    def clear(self):
+        self.entries.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / total if total > 0 else 0.,
+            'entries': len(self.entries),
+            'nbytes': self.nbytes,
+            'max_bytes': self.max_bytes,
+        }
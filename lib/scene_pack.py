@@ -0,0 +1,343 @@
+'''
+Packed container for the preprocessed ScanNet scenes.
+
+All arrays of a scene live in one file instead of six separate .npy files, so loading a scene
+costs a single open + mmap. Layout of a pack file:
+
+    magic (8 bytes) | header length (uint64, little endian) | json header | array data
+
+The json header stores dtype, shape and offset of every array plus free-form meta data.
+Array offsets are relative to the start of the data section, which as well as every array
+starts at a multiple of PACK_ALIGNMENT bytes, so the reader can hand out zero-copy views.
+
+A shard (SceneShard) is a pack holding the concatenated arrays of many scenes plus per-scene
+(start, length) offset tables, so a whole split is a single file served as slices of one memory map.
+
+With profile="compact" vertices are stored as int16 millimetre coordinates relative to a per-scene
+origin plus uint8 colors, semantic labels as uint8 and instance labels as uint16. The maximum
+reconstruction error is printed and kept in the meta data, decode_vertices() restores float32 xyz+rgb.
+
+Convert an existing scannet_data/ folder with:
+    python -m lib.scene_pack --input data/scannet/scannet_data --output data/scannet/scannet_packed
+or build a single shard with:
+    python -m lib.scene_pack --input data/scannet/scannet_data --shard data/scannet/scannet_shard.pack
+add --profile compact to either command for the quantized encoding.
+'''
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+
+sys.path.append(os.path.join(os.getcwd(), "lib"))  # HACK add the lib folder
+from lib.config import CONF
+
+PACK_MAGIC = b'SCNPACK1'
+PACK_ALIGNMENT = 64
+PACK_SUFFIX = '.pack'
+
+# array name in the pack -> suffix of the .npy file written by batch_load_scannet_data.py
+SCENE_ARRAYS = {
+    'vert': '_vert.npy',
+    'aligned_vert': '_aligned_vert.npy',
+    'sem_label': '_sem_label.npy',
+    'ins_label': '_ins_label.npy',
+    'bbox': '_bbox.npy',
+    'aligned_bbox': '_aligned_bbox.npy',
+}
+
+# vertex arrays (xyz+rgb) which the compact profile splits into <name>_xyz, <name>_rgb and <name>_origin
+VERTEX_ARRAYS = ['vert', 'aligned_vert']
+COMPACT_SCALE = 1000.0  # 坐标量化到毫米
+COMPACT_LABEL_DTYPES = {'sem_label': np.uint8, 'ins_label': np.uint16}
+
+
+def _align(offset, alignment=PACK_ALIGNMENT):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def create_pack(path, specs, meta=None):
+    """ lay out a pack file for {name: (dtype, shape)} and return ({name: writable view}, memory map),
+    lets large packs be filled piece by piece without holding all arrays in memory
+    """
+    header = {'arrays': {}, 'meta': meta if meta is not None else {}}
+    offset = 0
+    for name, (dtype, shape) in specs.items():
+        dtype = np.dtype(dtype)
+        header['arrays'][name] = {'dtype': dtype.str, 'shape': [int(x) for x in shape], 'offset': offset}
+        offset = _align(offset + dtype.itemsize * int(np.prod(shape)))
+    header_bytes = json.dumps(header).encode()
+    data_start = _align(len(PACK_MAGIC) + 8 + len(header_bytes))
+
+    with open(path, 'wb') as f:
+        f.write(PACK_MAGIC)
+        f.write(len(header_bytes).to_bytes(8, 'little'))
+        f.write(header_bytes)
+        f.truncate(data_start + max(offset, 1))
+    buf = np.memmap(path, dtype=np.uint8, mode='r+')
+
+    views = {}
+    for name, info in header['arrays'].items():
+        dtype = np.dtype(info['dtype'])
+        start = data_start + info['offset']
+        nbytes = dtype.itemsize * int(np.prod(info['shape']))
+        views[name] = buf[start:start + nbytes].view(dtype).reshape(info['shape'])
+    return views, buf
+
+
+def write_pack(path, arrays, meta=None):
+    """ write a dict of numpy arrays (and json-serializable meta data) into a single pack file """
+    # write to a temp file first so that readers never see a half-written pack
+    tmp_path = path + '.tmp'
+    views, buf = create_pack(tmp_path, {name: (arr.dtype, arr.shape) for name, arr in arrays.items()}, meta)
+    for name, arr in arrays.items():
+        views[name][...] = arr
+    buf.flush()
+    del views, buf
+    os.replace(tmp_path, path)
+
+
+def read_pack_header(path):
+    with open(path, 'rb') as f:
+        magic = f.read(len(PACK_MAGIC))
+        if magic != PACK_MAGIC:
+            raise ValueError('{} is not a scene pack file'.format(path))
+        header_len = int.from_bytes(f.read(8), 'little')
+        header = json.loads(f.read(header_len).decode())
+    return header, _align(len(PACK_MAGIC) + 8 + header_len)
+
+
+def read_pack(path, mmap=True):
+    """ returns ({name: array}, meta), with mmap=True the arrays are read-only views into one memory map """
+    header, data_start = read_pack_header(path)
+    if mmap:
+        buf = np.memmap(path, dtype=np.uint8, mode='r')
+    else:
+        buf = np.fromfile(path, dtype=np.uint8)
+
+    arrays = {}
+    for name, info in header['arrays'].items():
+        dtype = np.dtype(info['dtype'])
+        shape = tuple(info['shape'])
+        start = data_start + info['offset']
+        nbytes = dtype.itemsize * int(np.prod(shape))
+        arrays[name] = buf[start:start + nbytes].view(dtype).reshape(shape)
+    return arrays, header['meta']
+
+
+def get_scene_pack_path(scene_id, pack_dir=CONF.PATH.SCANNET_PACKED):
+    return os.path.join(pack_dir, scene_id + PACK_SUFFIX)
+
+
+def pack_scene(scene_id, input_dir=CONF.PATH.SCANNET_DATA, output_dir=CONF.PATH.SCANNET_PACKED, profile='full'):
+    """ returns the max reconstruction error of the compact profile, {} for the full one """
+    arrays = {name: np.load(os.path.join(input_dir, scene_id) + suffix) for name, suffix in SCENE_ARRAYS.items()}
+    meta = {'scene_id': scene_id, 'profile': profile}
+    max_error = {}
+    if profile == 'compact':
+        arrays, max_error = encode_compact(arrays)
+        meta['max_error'] = max_error
+    elif profile != 'full':
+        raise ValueError('unknown profile: {}'.format(profile))
+    write_pack(get_scene_pack_path(scene_id, output_dir), arrays, meta=meta)
+    return max_error
+
+
+def encode_vertices(vertices):
+    """ float xyz+rgb -> int16 xyz in mm relative to the returned origin, uint8 rgb, origin """
+    xyz = vertices[:, 0:3].astype(np.float64)
+    if len(xyz) > 0:
+        origin = np.round((xyz.min(0) + xyz.max(0)) / 2 * COMPACT_SCALE) / COMPACT_SCALE
+    else:
+        origin = np.zeros(3)
+    xyz = np.round((xyz - origin) * COMPACT_SCALE)
+    if len(xyz) > 0 and np.abs(xyz).max() > np.iinfo(np.int16).max:
+        raise ValueError('scene extent exceeds the int16 millimetre range of the compact profile')
+    rgb = np.clip(np.round(vertices[:, 3:6]), 0, 255)
+    return xyz.astype(np.int16), rgb.astype(np.uint8), origin
+
+
+def decode_vertices(xyz, rgb, origin):
+    """ inverse of encode_vertices, returns float32 xyz+rgb like the *_vert.npy files """
+    vertices = np.empty((len(xyz), 6), dtype=np.float32)
+    vertices[:, 0:3] = xyz * (1.0 / COMPACT_SCALE) + origin
+    vertices[:, 3:6] = rgb
+    return vertices
+
+
+def encode_compact(arrays):
+    """ compact profile of the arrays of one scene, returns (arrays, {name: max abs reconstruction error}) """
+    arrays = dict(arrays)
+    max_error = {}
+    for name in VERTEX_ARRAYS:
+        if name not in arrays:
+            continue
+        vertices = arrays.pop(name)
+        xyz, rgb, origin = encode_vertices(vertices)
+        error = np.abs(decode_vertices(xyz, rgb, origin) - vertices)
+        max_error[name + '_xyz'] = float(error[:, 0:3].max()) if len(error) > 0 else 0.
+        max_error[name + '_rgb'] = float(error[:, 3:6].max()) if len(error) > 0 else 0.
+        arrays[name + '_xyz'], arrays[name + '_rgb'], arrays[name + '_origin'] = xyz, rgb, origin
+    for name, dtype in COMPACT_LABEL_DTYPES.items():
+        if name not in arrays:
+            continue
+        if len(arrays[name]) > 0 and arrays[name].max() > np.iinfo(dtype).max:
+            raise ValueError('{} does not fit into {}'.format(name, np.dtype(dtype).name))
+        arrays[name] = arrays[name].astype(dtype)
+    return arrays, max_error
+
+
+def _merge_max_error(total, max_error):
+    for name, error in max_error.items():
+        total[name] = max(total.get(name, 0.), error)
+    return total
+
+
+def load_packed_scene(scene_id, pack_dir=CONF.PATH.SCANNET_PACKED, mmap=True):
+    arrays, _ = read_pack(get_scene_pack_path(scene_id, pack_dir), mmap=mmap)
+    return arrays
+
+
+# arrays concatenated into a shard, indexed by vert_offsets and bbox_offsets respectively
+SHARD_POINT_ARRAYS = ['aligned_vert', 'sem_label', 'ins_label']
+SHARD_BBOX_ARRAYS = ['aligned_bbox']
+# compact profile: per-point arrays after encode_compact, plus one row per scene for the origin
+SHARD_COMPACT_POINT_ARRAYS = ['aligned_vert_xyz', 'aligned_vert_rgb', 'sem_label', 'ins_label']
+SHARD_COMPACT_SCENE_ARRAYS = ['aligned_vert_origin']
+
+
+class SceneShard(object):
+    """ all scenes of a shard built by build_shard, every scene is a set of slices of one memory map """
+
+    def __init__(self, path=CONF.PATH.SCANNET_SHARD):
+        self.path = path
+        self.arrays, self.meta = read_pack(path)
+        self.scene_ids = self.meta['scene_ids']
+        self.scene_index = {scene_id: i for i, scene_id in enumerate(self.scene_ids)}
+        self.profile = self.meta.get('profile', 'full')
+        if self.profile == 'compact':
+            self.point_arrays, self.scene_arrays = SHARD_COMPACT_POINT_ARRAYS, SHARD_COMPACT_SCENE_ARRAYS
+        else:
+            self.point_arrays, self.scene_arrays = SHARD_POINT_ARRAYS, []
+        self.max_error = {name: float(error) for name, error in
+                          zip(self.meta.get('max_error_names', []), self.arrays.get('max_error', []))}
+
+    def __len__(self):
+        return len(self.scene_ids)
+
+    def __contains__(self, scene_id):
+        return scene_id in self.scene_index
+
+    def get_scene(self, scene_id):
+        """ same keys as load_packed_scene, restricted to the arrays stored in the shard """
+        i = self.scene_index[scene_id]
+        start, length = self.arrays['vert_offsets'][i]
+        bbox_start, bbox_length = self.arrays['bbox_offsets'][i]
+        scene = {name: self.arrays[name][start:start + length] for name in self.point_arrays}
+        scene.update({name: self.arrays[name][bbox_start:bbox_start + bbox_length] for name in SHARD_BBOX_ARRAYS})
+        scene.update({name: self.arrays[name][i] for name in self.scene_arrays})
+        return scene
+
+
+def build_shard(scene_ids, output_path=CONF.PATH.SCANNET_SHARD, input_dir=CONF.PATH.SCANNET_DATA, profile='full'):
+    """ concatenate the arrays the dataset loads of every scene into one pack with a global offset index """
+    if profile not in ('full', 'compact'):
+        raise ValueError('unknown profile: {}'.format(profile))
+    names = SHARD_POINT_ARRAYS + SHARD_BBOX_ARRAYS
+    # first pass only reads the .npy headers to size the shard
+    sources = {scene_id: {name: np.load(os.path.join(input_dir, scene_id) + SCENE_ARRAYS[name], mmap_mode='r')
+                          for name in names} for scene_id in scene_ids}
+    vert_offsets = np.zeros((len(scene_ids), 2), dtype=np.int64)
+    bbox_offsets = np.zeros((len(scene_ids), 2), dtype=np.int64)
+    num_verts, num_bboxes = 0, 0
+    for i, scene_id in enumerate(scene_ids):
+        vert_offsets[i] = num_verts, sources[scene_id]['aligned_vert'].shape[0]
+        bbox_offsets[i] = num_bboxes, sources[scene_id]['aligned_bbox'].shape[0]
+        num_verts += vert_offsets[i, 1]
+        num_bboxes += bbox_offsets[i, 1]
+
+    def get_arrays(scene_id):
+        arrays = sources[scene_id]
+        if profile == 'compact':
+            return encode_compact(arrays)
+        return arrays, {}
+
+    if profile == 'compact':
+        point_arrays, scene_arrays = SHARD_COMPACT_POINT_ARRAYS, SHARD_COMPACT_SCENE_ARRAYS
+    else:
+        point_arrays, scene_arrays = SHARD_POINT_ARRAYS, []
+    # dtypes and trailing dimensions are taken from the (encoded) first scene
+    first, first_max_error = get_arrays(scene_ids[0])
+    error_names = sorted(first_max_error.keys())
+    specs = {name: (first[name].dtype, (num_verts,) + first[name].shape[1:]) for name in point_arrays}
+    specs.update({name: (first[name].dtype, (num_bboxes,) + first[name].shape[1:]) for name in SHARD_BBOX_ARRAYS})
+    specs.update({name: (first[name].dtype, (len(scene_ids),) + first[name].shape) for name in scene_arrays})
+    specs['vert_offsets'] = (vert_offsets.dtype, vert_offsets.shape)
+    specs['bbox_offsets'] = (bbox_offsets.dtype, bbox_offsets.shape)
+    # the error is only known after encoding every scene, so it is stored as an array rather than in the header
+    specs['max_error'] = (np.float64, (len(error_names),))
+
+    tmp_path = output_path + '.tmp'
+    meta = {'scene_ids': list(scene_ids), 'profile': profile, 'max_error_names': error_names}
+    views, buf = create_pack(tmp_path, specs, meta=meta)
+    views['vert_offsets'][...] = vert_offsets
+    views['bbox_offsets'][...] = bbox_offsets
+    max_error = {}
+    for i, scene_id in enumerate(scene_ids):
+        arrays, scene_max_error = get_arrays(scene_id)
+        _merge_max_error(max_error, scene_max_error)
+        (start, length), (bbox_start, bbox_length) = vert_offsets[i], bbox_offsets[i]
+        for name in point_arrays:
+            views[name][start:start + length] = arrays[name]
+        for name in SHARD_BBOX_ARRAYS:
+            views[name][bbox_start:bbox_start + bbox_length] = arrays[name]
+        for name in scene_arrays:
+            views[name][i] = arrays[name]
+    views['max_error'][...] = [max_error[name] for name in error_names]
+    buf.flush()
+    del views, buf
+    os.replace(tmp_path, output_path)
+    print('built shard {} with {} scenes, {} points, {} boxes'.format(output_path, len(scene_ids), num_verts, num_bboxes))
+    if profile == 'compact':
+        print('max reconstruction error: {}'.format(max_error))
+    return max_error
+
+
+def list_scenes(input_dir=CONF.PATH.SCANNET_DATA):
+    suffix = SCENE_ARRAYS['vert']
+    return sorted([f[:-len(suffix)] for f in os.listdir(input_dir)
+                   if f.endswith(suffix) and not f.endswith(SCENE_ARRAYS['aligned_vert'])])
+
+
+def pack_scannet_data(input_dir=CONF.PATH.SCANNET_DATA, output_dir=CONF.PATH.SCANNET_PACKED, scene_ids=None,
+                      profile='full'):
+    """ convert the per-array .npy files of every scene in input_dir into one pack file per scene """
+    if scene_ids is None:
+        scene_ids = list_scenes(input_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    max_error = {}
+    for i, scene_id in enumerate(scene_ids):
+        _merge_max_error(max_error, pack_scene(scene_id, input_dir, output_dir, profile))
+        print('packed {} ({}/{})'.format(scene_id, i + 1, len(scene_ids)))
+    if profile == 'compact':
+        print('max reconstruction error: {}'.format(max_error))
+    return max_error
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--input', default=CONF.PATH.SCANNET_DATA, help='folder with the exported *_vert.npy etc.')
+    parser.add_argument('--output', default=CONF.PATH.SCANNET_PACKED, help='folder for the .pack files')
+    parser.add_argument('--shard', default=None, help='build a single shard file at this path instead')
+    parser.add_argument('--profile', default='full', choices=['full', 'compact'], help='storage profile')
+    parser.add_argument('--scene_list', default=None, help='text file with one scene id per line, default all scenes')
+    opt = parser.parse_args()
+
+    scene_ids = None
+    if opt.scene_list is not None:
+        scene_ids = [line.strip() for line in open(opt.scene_list) if line.strip()]
+    if opt.shard is not None:
+        build_shard(scene_ids if scene_ids is not None else list_scenes(opt.input), opt.shard, opt.input, opt.profile)
+    else:
+        pack_scannet_data(opt.input, opt.output, scene_ids, opt.profile)
@@ -0,0 +1,113 @@
+'''
+Prepared scenes in one shared memory buffer, read by every DataLoader worker without a copy.
+
+The prepared scenes of ScannetReferenceDataset are per process: in lazy mode every worker
+prepares and holds its own copy in its SceneCache (lib/scene_cache.py), otherwise the workers
+inherit scene_data through fork and the refcount updates on its arrays break copy-on-write for
+the pages they sit on. SharedSceneStore is filled once by the main process (create) with the
+output of ScannetReferenceDataset._prepare_scene. All arrays live in one shared uint8 torch
+tensor and the workers only hold read-only numpy views of it. With fork the views are inherited
+as they are; DataLoader workers started with spawn get the store through the multiprocessing
+pickler, for which torch sends a handle of the shared memory instead of the data, and the views
+are made again in __setstate__ (a plain pickle copies the buffer).
+
+create prepares every scene twice, once to size the buffer and once to copy it in, so the main
+process never holds more than one prepared scene next to the buffer.
+
+Lifetime: the memory is freed by torch when the last tensor / numpy view of it is gone in all
+processes. close() drops the references of the store in this process; views handed out by get
+stay valid as long as they are referenced.
+'''
+
+import numpy as np
+import torch
+
+ALIGNMENT = 64  # byte alignment of every array in the buffer
+
+
+def _view(buffer, offset, dtype, shape):
+    """ numpy array at byte offset of the uint8 buffer, shares its memory (and keeps it alive) """
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    return buffer.numpy()[offset:offset + nbytes].view(dtype).reshape(shape)
+
+
+class SharedSceneStore(object):
+    """ read-only dicts of prepared scene arrays (and plain python values) in one shared memory buffer """
+
+    def __init__(self, buffer, layout, values):
+        """ use create, or pickle the store to attach another process """
+        self.buffer = buffer  # shared uint8 tensor
+        self.layout = layout  # scene_id -> {key: (offset, dtype str, shape)}
+        self.values = values  # scene_id -> {key: value} of the non array entries
+        self.scenes = self._make_views()
+
+    @classmethod
+    def create(cls, scene_ids, load_fn):
+        """ load_fn(scene_id) -> dict of numpy arrays / python values, called twice per scene in this process """
+        layout, values = {}, {}
+        size = 0
+        for scene_id in scene_ids:
+            # sizing pass, only the shapes are kept
+            layout[scene_id], values[scene_id] = {}, {}
+            for key, value in load_fn(scene_id).items():
+                if isinstance(value, np.ndarray):
+                    layout[scene_id][key] = (size, value.dtype.str, value.shape)
+                    size += -(-value.nbytes // ALIGNMENT) * ALIGNMENT
+                else:
+                    values[scene_id][key] = value
+
+        buffer = torch.empty(max(size, 1), dtype=torch.uint8).share_memory_()
+        for scene_id in scene_ids:
+            scene = load_fn(scene_id)
+            for key, (offset, dtype, shape) in layout[scene_id].items():
+                if scene[key].dtype.str != dtype or scene[key].shape != shape:
+                    raise ValueError('scene {} changed between the two calls of load_fn: {} {} {} != {} {}'.format(
+                        scene_id, key, scene[key].dtype.str, scene[key].shape, dtype, shape))
+                _view(buffer, offset, dtype, shape)[...] = scene[key]
+            del scene
+        return cls(buffer, layout, values)
+
+    def _make_views(self):
+        scenes = {}
+        for scene_id, arrays in self.layout.items():
+            scene = dict(self.values[scene_id])
+            for key, (offset, dtype, shape) in arrays.items():
+                view = _view(self.buffer, offset, dtype, shape)
+                view.setflags(write=False)
+                scene[key] = view
+            scenes[scene_id] = scene
+        return scenes
+
+    def __len__(self):
+        return len(self.layout)
+
+    def __contains__(self, scene_id):
+        return scene_id in self.layout
+
+    def get(self, scene_id):
+        """ the prepared scene, the arrays are read-only views of the buffer """
+        if self.scenes is None:
+            raise ValueError('shared scene store is closed')
+        return self.scenes[scene_id]
+
+    @property
+    def nbytes(self):
+        return self.buffer.numel() if self.buffer is not None else 0
+
+    def close(self):
+        """ drops the buffer and the views of the store in this process; get fails afterwards """
+        self.scenes = None
+        self.buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getstate__(self):
+        return {'buffer': self.buffer, 'layout': self.layout, 'values': self.values}
+
+    def __setstate__(self, state):
+        self.__init__(state['buffer'], state['layout'], state['values'])
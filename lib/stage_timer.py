@@ -0,0 +1,63 @@
+'''
+Per-stage timing of the data pipeline.
+
+ScannetReferenceDataset times the stages of __getitem__ (scene fetch, sampling, augmentation,
+getInstanceInfo, label / box assembly) and of collate_fn (merge, batch elastic, voxelization_idx)
+with StageTimer.lap, which costs one perf_counter call per stage. collate_fn runs in the same
+DataLoader worker as the __getitem__ calls of its batch, so it drains the worker's timer into
+batch['stage_times']; the training process merges them (CapNet.training_step) and logs the
+percentiles of a sliding window over all workers.
+'''
+
+import time
+from collections import deque
+
+import numpy as np
+
+DEFAULT_WINDOW = 1000  # recent values kept per stage
+DEFAULT_PERCENTILES = (50, 90, 99)
+
+
+class StageTimer(object):
+    """ seconds per stage, start() then lap(stage) after each stage """
+
+    def __init__(self, window=DEFAULT_WINDOW):
+        self.window = window
+        self.times = {}  # stage -> deque of seconds
+        self.last = None
+
+    def start(self):
+        self.last = time.perf_counter()
+
+    def lap(self, stage):
+        """ records the time since the last start / lap as stage """
+        now = time.perf_counter()
+        self.add(stage, now - self.last)
+        self.last = now
+
+    def add(self, stage, seconds):
+        if stage not in self.times:
+            self.times[stage] = deque(maxlen=self.window)
+        self.times[stage].append(seconds)
+
+    def drain(self):
+        """ {stage: [seconds, ...]} recorded since the last drain, the timer is empty afterwards """
+        times = {stage: list(values) for stage, values in self.times.items()}
+        self.times = {}
+        return times
+
+    def merge(self, times):
+        """ adds the output of drain of another timer (e.g. of a DataLoader worker) """
+        for stage, values in times.items():
+            for seconds in values:
+                self.add(stage, seconds)
+
+    def percentiles(self, percentiles=DEFAULT_PERCENTILES):
+        """ {'<stage>_p<q>': milliseconds} over the window of every stage """
+        stats = {}
+        for stage, values in self.times.items():
+            if len(values) == 0:
+                continue
+            for q, value in zip(percentiles, np.percentile(np.array(values), percentiles)):
+                stats['{}_p{}'.format(stage, q)] = float(value) * 1000
+        return stats
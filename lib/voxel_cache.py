@@ -0,0 +1,148 @@
+'''
+Cache of per-scene voxelization results for deterministic splits.
+
+With augment=False and no random point sampling (val/test), transform_test produces the same
+coord for a scene in every epoch, so voxelization_idx gives the same voxel_coords, v2p_map and
+p2v_map each time. VoxelizationCache computes them once per scene (in the dataloader workers,
+on the first epoch or offline with build_voxel_cache) and keeps them in memory and optionally
+as .npz files keyed by scene id and voxel config (scale, spatial_shape).
+
+voxelization_idx numbers voxels in order of first occurrence and the scenes of a batch never
+share voxels (different batch index), so the result of a batch is the concatenation of the
+per-scene results with voxel / point indices shifted, see merge_voxelizations.
+'''
+
+import os
+import sys
+import zlib
+import numpy as np
+import torch
+
+from ops import voxelization_idx
+
+sys.path.append(os.path.join(os.getcwd(), "lib"))  # HACK add the lib folder
+from lib.config import CONF
+
+
+def get_voxel_cache_key(voxel_cfg):
+    return 'scale{}_shape{}'.format(voxel_cfg.scale, '-'.join([str(s) for s in voxel_cfg.spatial_shape]))
+
+
+def _checksum(coord):
+    return zlib.crc32(np.ascontiguousarray(coord.numpy()).tobytes())
+
+
+def voxelize_scene(coord):
+    """ voxelization_idx of a single scene, coord: long (N, 3) -> voxel_coords (M, 3), v2p_map (N), p2v_map (M, 1 + maxActive) """
+    coords = torch.cat([coord.new_zeros((coord.size(0), 1)), coord], 1).contiguous()
+    voxel_coords, v2p_map, p2v_map = voxelization_idx(coords, 1)
+    return voxel_coords[:, 1:].contiguous(), v2p_map, p2v_map
+
+
+class VoxelizationCache(object):
+    """ per-scene voxelization results, in memory and (with cache_dir) on disk """
+
+    def __init__(self, voxel_cfg=CONF.voxel_cfg, cache_dir=None):
+        self.key = get_voxel_cache_key(voxel_cfg)
+        self.cache_dir = os.path.join(cache_dir, self.key) if cache_dir is not None else None
+        self.entries = {}
+
+    def _get_path(self, scene_id):
+        return os.path.join(self.cache_dir, scene_id + '.npz')
+
+    def _load(self, scene_id):
+        if self.cache_dir is None or not os.path.exists(self._get_path(scene_id)):
+            return None
+        data = np.load(self._get_path(scene_id))
+        return {
+            'checksum': int(data['checksum']),
+            'voxel_coords': torch.from_numpy(data['voxel_coords']),
+            'v2p_map': torch.from_numpy(data['v2p_map']),
+            'p2v_map': torch.from_numpy(data['p2v_map']),
+        }
+
+    def _save(self, scene_id, entry):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # several workers may write the same scene, the last os.replace wins and every version is identical
+        tmp_path = '{}.{}.tmp.npz'.format(self._get_path(scene_id)[:-len('.npz')], os.getpid())
+        np.savez(tmp_path, checksum=entry['checksum'], voxel_coords=entry['voxel_coords'].numpy(),
+                 v2p_map=entry['v2p_map'].numpy(), p2v_map=entry['p2v_map'].numpy())
+        os.replace(tmp_path, self._get_path(scene_id))
+
+    def get(self, scene_id, coord):
+        """ returns (voxel_coords, v2p_map, p2v_map) of the scene, recomputed if coord changed since caching """
+        checksum = _checksum(coord)
+        entry = self.entries.get(scene_id)
+        if entry is None:
+            entry = self._load(scene_id)
+        if entry is None or entry['checksum'] != checksum:
+            voxel_coords, v2p_map, p2v_map = voxelize_scene(coord)
+            entry = {'checksum': checksum, 'voxel_coords': voxel_coords, 'v2p_map': v2p_map, 'p2v_map': p2v_map}
+            if self.cache_dir is not None:
+                self._save(scene_id, entry)
+        self.entries[scene_id] = entry
+        return entry['voxel_coords'], entry['v2p_map'], entry['p2v_map']
+
+
+def merge_voxelizations(voxelizations):
+    """ same result as voxelization_idx on the concatenated batch, voxelizations: list of per-scene results in batch order """
+    voxel_coords, v2p_maps, p2v_maps = [], [], []
+    max_active = max([p2v_map.size(1) - 1 for _, _, p2v_map in voxelizations])
+    num_points, num_voxels = 0, 0
+    for batch_id, (voxel_coord, v2p_map, p2v_map) in enumerate(voxelizations):
+        voxel_coords.append(torch.cat([voxel_coord.new_full((voxel_coord.size(0), 1), batch_id), voxel_coord], 1))
+        v2p_maps.append(v2p_map + num_voxels)
+
+        # rows are (count, point idx * count, zero padding up to max_active)
+        p2v_map_merged = p2v_map.new_zeros((p2v_map.size(0), max_active + 1))
+        p2v_map_merged[:, :p2v_map.size(1)] = p2v_map
+        valid = torch.arange(1, max_active + 1)[None, :] <= p2v_map[:, 0:1].long()
+        p2v_map_merged[:, 1:][valid] += num_points
+        p2v_maps.append(p2v_map_merged)
+
+        num_points += v2p_map.size(0)
+        num_voxels += voxel_coord.size(0)
+    return torch.cat(voxel_coords, 0), torch.cat(v2p_maps, 0), torch.cat(p2v_maps, 0)
+
+
+def voxelize_batch(coords):
+    """ same result as voxelization_idx(coords, batch_size) with torch ops, on the device of coords,
+    coords: long (N, 1 + 3) with the batch idx in coords[:, 0]
+
+    Voxels are numbered in order of first occurrence like voxelization_idx, the point indices of a
+    row of p2v_map are in increasing order.
+    """
+    num_points = coords.size(0)
+    # row-major index of every point in the (batch, x, y, z) grid
+    extent = coords.max(0)[0] + 1
+    strides = torch.flip(torch.cumprod(torch.flip(torch.cat([extent[1:], extent.new_ones(1)]), [0]), 0), [0])
+    keys, inverse = torch.unique((coords * strides).sum(1), return_inverse=True)
+    num_voxels = keys.numel()
+    point_idxs = torch.arange(num_points, device=coords.device)
+    first = torch.full((num_voxels,), num_points, dtype=torch.long, device=coords.device)
+    first = first.scatter_reduce(0, inverse, point_idxs, 'amin')
+    first, order = torch.sort(first)
+    rank = torch.empty_like(order)
+    rank[order] = torch.arange(num_voxels, device=coords.device)
+    v2p_map = rank[inverse]  # voxel of every point
+
+    # rows are (count, point idxs, zero padding up to max_active)
+    counts = torch.bincount(v2p_map, minlength=num_voxels)
+    point_order = torch.argsort(v2p_map, stable=True)
+    starts = counts.cumsum(0) - counts
+    slots = point_idxs - starts[v2p_map[point_order]]
+    p2v_map = torch.zeros((num_voxels, int(counts.max()) + 1), dtype=torch.int, device=coords.device)
+    p2v_map[:, 0] = counts.int()
+    p2v_map[v2p_map[point_order], slots + 1] = point_order.int()
+    return coords[first], v2p_map.int(), p2v_map
+
+
+def build_voxel_cache(dataset, cache_dir):
+    """ offline build of the on-disk cache, runs __getitem__ once for the first description of every scene """
+    first_idx = {}
+    for idx, data in enumerate(dataset.scanrefer):
+        first_idx.setdefault(data['scene_id'], idx)
+    cache = VoxelizationCache(dataset.voxel_cfg, cache_dir)
+    for i, (scene_id, idx) in enumerate(first_idx.items()):
+        cache.get(scene_id, dataset[idx]['coord'])
+        print('cached voxelization of {} ({}/{})'.format(scene_id, i + 1, len(first_idx)))
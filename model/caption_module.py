@@ -8,6 +8,7 @@ import numpy as np
 sys.path.append(os.path.join(os.getcwd()))  # HACK add the root folder
 from data.scannet.model_util_scannet import ScannetDatasetConfig
 from lib.config import CONF
+from lib.glove import build_embedding_matrix
 from utils.box_util import box3d_iou_batch_tensor
 
 # constants
@@ -66,6 +67,23 @@ class CaptionModule(nn.Module):
         # 输出分类层
         self.classifier = nn.Linear(emb_size, self.num_vocabs)
 
+        # 冻结的词向量表，dataset只提供lang_ids（没有lang_feat）时用它查出词向量
+        self.word_embedding = nn.Embedding.from_pretrained(
+            torch.from_numpy(build_embedding_matrix(vocabulary, embeddings, emb_size)), freeze=True, padding_idx=0)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints saved before word_embedding existed: keep the table built from the vocabulary
+        key = prefix + "word_embedding.weight"
+        if key not in state_dict:
+            state_dict[key] = self.word_embedding.weight.detach().clone()
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def get_word_embs(self, data_dict):
+        """ batch_size, max_len, emb_size word embeddings, from lang_feat or by looking up lang_ids """
+        if data_dict.get("lang_feat") is not None:
+            return data_dict["lang_feat"]
+        return self.word_embedding(data_dict["lang_ids"].to(self.word_embedding.weight.device))
+
     def step(self, step_input, hidden, cell):
         (hidden, cell) = self.recurrent_cell(step_input, (hidden, cell))  # num_proposals, emb_size
 
@@ -116,10 +134,13 @@ class CaptionModule(nn.Module):
     def forward_sample_batch(self, data_dict, max_len=CONF.TRAIN.MAX_DES_LEN, min_iou=CONF.TRAIN.MIN_IOU_THRESHOLD):
         """
         generate descriptions based on input tokens and object features
+
+        one row per description target: batch_size here is the number of targets, which in scene mode
+        (dataset targets_per_scene > 0) covers all targets of every scene of the backbone batch
         """
 
         # unpack
-        word_embs = data_dict["lang_feat"].cuda()  # batch_size, max_len, emb_size
+        word_embs = self.get_word_embs(data_dict).cuda()  # batch_size, max_len, emb_size
         des_lens = data_dict["lang_len"].cuda()  # batch_size
         obj_feats = data_dict["select_feats"].cuda()  # batch_size, feat_size
 
@@ -182,7 +203,7 @@ class CaptionModule(nn.Module):
         """
 
         # unpack
-        word_embs = data_dict["lang_feat"]  # batch_size, max_len, emb_size
+        word_embs = self.get_word_embs(data_dict)  # batch_size, max_len, emb_size
         des_lens = data_dict["lang_len"]  # batch_size
         obj_feats = data_dict["clus_feats_batch"]  # batch_size, num_proposals, feat_size
 
@@ -98,54 +98,58 @@ class SoftGroup(nn.Module):
                 if isinstance(m, nn.BatchNorm1d):
                     m.eval()
 
-    def select_feat(self, proposals_idx, proposal_each_scene, instance_labels, object_id, batch_size):
+    def select_feat(self, proposals_idx, proposal_each_scene, instance_labels, object_id, batch_size, batch_idxs,
+                    target_batch_idxs=None):
+        # 每个描述目标（object_id[t]，属于场景target_batch_idxs[t]）在其场景的proposal中选取和ref物体iou最大的一个
+        # target_batch_idxs为None时每个场景一个目标，即target t属于场景t
+        # 各场景的点数可以不同（voxel/fps采样、crop），点在场景内的下标由batch_idxs得到
+        if target_batch_idxs is None:
+            target_batch_idxs = torch.arange(batch_size)
+        target_batch_idxs = target_batch_idxs.long().cpu()
+        num_targets = target_batch_idxs.shape[0]
         proposal_id_offset = np.zeros(batch_size + 1).astype(np.int64)
-        good_clu_masks = torch.zeros(batch_size).bool().cuda()
+        good_clu_masks = torch.zeros(num_targets).bool().cuda()
         for i in range(batch_size + 1):
             proposal_id_offset[i] = sum(proposal_each_scene[0:i])
-        # print('proposal_each_scene')
-        # print(proposal_each_scene)
-        # print('proposal_id_offset:')
-        # print(proposal_id_offset)
         proposal_num = sum(proposal_each_scene)  # proposal总数量
-        npoint = int(instance_labels.shape[0] / batch_size)  # 每个batch中点的数量，例如40000
-
-        # 获取该batch中的ref_cluster (B,npoint) 如（4，40000）,为节约内存用bytetensor
-        ref_cluster = torch.zeros((batch_size, npoint)).byte()
-        for i in range(batch_size):
-            ref_cluster[i, :] = (instance_labels[npoint * i:npoint * (i + 1)] == object_id[i])
-        # print(ref_cluster)
+        point_batch_idxs = batch_idxs.long().to(instance_labels.device)
+        scene_pointnum = torch.bincount(point_batch_idxs, minlength=batch_size)
+        batch_offsets = torch.cumsum(scene_pointnum, 0) - scene_pointnum  # 每个场景第一个点的下标
+        local_idxs = torch.arange(point_batch_idxs.shape[0], device=point_batch_idxs.device) - \
+            batch_offsets[point_batch_idxs]  # 每个点在其场景内的下标
+        npoint = int(scene_pointnum.max())  # 点最多的场景的点数，例如40000
+
+        # 获取每个目标的ref_cluster (T,npoint) 如（4，40000）,为节约内存用bytetensor，点数较少的场景后面补-100（不属于任何instance）
+        scene_instance_labels = instance_labels.new_full((batch_size, npoint), -100)
+        scene_instance_labels[point_batch_idxs, local_idxs] = instance_labels
+        ref_cluster = (scene_instance_labels[target_batch_idxs.to(instance_labels.device)] ==
+                       object_id.view(-1, 1).to(instance_labels.device)).byte().cpu()
 
         # 获取全部proposal的cluster (N,npoint) 如 (512,40000)
         proposal_cluster = torch.zeros((proposal_num, npoint)).byte()
-        for [i, j] in proposals_idx:
-            proposal_cluster[i, j % npoint] = 1
-        # print(proposal_cluster)
+        proposal_cluster[proposals_idx[:, 0].long(), local_idxs.cpu()[proposals_idx[:, 1].long()]] = 1
 
         # 作iou选取和ref_cluster最接近的
-        select_proposal_idx = torch.zeros(batch_size).int()
-        for i in range(batch_size):
+        select_proposal_idx = torch.zeros(num_targets).int()
+        for i in range(num_targets):
             ref = ref_cluster[i]
-            iou_score = (proposal_cluster[proposal_id_offset[i]:proposal_id_offset[i + 1], :] * ref).sum(1) / (
-                    proposal_cluster[proposal_id_offset[i]:proposal_id_offset[i + 1], :].sum(1) + ref.sum() - (
-                    proposal_cluster[proposal_id_offset[i]:proposal_id_offset[i + 1], :] * ref).sum(1))
+            start, end = proposal_id_offset[target_batch_idxs[i]], proposal_id_offset[target_batch_idxs[i] + 1]
+            iou_score = (proposal_cluster[start:end, :] * ref).sum(1) / (
+                    proposal_cluster[start:end, :].sum(1) + ref.sum() - (proposal_cluster[start:end, :] * ref).sum(1))
             if iou_score.shape[0] == 0:
                 select_proposal_idx[i] = -1
             else:
-                select_proposal_idx[i] = iou_score.argmax() + proposal_id_offset[i]
+                select_proposal_idx[i] = iou_score.argmax() + start
                 if iou_score.max() > 0.2:
                     good_clu_masks[i] = 1
 
-                # print(iou_score)
-                # print(iou_score.argmax())
-                # print("最匹配的cluster的下标为:", iou_score.argmax() + proposal_id_offset[i])
-
         return select_proposal_idx, proposal_id_offset, good_clu_masks
 
     @cuda_cast
     def forward(self, batch_idxs, voxel_coords, p2v_map, v2p_map, coords_float, feats,
                 semantic_labels, instance_labels, pt_offset_labels, spatial_shape,
-                batch_size, object_id, **kwargs):
+                batch_size, object_id, target_batch_idxs=None, **kwargs):
+        # target_batch_idxs: (num_targets) 每个描述目标所属的场景，scene模式下一个场景有多个目标（见dataset的targets_per_scene）
 
         feats = torch.cat((feats, coords_float), 1)
         voxel_feats = voxelization(feats, p2v_map)
@@ -159,7 +163,8 @@ class SoftGroup(nn.Module):
 
         select_proposal_idx, proposal_id_offset, good_clu_masks = self.select_feat(proposals_idx, proposal_each_scene,
                                                                                    instance_labels, object_id,
-                                                                                   batch_size)
+                                                                                   batch_size, batch_idxs,
+                                                                                   target_batch_idxs)
 
         # 提取每个instance proposal的feature
         # 这里的是voxelization之后的，即inst_feat是tiny unet的输入
@@ -177,8 +182,8 @@ class SoftGroup(nn.Module):
         for i in range(batch_size):
             clus_feats_batch[i][0:proposal_each_scene[i]] = feats[proposal_id_offset[i]:proposal_id_offset[i + 1]]
 
-        select_feats = torch.zeros([batch_size, feats.shape[1]]).cuda()
-        for i in range(batch_size):
+        select_feats = torch.zeros([select_proposal_idx.shape[0], feats.shape[1]]).cuda()  # (num_targets, 32)
+        for i in range(select_proposal_idx.shape[0]):
             if select_proposal_idx[i] != -1:
                 select_feats[i] = feats[select_proposal_idx[i]]
 
@@ -155,18 +155,19 @@ def get_max_memory():
 
 
 def cuda_cast(func):
+    # non_blocking only overlaps the copy for pinned tensors (see lib/batch.py), pageable ones are copied as before
 
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
         new_args = []
         for x in args:
             if isinstance(x, torch.Tensor):
-                x = x.cuda()
+                x = x.cuda(non_blocking=True)
             new_args.append(x)
         new_kwargs = {}
         for k, v in kwargs.items():
             if isinstance(v, torch.Tensor):
-                v = v.cuda()
+                v = v.cuda(non_blocking=True)
             new_kwargs[k] = v
         return func(*new_args, **new_kwargs)
 
@@ -0,0 +1,198 @@
+'''
+Microbenchmarks of the per-sample dataset preprocessing on synthetic scenes, run from the repo root:
+    python scripts/benchmark_dataset.py --num_points 40000 250000
+Every benchmark checks that the fast version gives the same result as the reference one.
+'''
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+import torch
+
+sys.path.append(os.getcwd())  # HACK run from the repo root
+from lib.dataset import get_instance_info, get_instance_info_loop, ScannetReferenceDataset
+from ops import voxelization_idx
+from lib.config import CONF
+from lib.augment import random_affine, batch_affine, get_batch_offsets, augment_batch
+from lib.voxel_cache import voxelize_batch
+from lib.elastic import elastic, elastic_scipy, elastic_batch, NoisePool
+from lib.crop import crop, crop_loop, PointHistogram
+from utils.pc_utils import random_sampling, voxel_sampling
+
+
+def make_scene(num_points, num_instances=40, seed=0):
+    """ random float32 xyz, instance labels with unassigned (-100) points and unused ids, semantic labels """
+    rng = np.random.RandomState(seed)
+    xyz = (rng.rand(num_points, 3) * 8.).astype(np.float32)
+    instance_label = rng.randint(0, num_instances, num_points)
+    instance_label[instance_label % 7 == 3] = -100  # removed instances (wall / floor / ceiling)
+    instance_label[rng.rand(num_points) < 0.1] = -100
+    semantic_label = rng.randint(0, 20, num_points)
+    return xyz, instance_label, semantic_label
+
+
+def timeit(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        fn()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def bench_instance_info(num_points, repeat):
+    xyz, instance_label, semantic_label = make_scene(num_points)
+    ref = get_instance_info_loop(xyz, instance_label, semantic_label)
+    new = get_instance_info(xyz, instance_label, semantic_label)
+    assert ref[0] == new[0] and list(ref[1]) == list(new[1]) and list(ref[2]) == list(new[2])
+    assert ref[3].dtype == new[3].dtype and np.array_equal(ref[3], new[3])
+
+    t_loop = timeit(lambda: get_instance_info_loop(xyz, instance_label, semantic_label), repeat)
+    t_new = timeit(lambda: get_instance_info(xyz, instance_label, semantic_label), repeat)
+    print('getInstanceInfo  {:>7d} points: loop {:.2f} ms, vectorized {:.2f} ms ({:.1f}x)'.format(
+        num_points, t_loop * 1000, t_new * 1000, t_loop / t_new))
+
+
+def bench_elastic(num_points, repeat, batch_size=4):
+    """ the two elastic calls of transform_train on a centered 8m x 8m x 3m scene """
+    rng = np.random.RandomState(0)
+    xyz = (rng.rand(num_points, 3) - 0.5) * np.array([8., 8., 3.]) * 50
+
+    def run(fn, **kwargs):
+        return fn(fn(xyz, 6, 40., **kwargs), 20, 160., **kwargs)
+
+    np.random.seed(0)
+    ref = run(elastic_scipy)
+    np.random.seed(0)
+    new = run(elastic)
+    assert np.abs(ref - new).max() < 1e-6
+
+    noise_pool = NoisePool()
+    run(elastic, noise_pool=noise_pool)  # fill the pool
+    t_scipy = timeit(lambda: run(elastic_scipy), repeat)
+    t_new = timeit(lambda: run(elastic), repeat)
+    t_pool = timeit(lambda: run(elastic, noise_pool=noise_pool), repeat)
+    print('elastic          {:>7d} points: scipy {:.2f} ms, vectorized {:.2f} ms ({:.1f}x), '
+          'noise pool {:.2f} ms ({:.1f}x)'.format(num_points, t_scipy * 1000, t_new * 1000, t_scipy / t_new, t_pool * 1000, t_scipy / t_pool))
+
+    xyz_batch = torch.from_numpy(np.concatenate([xyz] * batch_size)).float()
+    batch_offsets = torch.arange(batch_size + 1) * num_points
+    t_batch = timeit(lambda: elastic_batch(elastic_batch(xyz_batch, batch_offsets, 6, 40.), batch_offsets, 20, 160.),
+                     repeat)
+    print('elastic_batch    {:>7d} points x {}: {:.2f} ms per sample'.format(
+        num_points, batch_size, t_batch * 1000 / batch_size))
+
+
+def bench_crop(num_points, repeat, max_npoint=250000, spatial_shape=512):
+    """ crop of an 18m x 18m x 4m scene with 5 x num_points points (transform_train is given the full scene) """
+    rng = np.random.RandomState(0)
+    xyz = rng.rand(num_points * 5, 3) * np.array([18., 18., 4.]) * 50
+    xyz -= xyz.min(0)
+
+    np.random.seed(0)
+    ref = crop_loop(xyz, spatial_shape, max_npoint)
+    np.random.seed(0)
+    new = crop(xyz, spatial_shape, max_npoint)
+    assert np.array_equal(ref[0], new[0]) and np.array_equal(ref[1], new[1])
+
+    histogram = PointHistogram(xyz)
+    t_loop = timeit(lambda: crop_loop(xyz, spatial_shape, max_npoint), repeat)
+    t_new = timeit(lambda: crop(xyz, spatial_shape, max_npoint), repeat)
+    t_reuse = timeit(lambda: crop(xyz, spatial_shape, max_npoint, histogram=histogram), repeat)
+    print('crop             {:>7d} points: loop {:.2f} ms, histogram {:.2f} ms ({:.1f}x), '
+          'prebuilt histogram {:.2f} ms ({:.1f}x)'.format(xyz.shape[0], t_loop * 1000, t_new * 1000, t_loop / t_new,
+                                                         t_reuse * 1000, t_loop / t_reuse))
+
+
+def make_uneven_scene(num_points, num_objects=30, seed=0):
+    """ 6m x 6m room in meters: densely scanned floor and walls (90% of the points) and small sparse objects """
+    rng = np.random.RandomState(seed)
+    num_object_points = num_points // 10 // num_objects
+    num_room_points = num_points - num_object_points * num_objects
+    room = rng.rand(num_room_points, 3) * np.array([6., 6., 0.])  # floor
+    walls = rng.rand(num_room_points) < 0.5
+    room[walls, 2] = rng.rand(walls.sum()) * 3.
+    room[walls, 0] = 0.
+    objects = rng.rand(num_objects, 1, 3) * np.array([5., 5., 1.]) + 0.5
+    objects = (objects + rng.rand(num_objects, num_object_points, 3) * 0.3).reshape(-1, 3)
+    xyz = np.concatenate([room, objects])
+    instance_label = np.concatenate([np.full(num_room_points, -100), np.repeat(np.arange(num_objects),
+                                                                                num_object_points)])
+    return xyz, instance_label
+
+
+def bench_sampling(num_points, repeat, voxel_size=0.05):
+    """ points kept on the small objects by random / voxel / fps sampling at lower budgets """
+    xyz, instance_label = make_uneven_scene(num_points)
+    num_objects = instance_label.max() + 1
+
+    def coverage(choices):
+        counts = np.bincount(instance_label[choices][instance_label[choices] >= 0], minlength=num_objects)
+        return counts.min(), np.median(counts)
+
+    for num_sample in [num_points // 4, num_points // 8]:
+        np.random.seed(0)
+        for name, fn, fn_repeat in [
+            ('random', lambda: random_sampling(xyz, num_sample, return_choices=True), repeat),
+            ('voxel', lambda: voxel_sampling(xyz, num_sample, voxel_size, return_choices=True), repeat),
+            ('fps', lambda: voxel_sampling(xyz, num_sample, voxel_size, fps=True, return_choices=True), repeat),
+        ]:
+            pc, choices = fn()
+            assert pc.shape[0] == num_sample
+            min_count, median_count = coverage(choices)
+            print('sampling {:>6s}  {:>7d} -> {:>6d} points: {:8.2f} ms, object points min {:>4d} median {:>6.1f}'.format(
+                name, num_points, num_sample, timeit(fn, fn_repeat) * 1000, min_count, median_count))
+
+
+def bench_augment(num_points, repeat, batch_size=4):
+    """ what batch_augment takes out of the worker (dataAugment of every sample, voxelization_idx of the batch)
+    vs what it leaves there (random_affine) and augment_batch on the device (with elastic) """
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    rng = np.random.RandomState(0)
+    xyz = [rng.rand(num_points, 3) * 8. for _ in range(batch_size)]
+    coords_float = torch.from_numpy(np.concatenate(xyz)).float()
+    batch_idxs = torch.arange(batch_size, dtype=torch.int).repeat_interleave(num_points)
+    coords = torch.cat([batch_idxs[:, None].long(), (coords_float * CONF.voxel_cfg.scale).long()], 1)
+
+    matrices = random_affine(batch_size, seeds=range(batch_size))
+    out = batch_affine(coords_float, get_batch_offsets(batch_idxs, batch_size), matrices)
+    assert torch.allclose(out[:num_points].double(), torch.from_numpy(xyz[0]) @ matrices[0], atol=1e-4)
+    assert all(torch.equal(a, b) for a, b in zip(voxelization_idx(coords, batch_size), voxelize_batch(coords)))
+
+    def per_sample():
+        return [ScannetReferenceDataset.dataAugment(None, x, True, True, True, True) for x in xyz]
+
+    batch = {'coords_float': coords_float, 'pt_offset_labels': coords_float.clone(), 'batch_idxs': batch_idxs,
+             'instance_labels': torch.zeros(batch_size * num_points, dtype=torch.long), 'batch_size': batch_size}
+    batch = {k: v.to(device) if torch.is_tensor(v) else v for k, v in batch.items()}
+    aug_mask = torch.ones(batch_size, dtype=torch.bool)
+
+    def on_device():
+        augment_batch(dict(batch, aug_matrices=matrices, aug_mask=aug_mask), CONF.voxel_cfg)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+
+    t_loop = timeit(per_sample, repeat)
+    t_voxelize = timeit(lambda: voxelization_idx(coords, batch_size), repeat)
+    t_matrices = timeit(lambda: random_affine(batch_size, seeds=range(batch_size)), repeat)
+    t_device = timeit(on_device, repeat)
+    print('augment          {:>7d} points x {}: worker dataAugment {:.2f} ms + voxelization_idx {:.2f} ms, '
+          'batch_augment worker {:.2f} ms ({:.1f}x) + augment_batch on {} {:.2f} ms'.format(
+              num_points, batch_size, t_loop * 1000, t_voxelize * 1000, t_matrices * 1000,
+              (t_loop + t_voxelize) / t_matrices, device.type, t_device * 1000))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num_points', type=int, nargs='+', default=[40000, 250000])
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    for num_points in args.num_points:
+        bench_instance_info(num_points, args.repeat)
+        bench_elastic(num_points, args.repeat)
+        bench_crop(num_points, args.repeat)
+        bench_sampling(num_points, args.repeat)
+        bench_augment(num_points, args.repeat)
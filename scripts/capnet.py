@@ -4,7 +4,6 @@ import numpy as np
 import sys
 import os
 import json
-import pickle
 import pytorch_lightning as pl
 
 from model.softgroup_module import SoftGroup
@@ -22,20 +21,25 @@ import lib.capeval.meteor.meteor as capmeteor
 
 sys.path.append(os.path.join(os.getcwd(), "lib"))  # HACK add the lib folder
 from lib.config import CONF
+from lib.glove import load_glove
+from lib.stage_timer import StageTimer
+from lib.augment import augment_batch
+from lib.batch import warn_undeclared_args
 
 vocab_path = os.path.join(CONF.PATH.DATA, "Scanrefer_vocabulary.json")
-GLOVE_PICKLE = os.path.join(CONF.PATH.DATA, "glove.p")
 
 
 class CapNet(pl.LightningModule):
     def __init__(self):
         super().__init__()
         self.vocabulary = json.load(open(vocab_path))
-        self.embeddings = pickle.load(open(GLOVE_PICKLE, "rb"))
+        self.embeddings = load_glove(self.vocabulary, "Scanrefer")  # memory-mapped vocabulary GloVe matrix
         self.organized = json.load(open(os.path.join(CONF.PATH.DATA, "scanrefer/ScanRefer_filtered_organized.json")))
         self.candidates = {}
         self.cap_acc = []
         self.cap_loss = []
+        self.stage_timer = StageTimer()  # data pipeline stage times of all DataLoader workers
+        self.scene_cache_counts = {'hits': 0, 'misses': 0}  # SceneCache lookups of all workers in this epoch
         # Define the model
         # -------------------------------------------------------------
         # ----------- SoftGroup-based Detection Backbone --------------
@@ -60,6 +64,7 @@ class CapNet(pl.LightningModule):
 
     def forward_train(self, batch):
         # semantic segmentation/grouping cluster/get cluster features
+        warn_undeclared_args(batch, self.softgroup_module.forward)
         batch['clus_feats_batch'], batch['select_feats'], batch['losses'], batch[
             'good_clu_masks'] = self.softgroup_module.forward(**batch)
         # predict bboxes
@@ -73,6 +78,7 @@ class CapNet(pl.LightningModule):
         # 新加的
         batch_size = batch['batch_size']
         num_proposals = CONF.train_cfg.max_proposal_num
+        warn_undeclared_args(batch, self.softgroup_module.forward_val)
         batch['clus_feats_batch'], batch['clus_center_batch'], batch['valid_clu_masks'], batch[
             'losses'] = self.softgroup_module.forward_val(
             **batch)
@@ -180,7 +186,36 @@ class CapNet(pl.LightningModule):
         print("validation数据集的bleu为：", bleu[0])
         return bleu
 
+    def log_stage_times(self, batch):
+        # merge the stage times the worker put into the batch, log the percentiles (ms) of the recent batches
+        stage_times = batch.pop('stage_times', None)
+        if stage_times is None:
+            return
+        self.stage_timer.merge(stage_times)
+        for name, value in self.stage_timer.percentiles().items():
+            self.log('data/' + name, value, on_step=True, logger=True, batch_size=batch['batch_size'])
+
+    def log_scene_cache(self, batch):
+        # hit rate of the workers' scene caches (lazy mode) in this epoch, from the counts the workers put into the batch
+        counts = batch.pop('scene_cache', None)
+        if counts is None:
+            return
+        for key in self.scene_cache_counts:
+            self.scene_cache_counts[key] += counts[key]
+        lookups = self.scene_cache_counts['hits'] + self.scene_cache_counts['misses']
+        if lookups > 0:
+            self.log('data/scene_cache_hit_rate', self.scene_cache_counts['hits'] / lookups, on_step=True, logger=True,
+                     batch_size=batch['batch_size'])
+
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        # batch_augment: the affine / elastic augmentation and the voxelization of the batch run on the device
+        if batch.get('aug_matrices') is not None:
+            batch = augment_batch(batch, CONF.voxel_cfg)
+        return batch
+
     def training_step(self, batch):
+        self.log_stage_times(batch)
+        self.log_scene_cache(batch)
         batch = self.forward_train(batch)
         semantic_loss = batch['losses']['semantic_loss']
         offset_loss = batch['losses']['offset_loss']
@@ -197,11 +232,13 @@ class CapNet(pl.LightningModule):
         return loss
 
     def on_train_epoch_end(self):
+        self.scene_cache_counts = {'hits': 0, 'misses': 0}
         filepath = f'model_checkpoint_epoch{self.current_epoch}.ckpt'
         self.trainer.save_checkpoint(filepath)
 
     def visualization_softgroup(self, batch):
         # semantic preds/instance preds
+        warn_undeclared_args(batch, self.softgroup_module.forward_visualization)
         result = self.softgroup_module.forward_visualization(**batch)
 
         return result
@@ -0,0 +1,181 @@
+'''
+Static check of STAGE_FIELDS (lib/dataset.py) against the model, run from the repo root:
+    python scripts/check_stage_fields.py
+Starting at the CapNet hooks of every stage, the calls that get the batch are followed through
+CapNet, its modules and the functions they import from the repo. A batch key the model reads
+(batch[key], batch.pop(key)) and never writes, or a named argument of a forward(**batch), has to be
+declared for the stage; batch.get(key) and pop with a default are optional reads. Branches on a
+flag argument with a constant value (caption_module.forward(batch, is_eval=True)) are followed
+for that value only. Exits with 1 if a key is missing, declared keys nothing reads are listed.
+'''
+
+import ast
+import os
+import sys
+
+sys.path.append(os.getcwd())  # HACK run from the repo root
+from lib.dataset import STAGE_FIELDS
+
+CAPNET = ('scripts/capnet.py', 'CapNet')
+# CapNet attribute -> (file, class) of the module
+MODULES = {
+    'softgroup_module': ('model/softgroup_module.py', 'SoftGroup'),
+    'proposal_module': ('model/proposal_module.py', 'ProposalModule'),
+    'caption_module': ('model/caption_module.py', 'CaptionModule'),
+}
+# stage -> CapNet methods Lightning calls with the batch
+STAGE_HOOKS = {
+    'train': ['on_after_batch_transfer', 'training_step'],
+    'val': ['validation_step'],
+    'predict': ['predict_step'],
+}
+
+_trees = {}
+
+
+def parse(path):
+    if path not in _trees:
+        with open(path) as f:
+            _trees[path] = ast.parse(f.read(), path)
+    return _trees[path]
+
+
+def find_function(path, cls, name):
+    """ FunctionDef of cls.name (cls None: module level function) in path, None if there is none """
+    body = parse(path).body
+    if cls is not None:
+        body = next((node.body for node in body if isinstance(node, ast.ClassDef) and node.name == cls), [])
+    return next((node for node in body if isinstance(node, ast.FunctionDef) and node.name == name), None)
+
+
+def find_import(path, name):
+    """ repo file a module level name of path is imported from (from lib.x import name), None otherwise """
+    for node in parse(path).body:
+        if isinstance(node, ast.ImportFrom) and node.module and any(alias.name == name for alias in node.names):
+            source = node.module.replace('.', '/') + '.py'
+            if os.path.exists(source):
+                return source
+    return None
+
+
+def resolve(path, cls, func):
+    """ (path, cls, FunctionDef) a call goes to, None for calls outside of the model / repo """
+    if isinstance(func, ast.Name):
+        if find_function(path, None, func.id) is not None:
+            return path, None, find_function(path, None, func.id)
+        source = find_import(path, func.id)
+        return (source, None, find_function(source, None, func.id)) if source else None
+    if not isinstance(func, ast.Attribute):
+        return None
+    owner = func.value
+    if isinstance(owner, ast.Name) and owner.id == 'self' and cls is not None:
+        function = find_function(path, cls, func.attr)
+        return (path, cls, function) if function is not None else None
+    if isinstance(owner, ast.Attribute) and isinstance(owner.value, ast.Name) and owner.value.id == 'self' \
+            and (path, cls) == CAPNET and owner.attr in MODULES:
+        module_path, module_cls = MODULES[owner.attr]
+        return module_path, module_cls, find_function(module_path, module_cls, func.attr)
+    return None
+
+
+def named_args(function):
+    args = function.args
+    return [arg.arg for arg in args.posonlyargs + args.args + args.kwonlyargs if arg.arg != 'self']
+
+
+def key_of(node):
+    return node.value if isinstance(node, ast.Constant) and isinstance(node.value, str) else None
+
+
+def constant_args(function, call=None):
+    """ parameter -> value of the parameters with a constant default or a constant argument of call """
+    params = [arg.arg for arg in function.args.posonlyargs + function.args.args]
+    defaults = function.args.defaults
+    values = {param: default.value for param, default in zip(params[len(params) - len(defaults):], defaults)
+              if isinstance(default, ast.Constant)}
+    if call is not None:
+        offset = 1 if params[:1] == ['self'] else 0
+        values.update({params[i + offset]: arg.value for i, arg in enumerate(call.args)
+                       if isinstance(arg, ast.Constant) and i + offset < len(params)})
+        values.update({keyword.arg: keyword.value.value for keyword in call.keywords
+                       if keyword.arg is not None and isinstance(keyword.value, ast.Constant)})
+    return values
+
+
+def evaluate(test, values):
+    """ truth value of an if test on a constant parameter (flag, not flag), None if unknown """
+    if isinstance(test, ast.UnaryOp) and isinstance(test.op, ast.Not):
+        value = evaluate(test.operand, values)
+        return None if value is None else not value
+    if isinstance(test, ast.Name) and test.id in values:
+        return bool(values[test.id])
+    return None
+
+
+class KeyCollector(object):
+    """ reads / optional reads / writes of batch keys of all functions reached from the hooks of a stage """
+
+    def __init__(self):
+        self.reads, self.optional, self.writes = set(), set(), set()
+        self.visited = set()
+
+    def visit(self, path, cls, function, batch_arg, call=None):
+        """ function gets the batch as its positional argument batch_arg (from call) """
+        params = [arg.arg for arg in function.args.posonlyargs + function.args.args]
+        values = constant_args(function, call)
+        state = (path, cls, function.name, batch_arg, tuple(sorted(values.items(), key=repr)))
+        if batch_arg >= len(params) or state in self.visited:
+            return
+        self.visited.add(state)
+        for statement in function.body:
+            self.visit_node(path, cls, statement, params[batch_arg], values)
+
+    def visit_node(self, path, cls, node, name, values):
+        if isinstance(node, ast.If) and evaluate(node.test, values) is not None:
+            for statement in node.body if evaluate(node.test, values) else node.orelse:
+                self.visit_node(path, cls, statement, name, values)
+            return
+        if isinstance(node, ast.Subscript) and isinstance(node.value, ast.Name) and node.value.id == name:
+            key = key_of(node.slice)
+            if key is not None:
+                (self.writes if isinstance(node.ctx, ast.Store) else self.reads).add(key)
+        elif isinstance(node, ast.Call):
+            self.visit_call(path, cls, node, name)
+        for child in ast.iter_child_nodes(node):
+            self.visit_node(path, cls, child, name, values)
+
+    def visit_call(self, path, cls, call, name):
+        func = call.func
+        if isinstance(func, ast.Attribute) and isinstance(func.value, ast.Name) and func.value.id == name:
+            # batch.get(key) / batch.pop(key[, default])
+            key = key_of(call.args[0]) if call.args else None
+            if key is not None and func.attr in ('get', 'pop'):
+                (self.reads if func.attr == 'pop' and len(call.args) == 1 else self.optional).add(key)
+            return
+        target = resolve(path, cls, func)
+        if target is None or target[2] is None:
+            return
+        target_path, target_cls, function = target
+        if any(keyword.arg is None and isinstance(keyword.value, ast.Name) and keyword.value.id == name
+               for keyword in call.keywords):
+            self.reads.update(named_args(function))  # forward(**batch)
+        offset = 1 if target_cls is not None else 0  # self
+        for i, arg in enumerate(call.args):
+            if isinstance(arg, ast.Name) and arg.id == name:
+                self.visit(target_path, target_cls, function, i + offset, call)
+
+
+def check_stage(stage):
+    collector = KeyCollector()
+    for hook in STAGE_HOOKS[stage]:
+        collector.visit(CAPNET[0], CAPNET[1], find_function(CAPNET[0], CAPNET[1], hook), 1)
+    missing = sorted(collector.reads - collector.writes - STAGE_FIELDS[stage])
+    unread = sorted(STAGE_FIELDS[stage] - collector.reads - collector.optional)
+    print('{:<8s} {} keys read, missing from STAGE_FIELDS: {}, declared but not read: {}'.format(
+        stage, len(collector.reads | collector.optional), missing or 'none', unread or 'none'))
+    return not missing
+
+
+if __name__ == '__main__':
+    results = [check_stage(stage) for stage in STAGE_HOOKS]
+    sys.exit(0 if all(results) else 1)
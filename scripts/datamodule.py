@@ -6,13 +6,48 @@ from torch.utils.data import DataLoader
 
 from lib.dataset import ScannetReferenceDataset
 from lib.dataset import get_scanrefer
+from lib.scene_cache import DEFAULT_CACHE_BYTES
+from lib.sampler import EpochRandomSampler, SceneLocalityBatchSampler, get_sample_scene_ids
 
 sys.path.append(os.path.join(os.getcwd(), "lib"))  # HACK add the lib folder
 
 
 class ScanReferDataModule(pl.LightningDataModule):
-    def __init__(self):
+    def __init__(self, scene_format='npy', cache_voxelization=True, lazy=False, cache_bytes=DEFAULT_CACHE_BYTES,
+                 lang_ids_only=False, augment=False, elastic_pool_size=0, batch_elastic=False, num_points=40000, sampling='random',
+                 sampling_voxel_size=0.05, targets_per_scene=0, scene_locality_window=0,
+                 shared_memory=False, pin_memory=False, batch_augment=False, batch_ring_size=0,
+                 project_fields=False, validate_fields=False, batch_size=4, num_workers=4, prefetch_factor=2):
         super().__init__()
+        if not augment and (elastic_pool_size > 0 or batch_elastic or batch_augment):
+            raise ValueError('elastic_pool_size, batch_elastic and batch_augment change the train augmentation, '
+                             'they need augment=True')
+        self.batch_size = batch_size  # train / val batch size, test runs with 1
+        self.num_workers = num_workers  # DataLoader workers, also the worker interleaving of SceneLocalityBatchSampler
+        self.prefetch_factor = prefetch_factor  # batches queued per DataLoader worker
+        self.scene_format = scene_format  # 'npy', 'packed' or 'shard' (see lib/scene_pack.py)
+        self.cache_voxelization = cache_voxelization  # val/test voxelization cache (see lib/voxel_cache.py)
+        self.lazy = lazy  # open scenes on first access instead of loading all of them up front
+        self.cache_bytes = cache_bytes  # budget of the per-worker prepared scene cache of lazy mode (see lib/scene_cache.py)
+        self.lang_ids_only = lang_ids_only  # ship token ids only, CaptionModule looks up the embeddings
+        self.augment = augment  # augmentation of the train samples (dataAugment, elastic, see lib/dataset.py)
+        self.elastic_pool_size = elastic_pool_size  # reuse pre-blurred elastic noise fields (see lib/elastic.py)
+        self.batch_elastic = batch_elastic  # elastic distortion of the whole batch in collate_fn
+        self.batch_augment = batch_augment  # augmentation and voxelization of the batch on the GPU (see lib/augment.py)
+        self.num_points = num_points  # points per training sample
+        self.sampling = sampling  # 'random', 'voxel' or 'fps' (see voxel_sampling in utils/pc_utils.py)
+        self.sampling_voxel_size = sampling_voxel_size  # voxel size in meters of the 'voxel' / 'fps' sampling
+        self.targets_per_scene = targets_per_scene  # > 0: train on scenes with this many descriptions each
+        self.scene_locality_window = scene_locality_window  # > 0: batches from this many scenes per worker (see lib/sampler.py)
+        self.shared_memory = shared_memory  # one copy of the prepared scenes for all workers (see lib/shared_scenes.py)
+        self.pin_memory = pin_memory  # pinned batches, copied to the GPU with non_blocking=True (see lib/batch.py)
+        # > 0: workers collate into this many reused shared memory buffers,
+        # without pin_memory >= prefetch_factor + 3 (min_ring_size in lib/batch.py), checked by the datasets
+        self.batch_ring_size = batch_ring_size
+        # only collate the batch keys the model reads in each stage (STAGE_FIELDS in lib/dataset.py),
+        # validate_fields (with project_fields): collate all keys, warn when the model reads an undeclared one (see lib/batch.py)
+        self.project_fields = project_fields
+        self.validate_fields = validate_fields
         self.dataset_val = None
         self.dataset_test = None
         self.dataset_train = None
@@ -30,8 +65,24 @@ class ScanReferDataModule(pl.LightningDataModule):
             scanrefer=self.Scanrefer_train,
             scanrefer_all_scene=self.all_scene_list,
             split='train',
-            num_points=40000,
-            augment=False,
+            num_points=self.num_points,
+            augment=self.augment,
+            scene_format=self.scene_format,
+            lazy=self.lazy,
+            cache_bytes=self.cache_bytes,
+            lang_ids_only=self.lang_ids_only,
+            shared_memory=self.shared_memory,
+            pin_memory=self.pin_memory,
+            batch_ring_size=self.batch_ring_size,
+            prefetch_factor=self.prefetch_factor,
+            fields='train' if self.project_fields else None,
+            validate_fields=self.validate_fields,
+            elastic_pool_size=self.elastic_pool_size,
+            batch_elastic=self.batch_elastic,
+            batch_augment=self.batch_augment,
+            sampling=self.sampling,
+            sampling_voxel_size=self.sampling_voxel_size,
+            targets_per_scene=self.targets_per_scene,
         )
         self.dataset_val = ScannetReferenceDataset(
             scanrefer=self.Scanrefer_eval_val,
@@ -39,28 +90,70 @@ class ScanReferDataModule(pl.LightningDataModule):
             split='val',
             num_points=40000,
             augment=False,
+            scene_format=self.scene_format,
+            lazy=self.lazy,
+            cache_bytes=self.cache_bytes,
+            lang_ids_only=self.lang_ids_only,
+            shared_memory=self.shared_memory,
+            pin_memory=self.pin_memory,
+            batch_ring_size=self.batch_ring_size,
+            prefetch_factor=self.prefetch_factor,
+            fields='val' if self.project_fields else None,
+            validate_fields=self.validate_fields,
+            cache_voxelization=self.cache_voxelization,
         )
 
         # test要改的
+        # 和val是同样的场景，shared_memory时共用val的共享内存
         self.dataset_test = ScannetReferenceDataset(
             scanrefer=self.Scanrefer_eval_val,
             scanrefer_all_scene=self.all_scene_list,
             split='val',
             num_points=40000,
             augment=False,
+            scene_format=self.scene_format,
+            lazy=self.lazy,
+            cache_bytes=self.cache_bytes,
+            lang_ids_only=self.lang_ids_only,
+            scene_store=self.dataset_val.scene_store,
+            pin_memory=self.pin_memory,
+            batch_ring_size=self.batch_ring_size,
+            prefetch_factor=self.prefetch_factor,
+            fields='predict' if self.project_fields else None,
+            validate_fields=self.validate_fields,
+            cache_voxelization=self.cache_voxelization,
         )
 
+    def teardown(self, stage: str):
+        for dataset in [self.dataset_train, self.dataset_val, self.dataset_test]:
+            if dataset is not None:
+                dataset.close()
+
+    def _worker_args(self):
+        # DataLoader only takes prefetch_factor with workers
+        if self.num_workers == 0:
+            return {'num_workers': 0}
+        return {'num_workers': self.num_workers, 'prefetch_factor': self.prefetch_factor}
+
     def train_dataloader(self):
-        return DataLoader(self.dataset_train, batch_size=4, shuffle=True, num_workers=4,
-                          collate_fn=self.dataset_train.collate_fn)
+        if self.scene_locality_window > 0:
+            batch_sampler = SceneLocalityBatchSampler(get_sample_scene_ids(self.dataset_train),
+                                                      batch_size=self.batch_size, num_workers=self.num_workers,
+                                                      window=self.scene_locality_window, dataset=self.dataset_train)
+            return DataLoader(self.dataset_train, batch_sampler=batch_sampler, **self._worker_args(),
+                              collate_fn=self.dataset_train.collate_fn, pin_memory=self.pin_memory)
+        # EpochRandomSampler: shuffle=True, the scene mode regroups its targets every epoch
+        return DataLoader(self.dataset_train, batch_size=self.batch_size, sampler=EpochRandomSampler(self.dataset_train),
+                          **self._worker_args(), collate_fn=self.dataset_train.collate_fn,
+                          pin_memory=self.pin_memory)
 
     def val_dataloader(self):
-        return DataLoader(self.dataset_val, batch_size=4, shuffle=False, num_workers=4,
-                          collate_fn=self.dataset_val.collate_fn)
+        return DataLoader(self.dataset_val, batch_size=self.batch_size, shuffle=False, **self._worker_args(),
+                          collate_fn=self.dataset_val.collate_fn, pin_memory=self.pin_memory)
 
     def test_dataloader(self):
-        return DataLoader(self.dataset_test, batch_size=1, shuffle=False, num_workers=4,
-                          collate_fn=self.dataset_test.collate_fn)
+        return DataLoader(self.dataset_test, batch_size=1, shuffle=False, **self._worker_args(),
+                          collate_fn=self.dataset_test.collate_fn, pin_memory=self.pin_memory)
 
 
 # test = ScanReferDataModule()
@@ -1,6 +1,8 @@
 import numpy as np
 import os.path as osp
 import os
+import argparse
+import multiprocessing as mp
 from operator import itemgetter
 
 COLOR_DETECTRON2 = np.array([
@@ -132,8 +134,86 @@ SEMANTIC_IDX2NAME = {
 }
 
 
+# corner index pairs of the 12 edges of a box given by 8 corners (get_3d_box order)
+BOX_EDGES = np.array([[0, 1], [0, 3], [0, 4], [2, 3], [2, 6], [2, 1],
+                      [7, 3], [7, 4], [7, 6], [5, 4], [5, 6], [5, 1]])
+BOX_EDGE_COLOR = [255, 0, 0]
+
+PLY_VERTEX_DTYPE = np.dtype([('x', '<f4'), ('y', '<f4'), ('z', '<f4'),
+                             ('red', 'u1'), ('green', 'u1'), ('blue', 'u1')])
+PLY_FACE_DTYPE = np.dtype([('n', 'u1'), ('vertex_indices', '<u4', (3,))])
+PLY_EDGE_DTYPE = np.dtype([('vertex1', '<i4'), ('vertex2', '<i4'),
+                           ('red', 'u1'), ('green', 'u1'), ('blue', 'u1')])
+
+
+def get_box_edges(num_boxes):
+    """ (num_boxes * 12, 2) vertex indices of the edges of boxes stored as consecutive groups of 8 corners """
+    return (BOX_EDGES[None, :, :] + 8 * np.arange(num_boxes)[:, None, None]).reshape(-1, 2)
+
+
+def _format_rows(fmt, rows):
+    # one %-formatting call for all rows instead of one str.format per row
+    rows = np.asarray(rows)
+    if len(rows) == 0:
+        return ''
+    return ((fmt + '\n') * len(rows)) % tuple(rows.ravel().tolist())
+
+
+def write_ply_binary(verts, colors, output_file, faces=None, edges=None, edge_colors=None):
+    """ binary little endian ply with uchar colors, optional triangle faces and colored edges,
+    colors are uint8 or floats in [0, 1] (scaled by 255 and truncated like write_ply)
+    """
+    colors = np.asarray(colors)
+    if colors.dtype != np.uint8:
+        colors = (colors * 255).astype(np.uint8)
+    vertex = np.empty(len(verts), dtype=PLY_VERTEX_DTYPE)
+    for i, name in enumerate(['x', 'y', 'z']):
+        vertex[name] = verts[:, i]
+    for i, name in enumerate(['red', 'green', 'blue']):
+        vertex[name] = colors[:, i]
+
+    header = ['ply', 'format binary_little_endian 1.0', 'element vertex {:d}'.format(len(vertex)),
+              'property float x', 'property float y', 'property float z',
+              'property uchar red', 'property uchar green', 'property uchar blue']
+    body = [vertex.tobytes()]
+    if faces is not None:
+        face = np.empty(len(faces), dtype=PLY_FACE_DTYPE)
+        face['n'] = 3
+        face['vertex_indices'] = faces
+        header += ['element face {:d}'.format(len(face)), 'property list uchar uint vertex_indices']
+        body.append(face.tobytes())
+    if edges is not None:
+        edge = np.empty(len(edges), dtype=PLY_EDGE_DTYPE)
+        edge['vertex1'], edge['vertex2'] = edges[:, 0], edges[:, 1]
+        edge_colors = BOX_EDGE_COLOR if edge_colors is None else edge_colors
+        edge['red'], edge['green'], edge['blue'] = np.broadcast_to(edge_colors, (len(edge), 3)).T
+        header += ['element edge {:d}'.format(len(edge)), 'property int vertex1', 'property int vertex2',
+                   'property uchar red', 'property uchar green', 'property uchar blue']
+        body.append(edge.tobytes())
+    header.append('end_header')
+
+    with open(output_file, 'wb') as f:
+        f.write(('\n'.join(header) + '\n').encode('ascii'))
+        for data in body:
+            f.write(data)
+
+
+def write_box_ply_binary(bbox_xyz, output_file):
+    """ box corners (num_boxes * 8, 3) as red vertices and edges """
+    colors = np.broadcast_to(np.array(BOX_EDGE_COLOR, dtype=np.uint8), (len(bbox_xyz), 3))
+    write_ply_binary(bbox_xyz, colors, output_file, edges=get_box_edges(len(bbox_xyz) // 8))
+
+
 # generate .ply
-def write_ply(verts, colors, indices, output_file, task, bbox_xyz):
+def write_ply(verts, colors, indices, output_file, task, bbox_xyz, binary=False):
+    if binary:
+        if task != "bbox_pred":
+            faces = np.zeros((0, 3), dtype=np.int64) if indices is None else np.asarray(indices).reshape(-1, 3)
+            write_ply_binary(verts, np.zeros_like(verts) if colors is None else colors, output_file, faces=faces)
+        else:
+            write_box_ply_binary(bbox_xyz, output_file)
+        return
+
     if task != "bbox_pred":
         if colors is None:
             colors = np.zeros_like(verts)
@@ -153,29 +233,11 @@ def write_ply(verts, colors, indices, output_file, task, bbox_xyz):
         file.write('element face {:d}\n'.format(len(indices)))
         file.write('property list uchar uint vertex_indices\n')
         file.write('end_header\n')
-        for vert, color in zip(verts, colors):
-            file.write('{:f} {:f} {:f} {:d} {:d} {:d}\n'.format(vert[0], vert[1], vert[2],
-                                                                int(color[0] * 255),
-                                                                int(color[1] * 255),
-                                                                int(color[2] * 255)))
-        for ind in indices:
-            file.write('3 {:d} {:d} {:d}\n'.format(ind[0], ind[1], ind[2]))
+        file.write(_format_rows('%f %f %f %d %d %d', np.concatenate(
+            [np.asarray(verts, dtype=np.float64), (np.asarray(colors) * 255).astype(np.int64)], 1)))
+        file.write(_format_rows('3 %d %d %d', np.asarray(indices, dtype=np.int64).reshape(-1, 3)))
         file.close()
     else:
-        # prime_corner = [0, 2, 5, 7]
-        related_corner1 = [0, 1]
-        related_corner2 = [0, 3]
-        related_corner3 = [0, 4]
-        related_corner4 = [2, 3]
-        related_corner5 = [2, 6]
-        related_corner6 = [2, 1]
-        related_corner7 = [7, 3]
-        related_corner8 = [7, 4]
-        related_corner9 = [7, 6]
-        related_corner10 = [5, 4]
-        related_corner11 = [5, 6]
-        related_corner12 = [5, 1]
-
         file = open(output_file, 'w')
         file.write('ply \n')
         file.write('format ascii 1.0\n')
@@ -194,63 +256,8 @@ def write_ply(verts, colors, indices, output_file, task, bbox_xyz):
         file.write('property uchar blue\n')
         file.write('end_header\n')
 
-        for i, corner_location in enumerate(bbox_xyz):
-            file.write(
-                '{:f} {:f} {:f} {:d} {:d} {:d}\n'.format(corner_location[0], corner_location[1], corner_location[2],
-                                                         int(255), int(0), int(0)))
-
-        for i in range(len(bbox_xyz) // 8):
-            if i == 0:
-                cur_related_corner1 = related_corner1
-                cur_related_corner2 = related_corner2
-                cur_related_corner3 = related_corner3
-                cur_related_corner4 = related_corner4
-                cur_related_corner5 = related_corner5
-                cur_related_corner6 = related_corner6
-                cur_related_corner7 = related_corner7
-                cur_related_corner8 = related_corner8
-                cur_related_corner9 = related_corner9
-                cur_related_corner10 = related_corner10
-                cur_related_corner11 = related_corner11
-                cur_related_corner12 = related_corner12
-            else:
-                cur_related_corner1 = np.sum([cur_related_corner1, [8, 8]], axis=0).tolist()
-                cur_related_corner2 = np.sum([cur_related_corner2, [8, 8]], axis=0).tolist()
-                cur_related_corner3 = np.sum([cur_related_corner3, [8, 8]], axis=0).tolist()
-                cur_related_corner4 = np.sum([cur_related_corner4, [8, 8]], axis=0).tolist()
-                cur_related_corner5 = np.sum([cur_related_corner5, [8, 8]], axis=0).tolist()
-                cur_related_corner6 = np.sum([cur_related_corner6, [8, 8]], axis=0).tolist()
-                cur_related_corner7 = np.sum([cur_related_corner7, [8, 8]], axis=0).tolist()
-                cur_related_corner8 = np.sum([cur_related_corner8, [8, 8]], axis=0).tolist()
-                cur_related_corner9 = np.sum([cur_related_corner9, [8, 8]], axis=0).tolist()
-                cur_related_corner10 = np.sum([cur_related_corner10, [8, 8]], axis=0).tolist()
-                cur_related_corner11 = np.sum([cur_related_corner11, [8, 8]], axis=0).tolist()
-                cur_related_corner12 = np.sum([cur_related_corner12, [8, 8]], axis=0).tolist()
-
-            file.write('{:d} {:d} {:d} {:d} {:d}\n'.format(cur_related_corner1[0], cur_related_corner1[1],
-                                                           int(255), int(0), int(0)))
-            file.write('{:d} {:d} {:d} {:d} {:d}\n'.format(cur_related_corner2[0], cur_related_corner2[1],
-                                                           int(255), int(0), int(0)))
-            file.write('{:d} {:d} {:d} {:d} {:d}\n'.format(cur_related_corner3[0], cur_related_corner3[1],
-                                                           int(255), int(0), int(0)))
-            file.write('{:d} {:d} {:d} {:d} {:d}\n'.format(cur_related_corner4[0], cur_related_corner4[1],
-                                                           int(255), int(0), int(0)))
-            file.write('{:d} {:d} {:d} {:d} {:d}\n'.format(cur_related_corner5[0], cur_related_corner5[1],
-                                                           int(255), int(0), int(0)))
-            file.write('{:d} {:d} {:d} {:d} {:d}\n'.format(cur_related_corner6[0], cur_related_corner6[1],
-                                                           int(255), int(0), int(0)))
-            file.write('{:d} {:d} {:d} {:d} {:d}\n'.format(cur_related_corner7[0], cur_related_corner7[1],
-                                                           int(255), int(0), int(0)))
-            file.write('{:d} {:d} {:d} {:d} {:d}\n'.format(cur_related_corner8[0], cur_related_corner8[1],
-                                                           int(255), int(0), int(0)))
-            file.write('{:d} {:d} {:d} {:d} {:d}\n'.format(cur_related_corner9[0], cur_related_corner9[1],
-                                                           int(255), int(0), int(0)))
-            file.write('{:d} {:d} {:d} {:d} {:d}\n'.format(cur_related_corner10[0], cur_related_corner10[1],
-                                                           int(255), int(0), int(0)))
-            file.write('{:d} {:d} {:d} {:d} {:d}\n'.format(cur_related_corner11[0], cur_related_corner11[1],
-                                                           int(255), int(0), int(0)))
-            file.write('{:d} {:d} {:d} {:d} {:d}\n'.format(cur_related_corner12[0], cur_related_corner12[1],
-                                                           int(255), int(0), int(0)))
+        file.write(_format_rows('%f %f %f 255 0 0', bbox_xyz))
+        file.write(_format_rows('%d %d 255 0 0', get_box_edges(len(bbox_xyz) // 8)))
         file.close()
 
 
@@ -301,18 +308,47 @@ def get_coords_color(prediction_path, room_name, task):
     return xyz, rgb, bbox_xyz
 
 
-if __name__ == '__main__':
-    # visualization_config
-    prediction_path = '/home/luk/DenseCap/visualization'
-    room_name = 'scene0011_00'
-    task_list = ["semantic_pred", "bbox_pred"]
-
-    for _, task in enumerate(task_list):
-        ply_out = '/home/luk/DenseCap/'
+def export_scene(prediction_path, room_name, task_list, output_dir, binary=True):
+    for task in task_list:
         xyz, rgb, bbox_xyz = get_coords_color(prediction_path, room_name, task=task)
 
         points = xyz[:, :3]
         colors = rgb / 255
 
-        ply_out = osp.join(ply_out + room_name + "_" + task + ".ply")
-        write_ply(points, colors, None, ply_out, task, bbox_xyz)
+        ply_out = osp.join(output_dir, room_name + "_" + task + ".ply")
+        write_ply(points, colors, None, ply_out, task, bbox_xyz, binary=binary)
+    return room_name
+
+
+def _export_scene_worker(args):
+    return export_scene(*args)
+
+
+def export_scenes(prediction_path, room_names, task_list, output_dir, binary=True, num_workers=1):
+    """ export several scenes, with num_workers > 1 in a process pool (one scene per task) """
+    jobs = [(prediction_path, room_name, task_list, output_dir, binary) for room_name in room_names]
+    if num_workers > 1:
+        with mp.Pool(num_workers) as pool:
+            for i, room_name in enumerate(pool.imap_unordered(_export_scene_worker, jobs)):
+                print('exported {} ({}/{})'.format(room_name, i + 1, len(jobs)))
+    else:
+        for i, job in enumerate(jobs):
+            print('exported {} ({}/{})'.format(_export_scene_worker(job), i + 1, len(jobs)))
+
+
+if __name__ == '__main__':
+    # visualization_config
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--prediction_path', default='/home/luk/DenseCap/visualization')
+    parser.add_argument('--output_dir', default='/home/luk/DenseCap/')
+    parser.add_argument('--room_name', nargs='+', default=['scene0011_00'],
+                        help='scenes to export, "all" for every scene in prediction_path/coords')
+    parser.add_argument('--task', nargs='+', default=["semantic_pred", "bbox_pred"])
+    parser.add_argument('--ascii', action='store_true', help='write ascii instead of binary ply')
+    parser.add_argument('--num_workers', type=int, default=1)
+    args = parser.parse_args()
+
+    room_names = args.room_name
+    if room_names == ['all']:
+        room_names = sorted([f[:-len('.npy')] for f in os.listdir(osp.join(args.prediction_path, 'coords'))])
+    export_scenes(args.prediction_path, room_names, args.task, args.output_dir, not args.ascii, args.num_workers)
@@ -39,6 +39,94 @@ def random_sampling(pc, num_sample, replace=None, return_choices=False):
     else:
         return pc[choices]
 
+def voxel_keys(xyz, voxel_size):
+    """ Input is Nx3, output is N int64 keys, equal iff the points fall in the same voxel
+    """
+    grid = ((xyz - xyz.min(0)) * (1. / voxel_size)).astype(np.int64)  # truncation is floor for non-negative values
+    dims = grid.max(0) + 1
+    return (grid[:, 0] * dims[1] + grid[:, 1]) * dims[2] + grid[:, 2]
+
+def morton_order(xyz, bits=10):
+    """ Input is Nx3, output is the N point indices sorted along a Z-order curve
+    Consecutive points of the order are close in space, so equal-size runs of it are compact regions
+    """
+    lo = xyz.min(0)
+    extent = max(float((xyz.max(0) - lo).max()), 1e-9)
+    grid = ((xyz - lo) * ((2 ** bits - 1) / extent)).astype(np.int64)
+    code = np.zeros(xyz.shape[0], dtype=np.int64)
+    for bit in range(bits):
+        for axis in range(3):
+            code |= ((grid[:, axis] >> bit) & 1) << (3 * bit + axis)
+    return np.argsort(code, kind='stable')
+
+def farthest_point_sampling(xyz, num_sample, samples_per_bucket=32):
+    """ Input is Nx3, output is num_sample distinct indices (num_sample <= N)
+    The points are split into equal-size buckets along morton_order and farthest point sampling runs in
+    all buckets at once, every bucket taking its share of num_sample starting from a random point.
+    Costs O(samples_per_bucket x N) instead of O(num_sample x N); samples_per_bucket >= num_sample is
+    a single exact FPS. Points are only kept apart from samples of their own bucket.
+    """
+    num_point = xyz.shape[0]
+    num_buckets = -(-num_sample // samples_per_bucket)
+    order = morton_order(xyz) if num_buckets > 1 else np.arange(num_point)
+    points = np.ascontiguousarray(xyz[order], dtype=np.float32)
+    starts = np.arange(num_buckets) * num_point // num_buckets
+    counts = np.diff(np.append(starts, num_point))
+    bucket = np.repeat(np.arange(num_buckets), counts)  # bucket of every point in morton order
+    # share of every bucket proportional to its size, the largest remainders get the leftover samples
+    share = num_sample * counts / num_point
+    quota = np.floor(share).astype(np.int64)
+    quota[np.argsort(quota - share, kind='stable')[:num_sample - quota.sum()]] += 1
+
+    min_dist = np.full(num_point, np.inf, dtype=np.float32)
+    idx = starts + np.random.randint(0, counts)  # next point of every bucket
+    choices = []
+    for i in range(quota.max()):
+        choices.append(idx[quota > i])
+        diff = points - np.repeat(points[idx], counts, axis=0)
+        np.minimum(min_dist, np.einsum('ij,ij->i', diff, diff), out=min_dist)
+        min_dist[choices[-1]] = -1  # never taken twice, also for duplicate points
+        # first point with the largest distance of every bucket
+        hit = np.flatnonzero(min_dist == np.maximum.reduceat(min_dist, starts)[bucket])
+        hit_bucket = bucket[hit]
+        idx = hit[np.flatnonzero(np.r_[True, hit_bucket[1:] != hit_bucket[:-1]])]
+    return order[np.concatenate(choices)]
+
+def voxel_sampling(pc, num_sample, voxel_size=0.05, fps=False, return_choices=False):
+    """ Input is NxC (xyz first), output is num_samplexC, density-aware replacement of random_sampling
+    Keeps one random point per occupied voxel, so dense areas do not take most of the budget.
+    With more occupied voxels than num_sample the voxels are subsampled at random (or by farthest
+    point sampling if fps), with fewer the remaining points are drawn at random from the rest.
+    """
+    num_point = pc.shape[0]
+    # sort by (voxel key, random rank), the first point of every voxel is a random one
+    point_of_rank = np.random.permutation(num_point)
+    rank = np.empty(num_point, dtype=np.int64)
+    rank[point_of_rank] = np.arange(num_point)
+    sorted_keys = np.sort(voxel_keys(pc[:, :3], voxel_size) * num_point + rank)
+    first = np.ones(num_point, dtype=bool)
+    first[1:] = sorted_keys[1:] // num_point != sorted_keys[:-1] // num_point
+    voxel_choices = point_of_rank[sorted_keys[first] % num_point]  # one random point of every occupied voxel
+    if voxel_choices.size >= num_sample:
+        if fps:
+            choices = voxel_choices[farthest_point_sampling(pc[voxel_choices, :3], num_sample)]
+        else:
+            choices = voxel_choices[np.random.choice(voxel_choices.size, num_sample, replace=False)]
+    else:
+        rest = np.ones(num_point, dtype=bool)
+        rest[voxel_choices] = False
+        rest = np.nonzero(rest)[0]
+        num_fill = num_sample - voxel_choices.size
+        if rest.size >= num_fill:
+            fill = np.random.choice(rest, num_fill, replace=False)
+        else:
+            fill = np.concatenate([rest, np.random.choice(num_point, num_fill - rest.size, replace=True)])
+        choices = np.concatenate([voxel_choices, fill])
+    if return_choices:
+        return pc[choices], choices
+    else:
+        return pc[choices]
+
 # ----------------------------------------
 # Point Cloud/Volume Conversions
 # ----------------------------------------